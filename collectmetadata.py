@@ -2,14 +2,21 @@
 collectmetadata.py
 
 Usage:
-  collectmetadata.py <contentpackdir> [--out=out]
+  collectmetadata.py <contentpackdir> [--out=out] [--threads=threads]
   collectmetadata.py -h | --help
+
+Packs whose size and modification time haven't changed since the last run
+are taken from the existing output file as they are.
 """
 import json
+import logging
 import pathlib
 import zipfile
+from multiprocessing.pool import ThreadPool
 from docopt import docopt
 
+from contentpacks.utils import hash_file
+
 
 CONTENTPACK_METADATA_FILENAME = "metadata.json"
 
@@ -17,8 +24,20 @@ CONTENTPACK_EXTENSION = "*.zip"
 
 ALL_METADATA_FILENAME = "all_metadata.json"
 
+NUM_THREADS = 8
+
+
+def read_metadata(filename: pathlib.Path, previous: dict=None) -> dict:
+    """
+    Read the pack's metadata and add its file name, size, modification time
+    and SHA-256. If previous has an entry for the same file with the same
+    size and modification time, return that instead.
+    """
+    stat = filename.stat()
+    previous = (previous or {}).get(filename.name)
+    if previous and previous.get("zip_size") == stat.st_size and previous.get("zip_mtime") == stat.st_mtime:
+        return previous
 
-def read_metadata(filename: pathlib.Path) -> dict:
     with zipfile.ZipFile(str(filename)) as zf:
         # necessary, since zf.open isn't smart enough to auto-decode and return
         # str (it returns bytes)
@@ -26,14 +45,48 @@ def read_metadata(filename: pathlib.Path) -> dict:
             s = zf.read(CONTENTPACK_METADATA_FILENAME).decode('utf-8') 
 
             metadata = json.loads(s)
-
-            # add the file size here as well
-            metadata['zip_size'] = filename.stat().st_size
-
-            return metadata
         except KeyError:    # no metadata file, skip zipfile
             return None
 
+    # add the file's details here as well
+    metadata['zip_name'] = filename.name
+    metadata['zip_size'] = stat.st_size
+    metadata['zip_mtime'] = stat.st_mtime
+    metadata['zip_sha256'] = hash_file(str(filename))
+
+    return metadata
+
+
+def read_previous_metadata(out: pathlib.Path) -> dict:
+    """
+    Return the entries of an earlier all_metadata.json by zip file name.
+    """
+    try:
+        with open(str(out)) as f:
+            all_metadata = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    return {m["zip_name"]: m for m in all_metadata if "zip_name" in m}
+
+
+def collect_metadata(dir: pathlib.Path, previous: dict=None, threads: int=NUM_THREADS) -> list:
+    """
+    Read the metadata of every pack in dir, several at a time, in the order
+    of their file names.
+    """
+    files = sorted(return_all_contentpack_files(dir))
+    pool = ThreadPool(processes=threads)
+    try:
+        all_metadata = pool.map(lambda f: read_metadata(f, previous), files)
+    finally:
+        pool.close()
+        pool.join()
+
+    reused = sum(1 for m in all_metadata if m and previous and previous.get(m["zip_name"]) is m)
+    logging.info("Collected the metadata of {} packs, {} of them unchanged.".format(len(files), reused))
+
+    return [m for m in all_metadata if m]
+
 
 def return_all_contentpack_files(dir: pathlib.Path) -> [pathlib.Path]:
     for path in dir.iterdir():
@@ -44,6 +97,8 @@ def return_all_contentpack_files(dir: pathlib.Path) -> [pathlib.Path]:
 def main():
     args = docopt(__doc__)
 
+    logging.basicConfig(level=logging.INFO)
+
     dir = pathlib.Path(args["<contentpackdir>"])
 
     if args["--out"]:
@@ -54,8 +109,9 @@ def main():
     # ensure dir exists
     out.parent.mkdir(exist_ok=True, parents=True)
 
-    all_metadata = [read_metadata(f) for f in return_all_contentpack_files(dir)]
-    all_metadata = [m for m in all_metadata if m]
+    threads = int(args["--threads"]) if args["--threads"] else NUM_THREADS
+
+    all_metadata = collect_metadata(dir, read_previous_metadata(out), threads)
 
     with open(str(out), "w") as f:
         json.dump(all_metadata, f)
@@ -3,6 +3,7 @@ makepack
 
 Usage:
   makecontentpacks ka-lite <lang> <version> [options]
+  makecontentpacks daemon [--port=port] [--cache-size=megabytes]
   makecontentpacks -h | --help
   makecontentpacks --version
 
@@ -11,26 +12,71 @@ Usage:
 --interfacelang=interface-lang The language to pull from CrowdIn for KALite's/Kolibri's interface.
 --videolang=video-lang         The language of dubbed videos, i.e. what dubbed video mapping language to use.
 --out=outdir                   The path to place the final content pack. 
+--minimal-out=path             If specified, also write a minimal pack (no assessment items, subtitles or exercises) to path.
+--khan-assessment-out=path     If specified, also write a khan_assessment.zip for KA Lite 0.15.x and below to path.
 --logging=log_file             The file for logging output. Defaults to stderr if not specified.
 --no-subtitles                 If specified, will omit downloading and including any subtitles.
 --no-assessment-items          If specified, will omit downloading and including any assessment item data.
 --no-assessment-resources      If specified, will omit downloading and including any resources (images, json files) needed to render assessment item exercises.
 --no-dubbed-videos             If specified, will omit including dubbed video mappings
+--optimize-images              If specified, losslessly recompress the PNG, JPEG and GIF assessment resources.
+--minify-text                  If specified, minify the subtitles, HTML exercises and graphie files.
+--probe-remote-sizes           If specified, check the actual download size of each video, reusing sizes cached by earlier runs.
+--low-memory                   If specified, keep the assessment item data in an on-disk staging database instead of in memory.
+--stream-assessment-items      If specified, filter, translate and save each assessment item as soon as it's downloaded.
+--compress-assessment-items    If specified, store the assessment item data compressed against a dictionary shipped in content.db.
+--mappable-db                  If specified, store content.db uncompressed and page-aligned, so it can be memory-mapped in place.
+--port=port                    The localhost port the daemon listens for build requests on [default: 8765].
+--cache-size=megabytes         Keep parsed topic trees, catalogs and mappings in memory while their source files add up to at most this many megabytes on disk. Parsed, they take several times as much [default: 512].
 
 """
-from docopt import docopt
+import contextlib
+import tempfile
+
+from docopt import docopt, DocoptExit
 from pathlib import Path
+from peewee import SqliteDatabase
 from contentpacks.khanacademy import retrieve_language_resources, apply_dubbed_video_map, retrieve_html_exercises, \
-    retrieve_all_assessment_item_data
+    retrieve_all_assessment_item_data, query_remote_content_file_sizes, apply_remote_content_file_sizes
 from contentpacks.utils import translate_nodes, \
     remove_untranslated_exercises, bundle_language_pack, separate_exercise_types, \
     generate_kalite_language_pack_metadata, translate_assessment_item_text, \
-    remove_assessment_data_with_empty_widgets, remove_nonexistent_assessment_items_from_exercises
+    remove_assessment_data_with_empty_widgets, remove_nonexistent_assessment_items_from_exercises, \
+    generate_dedupe_report, insert_assessment_items
+from contentpacks.optimize import optimize_assessment_images, minify_text_assets
+from contentpacks.pipeline import stream_through
+from contentpacks.staging import StagingStore
+from contentpacks.daemon import serve
 
 import logging
 
 
-def make_language_pack(lang, version, sublangargs, filename, ka_domain, no_assessment_items, no_subtitles, no_assessment_resources, no_dubbed_videos):
+def make_language_pack(lang, version, sublangargs, filename, ka_domain, no_assessment_items, no_subtitles, no_assessment_resources, no_dubbed_videos,
+                       optimize_images=False, minify_text=False, probe_remote_sizes=False, low_memory=False,
+                       stream_assessment_items=False, compress_assessment_items=False, outputs=None, mappable_db=False):
+    with contextlib.ExitStack() as stack:
+        stage = stack.enter_context(StagingStore()).stage if low_memory else _keep_in_memory
+        pack_db_path = stack.enter_context(tempfile.NamedTemporaryFile()).name if stream_assessment_items else None
+
+        return _make_language_pack(lang, version, sublangargs, filename, ka_domain, no_assessment_items, no_subtitles,
+                                   no_assessment_resources, no_dubbed_videos, optimize_images, minify_text,
+                                   probe_remote_sizes, compress_assessment_items, stage=stage, pack_db_path=pack_db_path,
+                                   outputs=outputs, mappable_db=mappable_db)
+
+
+def _keep_in_memory(name, items):
+    return list(items)
+
+
+def _record_ids(items, ids: list):
+    for item in items:
+        ids.append(item["id"])
+        yield item
+
+
+def _make_language_pack(lang, version, sublangargs, filename, ka_domain, no_assessment_items, no_subtitles, no_assessment_resources,
+                        no_dubbed_videos, optimize_images, minify_text, probe_remote_sizes, compress_assessment_items,
+                        stage=_keep_in_memory, pack_db_path=None, outputs=None, mappable_db=False):
     node_data, subtitle_data, interface_catalog, content_catalog = retrieve_language_resources(version, sublangargs, ka_domain, no_subtitles, no_dubbed_videos)
 
     subtitles, subtitle_paths = subtitle_data.keys(), subtitle_data.values()
@@ -39,27 +85,73 @@ def make_language_pack(lang, version, sublangargs, filename, ka_domain, no_asses
     node_data = list(node_data)
     node_data, dubbed_video_count = apply_dubbed_video_map(node_data, subtitles, sublangargs["video_lang"])
 
+    if probe_remote_sizes:
+        remote_sizes = query_remote_content_file_sizes(node_data)
+        node_data = apply_remote_content_file_sizes(node_data, remote_sizes)
+
     html_exercise_ids, assessment_exercise_ids, node_data = separate_exercise_types(node_data)
     html_exercise_path, translated_html_exercise_ids = retrieve_html_exercises(html_exercise_ids, lang)
 
+    if pack_db_path:
+        # Save each item straight into the pack's database as soon as it's downloaded, filtered and translated,
+        # keeping only the ids we need to prune the exercises afterwards.
+        ids_with_widgets, translated_ids = [], []
+        stages = [remove_assessment_data_with_empty_widgets, lambda items: _record_ids(items, ids_with_widgets)]
+        if lang != "en":
+            stages.append(lambda items: translate_assessment_item_text(items, content_catalog))
+        stages.append(lambda items: _record_ids(items, translated_ids))
+
+        def collect(items):
+            return insert_assessment_items(stream_through(items, stages), SqliteDatabase(pack_db_path))
+    else:
+        def collect(items):
+            return stage("all_assessment_data", items)
+
     # now include only the assessment item resources that we need
     all_assessment_data, all_assessment_files = retrieve_all_assessment_item_data(
         no_item_data=no_assessment_items,
         no_item_resources=no_assessment_resources,
         lang=lang,
+        collect=collect,
     )
-    all_assessment_data = list(remove_assessment_data_with_empty_widgets(all_assessment_data))
-    node_data = remove_nonexistent_assessment_items_from_exercises(node_data, all_assessment_data)
-
-    assessment_data = list(translate_assessment_item_text(all_assessment_data, content_catalog)) if lang != "en" else all_assessment_data
+    dedupe_report = generate_dedupe_report(all_assessment_files)
+    logging.info("Assessment resources: {unique_files} unique out of {total_files} files, "
+                 "{duplicate_size} of {total_size} bytes are duplicates.".format(**dedupe_report))
+
+    if optimize_images:
+        all_assessment_files, image_report = optimize_assessment_images(all_assessment_files)
+        for extension, sizes in sorted(image_report.items()):
+            logging.info("Optimized {count} {extension} files: {size_before} -> {size_after} bytes.".format(
+                extension=extension, **sizes))
+
+    if minify_text:
+        subtitle_paths, html_exercise_path, all_assessment_files, text_report = minify_text_assets(
+            subtitle_paths, html_exercise_path, all_assessment_files)
+        for kind, sizes in sorted(text_report.items()):
+            logging.info("Minified {count} {kind}: {size_before} -> {size_after} bytes.".format(kind=kind, **sizes))
+
+    if pack_db_path:
+        logging.info("Saved {} assessment items.".format(all_assessment_data))
+        all_assessment_data = [{"id": item_id} for item_id in ids_with_widgets]
+        node_data = remove_nonexistent_assessment_items_from_exercises(node_data, all_assessment_data)
+        assessment_data = [{"id": item_id} for item_id in translated_ids]
+    else:
+        all_assessment_data = stage("assessment_data_with_widgets", remove_assessment_data_with_empty_widgets(all_assessment_data))
+        node_data = remove_nonexistent_assessment_items_from_exercises(node_data, all_assessment_data)
+
+        assessment_data = stage("translated_assessment_data", translate_assessment_item_text(all_assessment_data, content_catalog)) \
+            if lang != "en" else all_assessment_data
 
     node_data = remove_untranslated_exercises(node_data, translated_html_exercise_ids, assessment_data) if lang != "en" else node_data
 
     pack_metadata = generate_kalite_language_pack_metadata(lang, version, interface_catalog, content_catalog, subtitles,
                                                            dubbed_video_count)
 
+    # the streamed assessment items are already in the database
     bundle_language_pack(str(filename), node_data, interface_catalog, interface_catalog,
-                         pack_metadata, assessment_data, all_assessment_files, subtitle_paths, html_exercise_path)
+                         pack_metadata, [] if pack_db_path else assessment_data, all_assessment_files, subtitle_paths,
+                         html_exercise_path, db_path=pack_db_path, compress_assessment_items=compress_assessment_items,
+                         outputs=outputs, mappable_db=mappable_db)
 
 
 def normalize_sublang_args(args):
@@ -75,13 +167,28 @@ def normalize_sublang_args(args):
     }
 
 
-def main():
-    import os
-    args = docopt(__doc__)
+def run_build_request(request: dict):
+    """
+    Build the pack described by a daemon build request: a lang, a version,
+    and any of the ka-lite command's options, without their leading dashes,
+    e.g. {"lang": "es", "version": "0.16", "out": "out/es.zip", "no-subtitles": true}.
+    """
+    argv = ["ka-lite", request["lang"], request["version"]]
+    for option, value in sorted(request.items()):
+        if option in ("lang", "version") or value in (None, False):
+            continue
+        argv.append("--{}".format(option) if value is True else "--{}={}".format(option, value))
 
-    assert args["ka-lite"], ("Sorry, content packs for non-KA Lite "
-                             "software aren't implemented yet.")
-    del args["ka-lite"]
+    try:
+        args = docopt(__doc__, argv=argv)
+    except DocoptExit as e:
+        raise ValueError("Invalid build request {}: {}".format(request, e))
+
+    build_from_args(args)
+
+
+def build_from_args(args: dict):
+    import os
 
     lang = args["<lang>"]
     version = args["<version>"]
@@ -95,13 +202,45 @@ def main():
     no_assessment_resources = args['--no-assessment-resources']
     no_subtitles = args['--no-subtitles']
     no_dubbed_videos = args['--no-dubbed-videos']
+    optimize_images = args['--optimize-images']
+    minify_text = args['--minify-text']
+    probe_remote_sizes = args['--probe-remote-sizes']
+    low_memory = args['--low-memory']
+    stream_assessment_items = args['--stream-assessment-items']
+    compress_assessment_items = args['--compress-assessment-items']
+    mappable_db = args['--mappable-db']
+
+    outputs = {}
+    if args['--minimal-out']:
+        outputs["minimal"] = str(Path(args['--minimal-out']).expanduser())
+    if args['--khan-assessment-out']:
+        outputs["khan_assessment"] = str(Path(args['--khan-assessment-out']).expanduser())
+
+    make_language_pack(lang, version, sublangs, out, ka_domain, no_assessment_items, no_subtitles, no_assessment_resources, no_dubbed_videos,
+                       optimize_images=optimize_images, minify_text=minify_text,
+                       probe_remote_sizes=probe_remote_sizes, low_memory=low_memory,
+                       stream_assessment_items=stream_assessment_items,
+                       compress_assessment_items=compress_assessment_items, outputs=outputs,
+                       mappable_db=mappable_db)
 
-    log_file = args["--logging"] or "debug.log"
+
+def main():
+    args = docopt(__doc__)
 
     logging.basicConfig(level=logging.INFO)
 
+    if args["daemon"]:
+        serve(run_build_request, port=int(args["--port"]), cache_size=int(args["--cache-size"]))
+        return
+
+    assert args["ka-lite"], ("Sorry, content packs for non-KA Lite "
+                             "software aren't implemented yet.")
+    del args["ka-lite"]
+
+    log_file = args["--logging"] or "debug.log"
+
     try:
-        make_language_pack(lang, version, sublangs, out, ka_domain, no_assessment_items, no_subtitles, no_assessment_resources, no_dubbed_videos)
+        build_from_args(args)
     except Exception:           # This is allowed, since we want to potentially debug all errors
         import os
         if not os.environ.get("DEBUG"):
@@ -0,0 +1,356 @@
+"""
+Finishing touches for the content.db inside a language pack.
+
+KA Lite often runs on Raspberry Pis with SD cards, where every page read
+counts. Once bundle_language_pack has written all the rows, finalize_content_db
+adds the indexes the client's lookups need, sets up the page layout and
+statistics, and measures how long a set of typical client queries take.
+"""
+import collections
+import mmap
+import os
+import random
+import re
+import sqlite3
+import statistics
+import time
+import zipfile
+import zlib
+
+import ujson
+
+CONTENT_DB_PAGE_SIZE = 4096
+
+# item_path isn't unique: two videos with the same slug under one topic, or a
+# video listed twice in it, end up with the same path
+CONTENT_DB_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS item_path ON item (path)",
+    "CREATE INDEX IF NOT EXISTS item_kind_parent_id ON item (kind, parent_id)",
+    "CREATE INDEX IF NOT EXISTS item_youtube_id ON item (youtube_id)",
+]
+
+# Typical client queries, and how to pick the parameters to run them with.
+BENCHMARK_QUERIES = {
+    "item_by_path": (
+        "SELECT * FROM item WHERE path = ?",
+        "SELECT path FROM item WHERE kind != 'Topic' ORDER BY pk LIMIT 1",
+    ),
+    "topic_children": (
+        "SELECT * FROM item WHERE parent_id = ? ORDER BY sort_order",
+        "SELECT parent_id FROM item GROUP BY parent_id ORDER BY COUNT(*) DESC LIMIT 1",
+    ),
+    "child_topics": (
+        "SELECT * FROM item WHERE kind = 'Topic' AND parent_id = ?",
+        "SELECT pk FROM item WHERE parent_id IS NULL LIMIT 1",
+    ),
+    "video_by_youtube_id": (
+        "SELECT * FROM item WHERE youtube_id = ?",
+        "SELECT youtube_id FROM item WHERE kind = 'Video' ORDER BY pk LIMIT 1",
+    ),
+    "exercise_by_id": (
+        "SELECT * FROM item WHERE id = ? AND kind = 'Exercise'",
+        "SELECT id FROM item WHERE kind = 'Exercise' ORDER BY pk LIMIT 1",
+    ),
+    "assessment_item_by_id": (
+        "SELECT * FROM assessmentitem WHERE id = ?",
+        "SELECT id FROM assessmentitem ORDER BY pk LIMIT 1",
+    ),
+    "topic_listing": (
+        "SELECT listing FROM topiclisting WHERE path = ?",
+        "SELECT path FROM topiclisting ORDER BY length(listing) DESC LIMIT 1",
+    ),
+    "exercise_assessment_items": (
+        "SELECT assessmentitem.* FROM exerciseassessmentitem JOIN assessmentitem "
+        "ON assessmentitem.id = exerciseassessmentitem.assessment_item_id "
+        "WHERE exerciseassessmentitem.exercise_id = ? ORDER BY exerciseassessmentitem.sort_order",
+        "SELECT exercise_id FROM exerciseassessmentitem LIMIT 1",
+    ),
+}
+
+BENCHMARK_REPETITIONS = 20
+
+SEARCH_INDEX_TABLE = "item_fts"
+
+# FTS4 tokenizers by primary language. English gets stemming, so "graphs"
+# finds "graphing"; everything else is split on unicode word boundaries,
+# ignoring accents so that searching without them still works.
+SEARCH_TOKENIZERS = {
+    "en": "porter",
+}
+
+DEFAULT_SEARCH_TOKENIZER = 'unicode61 "remove_diacritics=1"'
+
+ITEM_DATA_DICTIONARY_TABLE = "assessmentitem_dictionary"
+
+# zlib only looks back 32 KiB, so a bigger dictionary wouldn't help
+ITEM_DATA_DICTIONARY_SIZE = 32 * 1024
+
+ITEM_DATA_TRAINING_SAMPLE_SIZE = 2000
+
+ITEM_DATA_COMPRESSION_LEVEL = 9
+
+# how many assessment items compress_assessment_items reads and rewrites at a time
+ITEM_DATA_COMPRESSION_BATCH_SIZE = 500
+
+# JSON keys, with the start of their value: the widget boilerplate, hint
+# structures and field names repeated across Perseus items
+ITEM_DATA_FRAGMENT_REGEX = re.compile(r'"(?:[^"\\]|\\.){1,64}":\s*(?:\{"(?:[^"\\]|\\.){1,64}":|\[|"(?:[^"\\]|\\.){0,32}"|true|false|null|-?\d{1,8})?')
+
+
+def finalize_content_db(path: str) -> dict:
+    """
+    Index, analyze and vacuum the content database at path, then time the
+    benchmark queries against it. Returns a report of the database's size
+    and the median latency of each query, in milliseconds.
+    """
+    # autocommit, since VACUUM can't run inside a transaction
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        for statement in CONTENT_DB_INDEXES:
+            conn.execute(statement)
+        conn.execute("ANALYZE")
+        # the page size only changes when the database is rebuilt by VACUUM
+        conn.execute("PRAGMA page_size = {}".format(CONTENT_DB_PAGE_SIZE))
+        conn.execute("VACUUM")
+        page_size, = conn.execute("PRAGMA page_size").fetchone()
+    finally:
+        conn.close()
+
+    return {
+        "size": os.path.getsize(path),
+        "page_size": page_size,
+        "query_latency_ms": measure_query_latencies(path),
+    }
+
+
+def measure_query_latencies(path: str, repetitions: int=BENCHMARK_REPETITIONS) -> dict:
+    """
+    Run each of the BENCHMARK_QUERIES repetitions times, and return their
+    median latencies in milliseconds. Queries on tables that are missing or
+    empty are left out.
+    """
+    latencies = {}
+    conn = sqlite3.connect(path)
+    try:
+        for name, (query, parameter_query) in sorted(BENCHMARK_QUERIES.items()):
+            try:
+                parameters = conn.execute(parameter_query).fetchone()
+            except sqlite3.OperationalError:
+                continue
+            if parameters is None:
+                continue
+
+            timings = []
+            for _ in range(repetitions):
+                start = time.perf_counter()
+                conn.execute(query, parameters).fetchall()
+                timings.append(time.perf_counter() - start)
+            latencies[name] = round(statistics.median(timings) * 1000, 3)
+    finally:
+        conn.close()
+
+    return latencies
+
+
+def get_search_tokenizer(lang: str) -> str:
+    return SEARCH_TOKENIZERS.get(lang.split("-")[0].lower(), DEFAULT_SEARCH_TOKENIZER)
+
+
+def _get_keywords(extra_fields: str) -> str:
+    try:
+        keywords = ujson.loads(extra_fields or "{}").get("keywords")
+    except ValueError:
+        return ""
+    return keywords if isinstance(keywords, str) else " ".join(keywords or [])
+
+
+def build_search_index(path: str, lang: str) -> dict:
+    """
+    Build a full text index of the items' (already translated) titles,
+    descriptions and keywords. It's contentless, so the text isn't stored
+    twice; clients search it and join on docid = item.pk:
+
+        SELECT item.* FROM item JOIN item_fts ON item.pk = item_fts.docid WHERE item_fts MATCH ?
+
+    Returns the tokenizer used, the build time in seconds, and how many
+    bytes the index added to the database.
+    """
+    tokenizer = get_search_tokenizer(lang)
+    start = time.perf_counter()
+
+    conn = sqlite3.connect(path)
+    try:
+        conn.create_function("contentpacks_keywords", 1, _get_keywords)
+        size_before = _get_database_size(conn)
+
+        conn.execute("DROP TABLE IF EXISTS {}".format(SEARCH_INDEX_TABLE))
+        conn.execute('CREATE VIRTUAL TABLE {table} USING fts4(title, description, keywords, content="", tokenize={tokenizer})'.format(
+            table=SEARCH_INDEX_TABLE, tokenizer=tokenizer))
+        conn.execute("INSERT INTO {} (docid, title, description, keywords) "
+                     "SELECT pk, title, description, contentpacks_keywords(extra_fields) FROM item".format(SEARCH_INDEX_TABLE))
+        # merge the index into a single b-tree, which is the fastest to query
+        conn.execute("INSERT INTO {table} ({table}) VALUES ('optimize')".format(table=SEARCH_INDEX_TABLE))
+        conn.commit()
+
+        size = _get_database_size(conn) - size_before
+    finally:
+        conn.close()
+
+    return {
+        "tokenizer": tokenizer,
+        "build_time": round(time.perf_counter() - start, 3),
+        "size": size,
+    }
+
+
+def _get_database_size(conn) -> int:
+    page_count, = conn.execute("PRAGMA page_count").fetchone()
+    freelist_count, = conn.execute("PRAGMA freelist_count").fetchone()
+    page_size, = conn.execute("PRAGMA page_size").fetchone()
+    return (page_count - freelist_count) * page_size
+
+
+def train_item_data_dictionary(item_data: list, size: int=ITEM_DATA_DICTIONARY_SIZE) -> bytes:
+    """
+    Build a zlib preset dictionary out of the JSON fragments that show up in
+    the most items, weighted by how many bytes they'd save.
+    """
+    document_counts = collections.Counter()
+    for data in item_data:
+        document_counts.update(set(ITEM_DATA_FRAGMENT_REGEX.findall(data)))
+
+    candidates = sorted(((count - 1) * len(fragment.encode("utf-8")), fragment)
+                        for fragment, count in document_counts.items() if count > 1)
+
+    fragments, total = [], 0
+    for _, fragment in reversed(candidates):
+        fragment = fragment.encode("utf-8")
+        if total + len(fragment) > size:
+            continue
+        fragments.append(fragment)
+        total += len(fragment)
+
+    # the end of the dictionary is the cheapest to refer back to, so that's where the most useful fragments go
+    return b"".join(reversed(fragments))
+
+
+def encode_item_data(data: str, dictionary: bytes) -> bytes:
+    compressor = zlib.compressobj(ITEM_DATA_COMPRESSION_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS, zdict=dictionary)
+    return compressor.compress(data.encode("utf-8")) + compressor.flush()
+
+
+def decode_item_data(data, dictionary: bytes) -> str:
+    """
+    The reference decoder for item_data: a compressed item is a BLOB in zlib
+    format, compressed against the pack's preset dictionary. Text is
+    returned as is, so this works for uncompressed packs too.
+    """
+    if isinstance(data, str):
+        return data
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict=dictionary)
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+def get_item_data_dictionary(conn) -> bytes:
+    try:
+        row = conn.execute("SELECT dictionary FROM {} WHERE id = 1".format(ITEM_DATA_DICTIONARY_TABLE)).fetchone()
+    except sqlite3.OperationalError:
+        return b""
+    return row[0] if row else b""
+
+
+def compress_assessment_items(path: str, batch_size: int=ITEM_DATA_COMPRESSION_BATCH_SIZE) -> dict:
+    """
+    Compress every item_data in the database at path against a dictionary
+    trained on a sample of them, and store that dictionary in the
+    assessmentitem_dictionary table. Items are read and rewritten
+    batch_size at a time, so only one batch is ever held in memory. Returns
+    the sizes before and after, along with decoding benchmarks.
+    """
+    conn = sqlite3.connect(path)
+    try:
+        sample = [data for data, in conn.execute("SELECT item_data FROM assessmentitem ORDER BY RANDOM() LIMIT ?",
+                                                 (ITEM_DATA_TRAINING_SAMPLE_SIZE,))]
+        if not sample:
+            return {}
+        dictionary = train_item_data_dictionary(sample)
+
+        conn.execute("CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, dictionary BLOB NOT NULL)".format(
+            ITEM_DATA_DICTIONARY_TABLE))
+        conn.execute("INSERT OR REPLACE INTO {} (id, dictionary) VALUES (1, ?)".format(ITEM_DATA_DICTIONARY_TABLE),
+                     (dictionary,))
+
+        item_count = raw_size = compressed_size = 0
+        # a uniform sample of the compressed items to benchmark decoding on, kept as they go by
+        benchmark_blobs = []
+        rng = random.Random(0)
+        last_pk = -1
+        while True:
+            # paging by pk rather than iterating one cursor, since the rows it would read are being updated
+            rows = conn.execute("SELECT pk, item_data FROM assessmentitem WHERE pk > ? ORDER BY pk LIMIT ?",
+                                (last_pk, batch_size)).fetchall()
+            if not rows:
+                break
+            compressed = []
+            for pk, data in rows:
+                blob = encode_item_data(data, dictionary)
+                compressed.append((blob, pk))
+                item_count += 1
+                raw_size += len(data.encode("utf-8"))
+                compressed_size += len(blob)
+                if len(benchmark_blobs) < ITEM_DATA_TRAINING_SAMPLE_SIZE:
+                    benchmark_blobs.append(blob)
+                else:
+                    i = rng.randrange(item_count)
+                    if i < ITEM_DATA_TRAINING_SAMPLE_SIZE:
+                        benchmark_blobs[i] = blob
+            conn.executemany("UPDATE assessmentitem SET item_data = ? WHERE pk = ?", compressed)
+            last_pk = rows[-1][0]
+        conn.commit()
+    finally:
+        conn.close()
+
+    return dict(
+        benchmark_item_data_decoding(benchmark_blobs, dictionary),
+        item_count=item_count,
+        raw_size=raw_size,
+        # for comparison: how well each item compresses on its own
+        zlib_size=sum(len(zlib.compress(data.encode("utf-8"), ITEM_DATA_COMPRESSION_LEVEL)) for data in sample) * item_count // len(sample),
+        compressed_size=compressed_size,
+        dictionary_size=len(dictionary),
+    )
+
+
+def benchmark_item_data_decoding(blobs: list, dictionary: bytes, sample_size: int=ITEM_DATA_TRAINING_SAMPLE_SIZE) -> dict:
+    """
+    Time decode_item_data over a sample of the compressed items.
+    """
+    sample = random.Random(0).sample(blobs, min(len(blobs), sample_size))
+
+    timings = []
+    for blob in sample:
+        start = time.perf_counter()
+        decode_item_data(blob, dictionary)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "decode_median_ms": round(statistics.median(timings) * 1000, 4),
+        "decode_max_ms": round(max(timings) * 1000, 4),
+    }
+
+
+def map_content_db(pack_path: str) -> mmap.mmap:
+    """
+    The reference reader for packs built with a mappable content.db: map
+    the database straight out of the pack, using the offset and size in
+    its metadata.json, without extracting it.
+    """
+    with zipfile.ZipFile(pack_path) as zf:
+        metadata = ujson.loads(zf.read("metadata.json"))
+        info = zf.getinfo("content.db")
+    if "content_db_offset" not in metadata or info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("{} doesn't have a mappable content.db".format(pack_path))
+
+    with open(pack_path, "rb") as f:
+        return mmap.mmap(f.fileno(), metadata["content_db_size"], offset=metadata["content_db_offset"],
+                         access=mmap.ACCESS_READ)
@@ -0,0 +1,139 @@
+"""
+A long-running build server.
+
+Every makecontentpacks run starts cold: it imports everything, then parses
+the topic trees, dubbed video mappings and catalogs again. The daemon keeps
+one process around instead, with WARM_CACHE turned on, and runs the builds
+it's sent over a local HTTP API one after the other:
+
+    POST /builds        start a build; the body is a JSON object like
+                        {"lang": "es", "version": "0.16", "out": "out/es.zip", ...}
+    GET  /builds        list all builds
+    GET  /builds/<id>   one build's state: queued, running, done or failed
+    GET  /status        the warm cache's statistics and the queue length
+
+Builds run one at a time, since they share the build/ cache directory.
+"""
+import http.server
+import itertools
+import logging
+import queue
+import socketserver
+import threading
+import time
+import traceback
+
+import ujson
+
+from contentpacks.warmcache import WARM_CACHE
+
+DAEMON_PORT = 8765
+
+# in megabytes of the files the cached values were parsed from, as they are on disk
+DEFAULT_CACHE_SIZE = 512
+
+
+class BuildQueue:
+    """
+    Run build(request) for each submitted request, in order, on a worker
+    thread, keeping track of each build's state.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.builds = {}
+        self.pending = queue.Queue()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def submit(self, request: dict) -> dict:
+        with self.lock:
+            build = {"id": next(self.ids), "request": request, "state": "queued", "error": None,
+                     "queued_at": time.time(), "started_at": None, "finished_at": None}
+            self.builds[build["id"]] = build
+        self.pending.put(build)
+        return build
+
+    def _work(self):
+        while True:
+            build = self.pending.get()
+            build.update(state="running", started_at=time.time())
+            logging.info("Starting build {id}: {request}".format(**build))
+            try:
+                self.build(build["request"])
+                build["state"] = "done"
+            except Exception:       # keep serving, and report the error with the build
+                build.update(state="failed", error=traceback.format_exc())
+                logging.exception("Build {} failed.".format(build["id"]))
+            build["finished_at"] = time.time()
+            logging.info("Finished build {id} ({state}); warm cache: {cache}".format(cache=WARM_CACHE.stats(), **build))
+
+    def queued_count(self) -> int:
+        return self.pending.qsize()
+
+
+class _DaemonHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        builds = self.server.builds
+        if self.path == "/status":
+            self._respond(200, {"cache": WARM_CACHE.stats(), "queued": builds.queued_count()})
+        elif self.path == "/builds":
+            self._respond(200, sorted(builds.builds.values(), key=lambda build: build["id"]))
+        elif self.path.startswith("/builds/"):
+            try:
+                self._respond(200, builds.builds[int(self.path[len("/builds/"):])])
+            except (ValueError, KeyError):
+                self._respond(404, {"error": "No such build"})
+        else:
+            self._respond(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/builds":
+            return self._respond(404, {"error": "Not found"})
+        try:
+            request = ujson.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        except ValueError:
+            return self._respond(400, {"error": "The body isn't valid JSON"})
+        if not isinstance(request, dict) or not request.get("lang") or not request.get("version"):
+            return self._respond(400, {"error": "A build needs a lang and a version"})
+        self._respond(202, self.server.builds.submit(request))
+
+    def _respond(self, status: int, body):
+        data = ujson.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def make_server(build, port: int=DAEMON_PORT, cache_size: int=DEFAULT_CACHE_SIZE) -> http.server.HTTPServer:
+    """
+    Turn on the warm cache, bounded by cache_size megabytes of source files
+    (see warmcache), and create a server on localhost:port that runs
+    build(request) for each build request it's sent.
+    """
+    WARM_CACHE.resize(cache_size * 1024 * 1024)
+
+    server = _ThreadingHTTPServer(("127.0.0.1", port), _DaemonHandler)
+    server.builds = BuildQueue(build)
+    return server
+
+
+def serve(build, port: int=DAEMON_PORT, cache_size: int=DEFAULT_CACHE_SIZE):
+    server = make_server(build, port, cache_size)
+    logging.info("Listening for builds on http://127.0.0.1:{}/".format(server.server_port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -1,6 +1,5 @@
+import asyncio
 import collections
-import copy
-import filecmp
 import fnmatch
 import glob
 import logging
@@ -11,7 +10,7 @@ import urllib
 import tempfile
 import zipfile
 from collections import OrderedDict
-from functools import reduce
+from functools import lru_cache
 from multiprocessing.pool import ThreadPool
 import itertools
 import time
@@ -21,16 +20,31 @@ import json
 import ujson
 import pkgutil
 import sys
+from urllib.parse import urlparse
 
 from math import ceil, log, exp
 
 from contentpacks.utils import NodeType, download_and_cache_file, Catalog, cache_file,\
-    is_video_node_dubbed, get_lang_name, NodeType
+    get_lang_name, get_primary_language, NodeType, download_file, get_cache_filename, hash_file, \
+    PersistentDict, iter_json_object_arrays
 from contentpacks.models import AssessmentItem
+from contentpacks.nodes import compact_nodes
+from contentpacks.warmcache import load_cached
 from contentpacks.generate_dubbed_video_mappings import main, DUBBED_VIDEOS_MAPPING_FILEPATH
 
 NUM_PROCESSES = 5
 
+HTML_EXERCISE_MANIFEST_FILENAME = "html_exercise_manifest.json"
+
+REMOTE_SIZE_CACHE_FILENAME = "remote_sizes.json"
+
+# video sizes rarely change; only check them again once they're this old (in seconds)
+REMOTE_SIZE_MAX_AGE = 30 * 24 * 60 * 60
+
+NUM_CONCURRENT_PROBES = 50
+
+TOPICTREE_CHUNK_SIZE = 64 * 1024
+
 LangpackResources = collections.namedtuple(
     "LangpackResources",
     ["node_data",
@@ -170,6 +184,11 @@ def retrieve_translations(crowdin_project_name, crowdin_secret_key, lang_code="e
 
     logging.debug("Retrieving translations from {}".format(request_url))
     zip_path = download_and_cache_file(request_url, ignorecache=force)
+
+    return load_cached(zip_path, lambda path: _read_translations(path, includes), key=("translations", includes))
+
+
+def _read_translations(zip_path: str, includes: str) -> Catalog:
     zip_extraction_path = tempfile.mkdtemp()
 
     with zipfile.ZipFile(zip_path) as zf:
@@ -215,20 +234,12 @@ first_cap_re = re.compile('(.)([A-Z][a-z]+)')
 all_cap_re = re.compile('([a-z0-9])([A-Z])')
 
 
+@lru_cache(maxsize=None)
 def convert_camel_case(name) -> str:
     s1 = first_cap_re.sub(r'\1_\2', name)
     return all_cap_re.sub(r'\1_\2', s1).lower()
 
 
-def convert_all_nodes_to_camel_case(nodes) -> list:
-    for i, node in enumerate(nodes):
-        new_node = {}
-        for k, v in node.items():
-            new_node[convert_camel_case(k)] = v
-        nodes[i] = new_node
-    return nodes
-
-
 # Khan Academy specific blacklists
 
 slug_blacklist = ["new-and-noteworthy", "talks-and-interviews", "coach-res"]  # not relevant
@@ -337,66 +348,67 @@ def prune_assessment_items(nodes) -> list:
     return node_list
 
 
-def group_by_slug(count_dict, item):
-    # Build a dictionary, keyed by slug, of items that share that slug
-    if item.get("slug") in count_dict:
-        count_dict[item.get("slug")].append(item)
-    else:
-        count_dict[item.get("slug")] = [item]
-    return count_dict
-
-
 def create_paths_remove_orphans_and_empty_topics(nodes) -> list:
+    """
+    Walk the topic tree from the root, giving every node its path and sort_order, and dropping orphans and
+    childless topics. Content that's listed under several topics (and the subtrees of cross-listed topics) is
+    kept once: its first placement's path, slug and sort_order are set on the node itself, and the others are
+    recorded in its "extra_placements", to be expanded into separate items only when saving them.
+    """
     node_dict = {node.get("id"): node for node in nodes}
     # Set the slug on the root node to "khan"
     node_dict["x00000000"]["slug"] = "khan"
 
+    # Keep the original slugs, since a node's own slug is overwritten by its first placement's
+    base_slugs = {node_id: node.get("slug") for node_id, node in node_dict.items()}
+
     node_list = []
+    placed = set()
 
-    def recurse_nodes(node, parent_path="", node_count=0.0):
+    def recurse_nodes(node, slug, parent_path="", node_count=0.0):
 
         """
         :param node: dict
+        :param slug: str
         :param parent_path: str
         :param node_count: float
         """
-        node["path"] = parent_path + node.get("slug") + "/"
+        placement = {"path": parent_path + slug + "/", "slug": slug, "sort_order": node_count}
 
-        node["sort_order"] = node_count
+        first_placement = node.get("id") not in placed
+        if first_placement:
+            placed.add(node.get("id"))
+            node.update(placement)
+        else:
+            node.setdefault("extra_placements", []).append(placement)
 
         logging.debug("Node count: {}".format(node_count))
 
-        children = node.pop("child_data", [])
-
-        if children:
-            # Use a deepcopy here, in order to create an entirely separate node, not referencing any child objects
-            # This avoids any nested data in the node data being shared across nodes.
-            # Our chosen strategy of duplicating content nodes that appear twice in the topic tree requires this.
-            children = [copy.deepcopy(node_dict.get(child.get("id"))) for child in children if node_dict.get(child.get("id"))]
-
-            counts = reduce(group_by_slug, children, {})
-            for items in counts.values():
-                # Slug has more than one item!
-                if len(items) > 1:
-                    i = 1
-                    # Rename the items
-                    for item in items:
-                        if item.get("kind") != "Video":
-                            # Don't change video slugs, as that will break internal links from KA.
-                            item["slug"] = item["slug"] + "_{i}".format(i=i)
-                            item["path"] = node.get("path") + item["slug"] + "/"
-                            i += 1
-
-        for child in children:
+        children = [node_dict[child.get("id")] for child in node.get("child_data", []) if node_dict.get(child.get("id"))]
+        child_slugs = [base_slugs[child.get("id")] for child in children]
+
+        counts = collections.Counter(child_slugs)
+        renamed = collections.Counter()
+        for i, child in enumerate(children):
+            # Slug has more than one item!
+            if counts[child_slugs[i]] > 1 and child.get("kind") != "Video":
+                # Rename the items. Don't change video slugs, as that will break internal links from KA.
+                renamed[child_slugs[i]] += 1
+                child_slugs[i] += "_{i}".format(i=renamed[child_slugs[i]])
+
+        for child, child_slug in zip(children, child_slugs):
             node_count += 1
-            node_count = recurse_nodes(child, node.get("path"), node_count)
+            node_count = recurse_nodes(child, child_slug, placement["path"], node_count)
 
-        if children or node.get("kind") != "Topic":
+        if first_placement and (children or node.get("kind") != "Topic"):
             node_list.append(node)
 
         return node_count
 
-    recurse_nodes(node_dict["x00000000"])
+    recurse_nodes(node_dict["x00000000"], "khan")
+
+    for node in node_list:
+        node.pop("child_data", None)
 
     return node_list
 
@@ -434,7 +446,7 @@ def retrieve_exercise_dict(lang=None, force=False) -> str:
 def download_and_clean_kalite_data(url, path, lang="en") -> str:
     attempts = 1
     while attempts < 100:
-        data = requests.get(url)
+        data = requests.get(url, stream=True)
         try:
             data.raise_for_status()
             break
@@ -449,36 +461,35 @@ def download_and_clean_kalite_data(url, path, lang="en") -> str:
 
     data.raise_for_status()     # make sure that when we get here, there are no more errors from KA.
 
-    node_data = ujson.loads(data.content)
-
-    # Convert all keys of nodes to snake case from camel case.
-    for key in node_data:
-        node_data[key] = convert_all_nodes_to_camel_case(node_data[key])
-
-    # Remove any topic nodes that are hidden, deleted, or set to 'do_not_publish'
-    # Also remove those flags from the nodes themselves.
+    # The topic tree is by far the largest download, so parse it as it arrives
+    # rather than holding the whole response and its parsed copy in memory.
+    node_data = OrderedDict()
 
-    topic_nodes = []
+    for key, node in iter_json_object_arrays(data.iter_content(TOPICTREE_CHUNK_SIZE)):
+        # Convert all keys of nodes to snake case from camel case.
+        node = {convert_camel_case(k): v for k, v in node.items()}
 
-    for node in node_data["topics"]:
-        hidden = node.pop("hide")
-        dnp = node.pop("do_not_publish")
-        deleted = node.pop("deleted")
-        # We want to remove all of these, except the root node,
-        # the only node we do hide, but we use for defining the overall KA channel
-        if not (hidden or dnp or deleted) or node.get("id") == "x00000000":
-            topic_nodes.append(node)
+        # Remove any topic nodes that are hidden, deleted, or set to 'do_not_publish'
+        # Also remove those flags from the nodes themselves.
+        if key == "topics":
+            hidden = node.pop("hide")
+            dnp = node.pop("do_not_publish")
+            deleted = node.pop("deleted")
+            # We want to remove all of these, except the root node,
+            # the only node we do hide, but we use for defining the overall KA channel
+            if (hidden or dnp or deleted) and node.get("id") != "x00000000":
+                continue
 
-    node_data["topics"] = topic_nodes
+        node_data.setdefault(key, []).append(node)
 
     # Hack to hardcode the mp4 format flag on Videos.
-    for node in node_data["videos"]:
+    for node in node_data.get("videos", []):
         node["format"] = "mp4"
 
     # Hack to add basepoints to all Exercise data.
     ex_dict = retrieve_exercise_dict()
 
-    for node in node_data["exercises"]:
+    for node in node_data.get("exercises", []):
         seconds_per_fast_problem = ex_dict.get(node.get("id"), {}).get("seconds_per_fast_problem", 0)
         node["basepoints"] = ceil(7 * log(max(exp(5. / 7), seconds_per_fast_problem)))
 
@@ -585,8 +596,8 @@ def retrieve_kalite_data(lang=en_lang_code, force=False, ka_domain=None, no_dubb
 
     node_data_path = download_and_clean_kalite_data(url, lang=lang, ignorecache=force, filename="nodes.json")
 
-    with open(node_data_path, 'r') as f:
-        node_data = ujson.load(f)
+    # a copy of the list, since the dubbed videos get added to it; compact_nodes copies the nodes themselves
+    node_data = list(load_cached(node_data_path, _load_json))
 
     if not lang == en_lang_code and not no_dubbed_videos:
         # Generate en_nodes.json json this will be used in dubbed video mappings.
@@ -596,7 +607,12 @@ def retrieve_kalite_data(lang=en_lang_code, force=False, ka_domain=None, no_dubb
 
         node_data = addin_dubbed_video_mappings(node_data, lang)
 
-    return node_data
+    return compact_nodes(node_data)
+
+
+def _load_json(path: str):
+    with open(path, 'r') as f:
+        return ujson.load(f)
 
 
 def addin_dubbed_video_mappings(node_data, lang=en_lang_code):
@@ -614,8 +630,7 @@ def addin_dubbed_video_mappings(node_data, lang=en_lang_code):
     # Get the list of video ids from dubbed video mappings
     lang_code = get_lang_name(lang).lower()
     dubbed_videos_path = os.path.join(build_path, "dubbed_video_mappings.json")
-    with open(dubbed_videos_path, 'r') as f:
-        dubbed_videos_load = ujson.load(f)
+    dubbed_videos_load = load_cached(dubbed_videos_path, _load_json)
 
     dubbed_videos_list = dubbed_videos_load.get(lang_code)
     # If dubbed_videos_list is None It means that the language code is not available in dubbed video mappings.
@@ -631,10 +646,11 @@ def addin_dubbed_video_mappings(node_data, lang=en_lang_code):
             youtube_ids.append(node.get("youtube_id"))
         if node_kind == NodeType.topic:
             topic_paths.append(node.get("path"))
+            topic_paths.extend(placement["path"] for placement in node.get("extra_placements", []))
 
     en_nodes_path = os.path.join(build_path, "en_nodes.json")
-    with open(en_nodes_path, 'r') as f:
-        en_node_load = ujson.load(f)
+    # copies, since the dubbed videos are modified below
+    en_node_load = [dict(node) for node in load_cached(en_nodes_path, _load_json)]
 
     en_node_list = []
     # The en_nodes.json must be the same data structure to node_data variable from khan api.
@@ -851,12 +867,14 @@ def retrieve_assessment_item_data(assessment_item, lang=None, force=False, no_it
     return item_data, file_paths
 
 
-def retrieve_all_assessment_item_data(lang=None, force=False, node_data=None, no_item_data=False, no_item_resources=False) -> ([dict], set):
+def retrieve_all_assessment_item_data(lang=None, force=False, node_data=None, no_item_data=False, no_item_resources=False,
+                                      collect=list) -> ([dict], set):
     """
     Retrieve Khan Academy assessment items and associated images from KA.
     :param lang: language to retrieve data in
     :param force: refetch all assessment items
     :param node_data: list of dicts containing node data to collect assessment items for
+    :param collect: called with an iterator over the item data as it's downloaded, returns what to keep it in
     :return: a tuple of a list of assessment item data dicts, and a list of filepaths for the zip file
     """
     if not node_data:
@@ -888,27 +906,137 @@ def retrieve_all_assessment_item_data(lang=None, force=False, node_data=None, no
     assessment_items = assessment_items.values()
 
     logging.info("Retrieving assessment item data for all assessment items.")
-    data_and_files = pool.map(_download_item_data_and_files, assessment_items)
-    try:
-        assessment_item_data, all_file_paths = zip(*data_and_files)
-    except ValueError:
+    data_and_files = pool.imap(_download_item_data_and_files, assessment_items)
+
+    all_file_paths = set()
+
+    def _collect_item_data():
+        for item_data, file_paths in data_and_files:
+            all_file_paths.update(file_paths)
+            # remove empty assessment_item_data
+            if item_data:
+                yield item_data
+
+    assessment_item_data = collect(_collect_item_data())
+
+    if not assessment_items:
         logging.warning("No assessment iitems fetched at all.")
-        return [], set()
 
-    # remove empty assessment_item_data
-    assessment_item_data = (data for data in assessment_item_data if data)
+    return assessment_item_data, all_file_paths
+
+
+def _get_content_download_url(content) -> str:
+    return content["download_urls"][content["format"]].replace("http://fastly.kastatic.org/", "http://s3.amazonaws.com/") # because fastly is SLOWLY
+
+
+def _is_remote_size_stale(entry, now, max_age) -> bool:
+    return not entry or not entry.get("size") or now - entry["checked"] > max_age
+
+
+async def _head(url: str, headers: dict, timeout: float, redirects=5) -> (int, dict):
+    """
+    Make an HTTP HEAD request with nothing but asyncio streams. Returns the
+    status code and the response headers, with lowercased names.
+    """
+    parsed = urlparse(url)
+    is_https = parsed.scheme == "https"
+    port = parsed.port or (443 if is_https else 80)
+
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(parsed.hostname, port, ssl=is_https or None),
+        timeout,
+    )
+    try:
+        target = parsed.path or "/"
+        if parsed.query:
+            target += "?" + parsed.query
+        request_lines = ["HEAD {} HTTP/1.1".format(target), "Host: {}".format(parsed.netloc), "Connection: close"]
+        request_lines += ["{}: {}".format(name, value) for name, value in headers.items()]
+        writer.write(("\r\n".join(request_lines) + "\r\n\r\n").encode("latin-1"))
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        status = int(status_line.split()[1])
+
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+    finally:
+        writer.close()
+
+    if status in (301, 302, 303, 307, 308) and "location" in response_headers and redirects:
+        location = urllib.parse.urljoin(url, response_headers["location"])
+        return await _head(location, headers, timeout, redirects - 1)
 
-    # all_file_paths is a list of lists, so we need to flatten it first before deduping through set()
-    all_file_paths = itertools.chain.from_iterable(all_file_paths)
+    return status, response_headers
 
-    return assessment_item_data, set(all_file_paths)
 
+async def _probe_remote_size(content, entry, semaphore, timeout, retries) -> dict:
+    """
+    Return an up to date remote size cache entry for content. If we already
+    have an entry, the server only needs to confirm that the file's validator
+    hasn't changed.
+    """
+    url = _get_content_download_url(content)
+    headers = {}
+    if entry and entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    elif entry and entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+
+    for i in range(retries):
+        try:
+            async with semaphore:
+                status, response_headers = await _head(url, headers, timeout)
+            break
+        except asyncio.TimeoutError:
+            logging.warning("Timed out on try {i} while checking remote file size for '{title}'!".format(title=content.get("title"), i=i))
+        except (OSError, ValueError, IndexError) as e:
+            logging.warning("Error on try {i} while checking remote file size for '{title}': {e}".format(title=content.get("title"), i=i, e=e))
+    else:
+        logging.error("No file size retrieved (timeouts?) for content '{title}'!".format(title=content.get("title")))
+        return entry
+
+    if status == 304 and entry:
+        return dict(entry, checked=time.time())
+    elif status != 200:
+        logging.error("Got status {status} while checking remote file size for '{title}'!".format(status=status, title=content.get("title")))
+        return entry
 
-def query_remote_content_file_sizes(content_items, threads=NUM_PROCESSES):
+    try:
+        size = int(response_headers["content-length"])
+    except (KeyError, ValueError):
+        logging.warning("No numeric content-length returned while checking remote file size for '{title}' ({readable_id})!".format(**content))
+        return entry
+
+    return {
+        "size": size,
+        "etag": response_headers.get("etag"),
+        "last_modified": response_headers.get("last-modified"),
+        "checked": time.time(),
+    }
+
+
+async def _probe_remote_sizes(items_by_url, cache, concurrency, timeout, retries) -> list:
+    semaphore = asyncio.Semaphore(concurrency)
+    probes = [_probe_remote_size(content, cache.get(url), semaphore, timeout, retries)
+              for url, content in items_by_url.items()]
+    return await asyncio.gather(*probes)
+
+
+def query_remote_content_file_sizes(content_items, concurrency=NUM_CONCURRENT_PROBES, max_age=REMOTE_SIZE_MAX_AGE,
+                                    cache_path=None, timeout=60, retries=5):
     """
     Query and store the file sizes for downloadable videos, by running HEAD requests against them,
     and reading the `content-length` header. Right now, this is only for the "khan" channel, and hence lives here.
     TODO(jamalex): Generalize this to other channels once they're centrally hosted and downloadable.
+
+    Sizes are cached in the build directory along with each file's ETag or
+    Last-Modified validator, and only entries older than max_age seconds
+    are checked again, with a conditional request.
     """
 
     sizes_by_id = {}
@@ -918,59 +1046,72 @@ def query_remote_content_file_sizes(content_items, threads=NUM_PROCESSES):
 
     content_items = [content for content in content_items if content.get("format") in content.get("download_urls", {}) and content.get("youtube_id")]
 
-    pool = ThreadPool(threads)
-    sizes = pool.map(get_content_length, content_items)
-
-    for content, size in zip(content_items, sizes):
+    cache = PersistentDict(cache_path or os.path.join(os.getcwd(), "build", REMOTE_SIZE_CACHE_FILENAME))
+    now = time.time()
+    stale_items = {}
+    for content in content_items:
+        url = _get_content_download_url(content)
+        if _is_remote_size_stale(cache.get(url), now, max_age):
+            stale_items[url] = content
+
+    if stale_items:
+        logging.info("Checking remote file sizes of {} out of {} videos.".format(len(stale_items), len(content_items)))
+        loop = asyncio.new_event_loop()
+        try:
+            entries = loop.run_until_complete(
+                _probe_remote_sizes(stale_items, cache, concurrency, timeout, retries))
+        finally:
+            loop.close()
+
+        for url, entry in zip(stale_items, entries):
+            if entry:
+                cache[url] = entry
+        cache.save()
+
+    for content in content_items:
+        entry = cache.get(_get_content_download_url(content))
         # TODO(jamalex): This should be generalized from "youtube_id" to support other content types
-        if size:
-            sizes_by_id[content["youtube_id"]] = size
+        if entry and entry.get("size"):
+            sizes_by_id[content["youtube_id"]] = entry["size"]
 
     return sizes_by_id
 
 
-def get_content_length(content):
-    url = content["download_urls"][content["format"]].replace("http://fastly.kastatic.org/", "http://s3.amazonaws.com/") # because fastly is SLOWLY
-    logging.info("Checking remote file size for content '{title}' at {url}...".format(title=content.get("title"), url=url))
-    size = 0
-    for i in range(5):
-        try:
-            size = int(requests.head(url, timeout=60).headers["content-length"])
-            break
-        except requests.Timeout:
-            logging.warning("Timed out on try {i} while checking remote file size for '{title}'!".format(title=content.get("title"), i=i))
-        except requests.ConnectionError:
-            logging.warning("Connection error on try {i} while checking remote file size for '{title}'!".format(title=content.get("title"), i=i))
-        except TypeError:
-            logging.warning("No numeric content-length returned while checking remote file size for '{title}' ({readable_id})!".format(**content))
-            break
-    if size:
-        logging.info("Finished checking remote file size for content '{title}'!".format(title=content.get("title")))
-    else:
-        logging.error("No file size retrieved (timeouts?) for content '{title}'!".format(title=content.get("title")))
-    return size
+def apply_remote_content_file_sizes(content_data: list, sizes_by_id: dict) -> list:
+    """
+    Replace the remote_size of each video with the one we measured, if any.
+    """
+    for item in content_data:
+        size = sizes_by_id.get(item.get("youtube_id"))
+        if item.get("kind") == NodeType.video and size:
+            item["remote_size"] = size
+            item["total_files"] = 1
+
+    return content_data
 
 
 def apply_dubbed_video_map(content_data: list, subtitles: list, lang: str) -> (list, int):
 
     if lang != "en":
+        primary_lang = get_primary_language(lang)
+        subtitles = set(subtitles)
 
         dubbed_content = []
-
         dubbed_count = 0
 
         for item in content_data:
             if item["kind"] == NodeType.video:
-                if is_video_node_dubbed(item, lang):
+                if get_primary_language(item.get("translated_youtube_lang") or "") == primary_lang:
                     dubbed_count += 1
-                elif item["youtube_id"] not in subtitles:
+                elif item.get("youtube_id") not in subtitles:
                     continue
             dubbed_content.append(item)
 
         content_data = dubbed_content
 
     else:
-        dubbed_count = sum(content_datum.get("kind") == NodeType.video for content_datum in content_data)
+        content_data = list(content_data)
+        dubbed_count = sum(item["kind"] == NodeType.video for item in content_data)
 
     for item in content_data:
         item["remote_size"] = item.pop("download_size", 0)
@@ -980,16 +1121,67 @@ def apply_dubbed_video_map(content_data: list, subtitles: list, lang: str) -> (l
     return content_data, dubbed_count
 
 
+def _fetch_html_exercise(url: str, cachedir: str, entries: dict, exercise_id: str, force=False) -> dict:
+    """
+    Make sure the exercise html at url is cached in cachedir, and return its
+    manifest entry, i.e. the file's hash and HTTP validators. If force is
+    True, the cached file is revalidated with a conditional request instead
+    of being downloaded again.
+    """
+    path = os.path.join(cachedir, get_cache_filename(url))
+    entry = entries.get(exercise_id)
+    headers = {}
+
+    if os.path.exists(path):
+        stat = os.stat(path)
+        if not entry or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+            # the file changed behind our back, or predates the manifest
+            entry = {"sha256": hash_file(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+            entries[exercise_id] = entry
+
+        if not force:
+            return entry
+
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    else:
+        os.makedirs(cachedir, exist_ok=True)
+
+    r, digest = download_file(url, path, headers=headers)
+    if digest:
+        stat = os.stat(path)
+        entry = {
+            "sha256": digest,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+        }
+        entries[exercise_id] = entry
+
+    return entry
+
+
 def retrieve_html_exercises(exercises: [str], lang: str, force=False) -> (str, [str]):
     """
     Return a 2-tuple with the first element pointing to the path the exercise files are stored,
     and the second element a list of exercise ids that have html exercises.
+
+    The hashes of all the exercise files we've fetched are kept in a manifest
+    inside the build directory, so that finding out which exercises are
+    translated is just a matter of comparing hashes.
     """
     BUILD_DIR = os.path.join(os.getcwd(), "build", lang)
     EN_BUILD_DIR = os.path.join(os.getcwd(), "build", "en")
     EXERCISE_DOWNLOAD_URL_TEMPLATE = ("https://es.khanacademy.org/"
                                       "khan-exercises/exercises/{id}.html?lang={lang}")
 
+    manifest = PersistentDict(os.path.join(os.getcwd(), "build", HTML_EXERCISE_MANIFEST_FILENAME))
+    lang_entries = manifest.setdefault(lang, {})
+    en_entries = manifest.setdefault("en", {})
+
     def _download_html_exercise(exercise_id):
         """
         Download an exercise and return its exercise id *if* the
@@ -998,9 +1190,9 @@ def retrieve_html_exercises(exercises: [str], lang: str, force=False) -> (str, [
         lang_url = EXERCISE_DOWNLOAD_URL_TEMPLATE.format(id=exercise_id, lang=lang)
         en_url = EXERCISE_DOWNLOAD_URL_TEMPLATE.format(id=exercise_id, lang="en")
         try:
-            lang_file = download_and_cache_file(lang_url, cachedir=BUILD_DIR, ignorecache=force)
-            en_file = download_and_cache_file(en_url, cachedir=EN_BUILD_DIR, ignorecache=force)
-            if not filecmp.cmp(lang_file, en_file, shallow=False):
+            lang_entry = _fetch_html_exercise(lang_url, BUILD_DIR, lang_entries, exercise_id, force=force)
+            en_entry = _fetch_html_exercise(en_url, EN_BUILD_DIR, en_entries, exercise_id, force=force)
+            if lang_entry["sha256"] != en_entry["sha256"]:
                 return exercise_id
         except requests.exceptions.HTTPError as e:
             logging.warning("Failed to fetch html for exercise {}, exception: {}".format(exercise_id, e))
@@ -1008,6 +1200,8 @@ def retrieve_html_exercises(exercises: [str], lang: str, force=False) -> (str, [
 
     pool = ThreadPool(processes=NUM_PROCESSES)
     translated_exercises = pool.map(_download_html_exercise, exercises)
+    manifest.save()
+
     # filter out Nones, since it means we got an error downloading those exercises
     result = [e for e in translated_exercises if e]
     return (BUILD_DIR, result)
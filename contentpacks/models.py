@@ -1,5 +1,5 @@
 from peewee import Model, CharField, TextField, BooleanField,\
-    ForeignKeyField, PrimaryKeyField, IntegerField, FloatField
+    ForeignKeyField, PrimaryKeyField, IntegerField, FloatField, CompositeKey
 
 
 class Item(Model):
@@ -19,6 +19,13 @@ class Item(Model):
     size_on_disk = IntegerField(default=0)
     remote_size = IntegerField(default=0)
     sort_order = FloatField(default=0.0)
+    # fields clients read on every topic page, typed so they don't have to decode extra_fields
+    display_name = CharField(null=True)
+    duration = IntegerField(null=True)
+    basepoints = FloatField(null=True)
+    file_name = CharField(null=True)
+    related_exercise_url = CharField(null=True)
+    uses_assessment_items = BooleanField(default=False)
 
     def __init__(self, *args, **kwargs):
         super(Item, self).__init__(*args, **kwargs)
@@ -31,3 +38,74 @@ class AssessmentItem(Model):
     pk = PrimaryKeyField(primary_key=True)
     item_data = TextField()  # A serialized JSON blob
     author_names = CharField(max_length=200)  # A serialized JSON list
+
+
+class ItemClosure(Model):
+    """
+    One row for every pair of an item and one of its ancestors, including
+    the item itself at depth 0, so that subtree queries are index lookups.
+    """
+    ancestor = ForeignKeyField(Item, related_name="descendant_links")
+    descendant = ForeignKeyField(Item, related_name="ancestor_links")
+    depth = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("ancestor", "descendant")
+        indexes = (
+            (("descendant", "depth"), False),
+        )
+
+
+class ExerciseAssessmentItem(Model):
+    """
+    The assessment items of each exercise, in order, so that clients don't
+    have to parse the exercise's extra_fields to find them.
+    """
+    exercise_id = CharField()
+    assessment_item_id = CharField(max_length=50)
+    sort_order = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("exercise_id", "sort_order")
+        indexes = (
+            (("assessment_item_id", "exercise_id"), False),
+        )
+
+
+class ItemPrerequisite(Model):
+    """
+    The prerequisites of each exercise, in order, by id.
+    """
+    item_id = CharField()
+    prerequisite_id = CharField()
+    sort_order = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("item_id", "sort_order")
+        indexes = (
+            (("prerequisite_id", "item_id"), False),
+        )
+
+
+class ItemRelatedVideo(Model):
+    """
+    The curated related videos of each exercise, in order, by id.
+    """
+    item_id = CharField()
+    video_id = CharField()
+    sort_order = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey("item_id", "sort_order")
+        indexes = (
+            (("video_id", "item_id"), False),
+        )
+
+
+class TopicListing(Model):
+    """
+    What a topic page shows, pre-rendered: a compact JSON object with the
+    topic's own totals and one row per child, in order.
+    """
+    path = CharField(primary_key=True)
+    listing = TextField()
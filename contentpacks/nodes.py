@@ -0,0 +1,145 @@
+"""
+A compact representation of topic tree nodes.
+
+A full topic tree has hundreds of thousands of nodes, and each of them being
+a dict with its own hash table makes up most of the memory used by a build.
+Node stores the fields every node has in __slots__ instead, while still
+behaving like the dicts the rest of the pipeline expects.
+"""
+import sys
+from collections.abc import MutableMapping
+
+# The snake_case versions of khanacademy.topic_attributes, exercise_attributes and video_attributes
+# (minus the flags dropped while cleaning the data), and the fields we add to nodes ourselves.
+NODE_FIELDS = (
+    "id",
+    "kind",
+    "slug",
+    "path",
+    "title",
+    "description",
+    "sort_order",
+    "extra_placements",
+    "child_data",
+    # exercises
+    "name",
+    "display_name",
+    "file_name",
+    "basepoints",
+    "uses_assessment_items",
+    "all_assessment_items",
+    "curated_related_videos",
+    "prerequisites",
+    # videos
+    "youtube_id",
+    "readable_id",
+    "format",
+    "duration",
+    "download_size",
+    "remote_size",
+    "total_files",
+    "image_url",
+    "keywords",
+    "license_name",
+    "related_exercise_url",
+    "relative_url",
+    "sha",
+    "translated_youtube_lang",
+)
+
+# Fields that only ever take a handful of distinct values, so every node can share the same string object.
+INTERNED_FIELDS = frozenset(["kind", "format", "license_name", "translated_youtube_lang"])
+
+_NODE_FIELD_SET = frozenset(NODE_FIELDS)
+
+
+class Node(MutableMapping):
+    """
+    A dict-like topic tree node. Known fields live in slots, anything else
+    goes into an overflow dict that's only created when needed.
+    """
+    __slots__ = NODE_FIELDS + ("_extra",)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in _NODE_FIELD_SET:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _NODE_FIELD_SET:
+            if key in INTERNED_FIELDS and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _NODE_FIELD_SET:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        else:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+            if not self._extra:
+                self._extra = None
+
+    def __contains__(self, key):
+        if key in _NODE_FIELD_SET:
+            return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in NODE_FIELDS:
+            if hasattr(self, field):
+                yield field
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "Node({!r})".format(dict(self))
+
+    # Slots don't get pickled or copied by default without a __dict__ to
+    # fall back on, so spell out the state.
+    def __getstate__(self):
+        return dict(self)
+
+    def __setstate__(self, state):
+        self._extra = None
+        self.update(state)
+
+    def __reduce__(self):
+        return Node, (), self.__getstate__()
+
+    def copy(self):
+        """
+        Return a shallow copy of the node, like dict.copy().
+        """
+        return Node(self)
+
+
+def compact_nodes(nodes: list) -> list:
+    """
+    Replace every dict in nodes with a Node, in place, so that each dict can
+    be freed as soon as it's been converted.
+    """
+    for i, node in enumerate(nodes):
+        if not isinstance(node, Node):
+            nodes[i] = Node(node)
+    return nodes
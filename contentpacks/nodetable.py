@@ -0,0 +1,120 @@
+"""
+A columnar view of the topic tree, for the per-topic roll-ups.
+
+Rather than querying the children of every topic, NodeTable pulls the
+fields the roll-ups read into NumPy arrays once, so that they become
+np.add.at calls over the parent indices, one tree level at a time. The
+node filters only look at each node once, so they stay plain loops.
+"""
+import numpy as np
+
+# the values of contentpacks.utils.NodeType, which imports this module
+TOPIC, EXERCISE, VIDEO = "Topic", "Exercise", "Video"
+
+KIND_CODES = {
+    TOPIC: 0,
+    EXERCISE: 1,
+    VIDEO: 2,
+}
+
+UNKNOWN_KIND_CODE = len(KIND_CODES)
+
+NO_PARENT = -1
+
+
+def get_key(node, key):
+    return node.get(key)
+
+
+def get_attribute(node, key):
+    return getattr(node, key, None)
+
+
+def get_parent_path(path: str) -> str:
+    return path[:path.rstrip("/").rfind("/") + 1]
+
+
+class NodeTable:
+    """
+    Columns for the node list nodes, one row per node, in the same order.
+    nodes can be dicts (or Nodes), or Item models if get is get_attribute.
+
+    kind, parent and depth are integer arrays; available is boolean;
+    remote_size, total_files and size_on_disk are int64. parent holds the row
+    of each node's parent, or NO_PARENT. Only the columns the roll-ups read
+    are kept.
+    """
+
+    def __init__(self, nodes: list, get=get_key):
+        self.nodes = nodes
+        size = len(nodes)
+
+        def column(key, dtype):
+            return np.fromiter((get(node, key) or 0 for node in nodes), dtype=dtype, count=size)
+
+        self.kind = np.fromiter((KIND_CODES.get(get(node, "kind"), UNKNOWN_KIND_CODE) for node in nodes),
+                                dtype=np.int8, count=size)
+        self.available = column("available", bool)
+        self.remote_size = column("remote_size", np.int64)
+        self.total_files = column("total_files", np.int64)
+        self.size_on_disk = column("size_on_disk", np.int64)
+
+        paths = [get(node, "path") or "" for node in nodes]
+        self.depth = np.fromiter((path.count("/") for path in paths), dtype=np.int32, count=size)
+        rows = {path: row for row, path in enumerate(paths) if path}
+        # the root's parent path is "", which is never in rows
+        self.parent = np.fromiter((rows.get(get_parent_path(path), NO_PARENT) for path in paths),
+                                  dtype=np.int32, count=size)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def is_kind(self, kind: str) -> np.ndarray:
+        return self.kind == KIND_CODES.get(kind, UNKNOWN_KIND_CODE)
+
+    def roll_up(self) -> dict:
+        """
+        Aggregate availability and sizes up the tree, the way KA Lite expects
+        them on topics: a topic is available if any of its descendants are,
+        its total_files and size_on_disk are the sums over its children, and
+        its remote_size is the size of everything below it that's not
+        available yet. A topic keeps its own remote_size and size_on_disk if
+        nothing below it has any.
+
+        Returns the new available, total_files, remote_size and size_on_disk
+        columns.
+        """
+        is_topic = self.is_kind(TOPIC)
+
+        available = self.available.copy()
+        total_files = np.where(is_topic, 0, self.total_files)
+        remote_size = self.remote_size.copy()
+        size_on_disk = self.size_on_disk.copy()
+        child_remote_size = np.zeros(len(self), dtype=np.int64)
+        child_size_on_disk = np.zeros(len(self), dtype=np.int64)
+
+        has_parent = self.parent != NO_PARENT
+
+        for depth in np.unique(self.depth)[::-1]:
+            at_depth = self.depth == depth
+
+            # everything below this level has been added up by now
+            done = at_depth & is_topic & (child_remote_size != 0)
+            remote_size[done] = child_remote_size[done]
+            done = at_depth & is_topic & (child_size_on_disk != 0)
+            size_on_disk[done] = child_size_on_disk[done]
+
+            children = np.flatnonzero(at_depth & has_parent)
+            parents = self.parent[children]
+            np.logical_or.at(available, parents, available[children])
+            np.add.at(total_files, parents, total_files[children])
+            not_downloaded = is_topic[children] | ~available[children]
+            np.add.at(child_remote_size, parents, np.where(not_downloaded, remote_size[children], 0))
+            np.add.at(child_size_on_disk, parents, size_on_disk[children])
+
+        return {
+            "available": available,
+            "total_files": total_files,
+            "remote_size": remote_size,
+            "size_on_disk": size_on_disk,
+        }
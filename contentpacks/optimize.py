@@ -0,0 +1,502 @@
+"""
+Optional optimization stages for the files that end up in a content pack.
+
+Every optimizer here is lossless: it only drops data that doesn't affect how
+the file renders, and falls back to the original bytes whenever the input
+can't be parsed or the result isn't smaller. Results are cached by the
+SHA-256 of the source file, so each file is only optimized once across builds.
+"""
+import collections
+import json
+import logging
+import os
+import re
+import struct
+import tempfile
+import zlib
+
+from contentpacks.utils import hash_file, add_to_asset_store, link_or_copy_file, ASSET_STORE_DIRNAME
+
+
+OPTIMIZED_IMAGES_CACHE_DIRNAME = "optimized_images"
+
+# bump this whenever a minifier's output changes, to invalidate the cache
+MINIFIED_TEXT_CACHE_DIRNAME = "minified_text/v1"
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# textual and timestamp chunks; none of these affect how the image is drawn
+PNG_CHUNKS_TO_STRIP = {b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+
+# animated PNGs carry frame data outside IDAT; leave them alone
+PNG_ANIMATION_CHUNKS = {b"acTL", b"fcTL", b"fdAT"}
+
+JPEG_SOI = b"\xff\xd8"
+
+# APP14 (Adobe) affects the color transform; keep it along with APP0 (JFIF)
+JPEG_MARKERS_TO_KEEP = {0xe0, 0xee}
+
+JPEG_COMMENT_MARKER = 0xfe
+
+JPEG_SOS_MARKER = 0xda
+
+EXIF_ORIENTATION_TAG = 0x0112
+
+
+def optimize_png(data: bytes) -> bytes:
+    """
+    Strip textual metadata chunks and recompress the image data at the
+    highest zlib level. The decompressed pixel data is left untouched.
+    """
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError("Not a PNG file.")
+
+    chunks = []
+    idat = []
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk_data = data[pos + 8:pos + 8 + length]
+        if len(chunk_data) != length:
+            raise ValueError("Truncated PNG chunk {}.".format(chunk_type))
+        pos += length + 12
+
+        if chunk_type in PNG_ANIMATION_CHUNKS:
+            return data
+        elif chunk_type == b"IDAT":
+            if not idat:
+                chunks.append((b"IDAT", None))  # placeholder, filled in below
+            idat.append(chunk_data)
+        elif chunk_type not in PNG_CHUNKS_TO_STRIP:
+            chunks.append((chunk_type, chunk_data))
+
+        if chunk_type == b"IEND":
+            break
+
+    if not idat:
+        raise ValueError("PNG file has no image data.")
+
+    original_idat = b"".join(idat)
+    pixels = zlib.decompress(original_idat)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS, 9)
+    new_idat = compressor.compress(pixels) + compressor.flush()
+    if len(new_idat) >= len(original_idat):
+        new_idat = original_idat
+
+    out = [PNG_SIGNATURE]
+    for chunk_type, chunk_data in chunks:
+        if chunk_data is None:
+            chunk_data = new_idat
+        out.append(struct.pack(">I4s", len(chunk_data), chunk_type))
+        out.append(chunk_data)
+        out.append(struct.pack(">I", zlib.crc32(chunk_type + chunk_data) & 0xffffffff))
+
+    return b"".join(out)
+
+
+def _exif_orientation(segment: bytes) -> int:
+    """
+    Return the orientation recorded in an APP1 Exif segment, or 1 (the
+    default) if there is none.
+    """
+    tiff = segment[6:]
+    byteorder = {b"II": "<", b"MM": ">"}[tiff[:2]]
+    ifd_offset, = struct.unpack(byteorder + "I", tiff[4:8])
+    entry_count, = struct.unpack(byteorder + "H", tiff[ifd_offset:ifd_offset + 2])
+    for i in range(entry_count):
+        entry = tiff[ifd_offset + 2 + i * 12:ifd_offset + 14 + i * 12]
+        tag, value_type, count = struct.unpack(byteorder + "HHI", entry[:8])
+        if tag == EXIF_ORIENTATION_TAG:
+            return struct.unpack(byteorder + "H", entry[8:10])[0]
+
+    return 1
+
+
+def _is_jpeg_segment_needed(marker: int, segment: bytes) -> bool:
+    if marker == JPEG_COMMENT_MARKER:
+        return False
+    elif 0xe0 <= marker <= 0xef:
+        if marker in JPEG_MARKERS_TO_KEEP:
+            return True
+        elif marker == 0xe2 and segment.startswith(b"ICC_PROFILE\x00"):
+            return True
+        elif marker == 0xe1 and segment.startswith(b"Exif\x00\x00"):
+            # browsers rotate images according to their Exif orientation,
+            # so we can only drop the Exif data if there's no rotation.
+            try:
+                return _exif_orientation(segment) != 1
+            except (KeyError, struct.error):
+                return True
+        return False
+    else:
+        return True
+
+
+def optimize_jpeg(data: bytes) -> bytes:
+    """
+    Drop comments and application metadata segments (Exif, XMP and
+    friends) from a JPEG file. The entropy-coded image data is copied as-is,
+    so the image is never re-encoded.
+    """
+    if not data.startswith(JPEG_SOI):
+        raise ValueError("Not a JPEG file.")
+
+    out = [JPEG_SOI]
+    pos = len(JPEG_SOI)
+    while pos < len(data):
+        if data[pos] != 0xff:
+            raise ValueError("Expected a JPEG marker at offset {}.".format(pos))
+        marker = data[pos + 1]
+        if marker == 0xff:      # fill byte
+            pos += 1
+            continue
+        elif 0xd0 <= marker <= 0xd7 or marker == 0x01:  # markers without a length
+            out.append(data[pos:pos + 2])
+            pos += 2
+            continue
+
+        length, = struct.unpack(">H", data[pos + 2:pos + 4])
+        segment = data[pos + 4:pos + 2 + length]
+        if marker == JPEG_SOS_MARKER:
+            # everything from the start of scan onwards is image data
+            out.append(data[pos:])
+            break
+        elif _is_jpeg_segment_needed(marker, segment):
+            out.append(data[pos:pos + 2 + length])
+        pos += 2 + length
+    else:
+        raise ValueError("JPEG file has no image data.")
+
+    return b"".join(out)
+
+
+def _skip_gif_sub_blocks(data: bytes, pos: int) -> int:
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+def optimize_gif(data: bytes) -> bytes:
+    """
+    Drop comment extension blocks from a GIF file. Image, graphic control and
+    application (e.g. looping) blocks are copied as-is.
+    """
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("Not a GIF file.")
+
+    flags = data[10]
+    pos = 13
+    if flags & 0x80:            # global color table
+        pos += 3 * 2 ** ((flags & 0x07) + 1)
+
+    out = [data[:pos]]
+    while True:
+        block_type = data[pos]
+        if block_type == 0x3b:  # trailer
+            out.append(data[pos:pos + 1])
+            break
+        elif block_type == 0x2c:  # image descriptor
+            start = pos
+            flags = data[pos + 9]
+            pos += 10
+            if flags & 0x80:    # local color table
+                pos += 3 * 2 ** ((flags & 0x07) + 1)
+            pos = _skip_gif_sub_blocks(data, pos + 1)  # skip the LZW code size byte too
+            out.append(data[start:pos])
+        elif block_type == 0x21:  # extension
+            start = pos
+            label = data[pos + 1]
+            pos = _skip_gif_sub_blocks(data, pos + 2)
+            if label != 0xfe:   # comment extension
+                out.append(data[start:pos])
+        else:
+            raise ValueError("Unknown GIF block type {}.".format(block_type))
+
+    return b"".join(out)
+
+
+IMAGE_OPTIMIZERS = {
+    ".png": optimize_png,
+    ".jpg": optimize_jpeg,
+    ".jpeg": optimize_jpeg,
+    ".gif": optimize_gif,
+}
+
+
+def get_optimized_images_cache_dir() -> str:
+    return os.path.join(os.getcwd(), "build", OPTIMIZED_IMAGES_CACHE_DIRNAME)
+
+
+def optimize_cached_file(path: str, optimizer, cachedir: str, storedir: str=None) -> str:
+    """
+    Run optimizer over the bytes of the file at path, unless a file with the
+    same contents was optimized before. Returns the path to the cached result,
+    which is named after the SHA-256 digest of the source file, and links to
+    a blob in the asset store at storedir.
+    """
+    digest = hash_file(path)
+    cached_path = os.path.join(cachedir, digest[:2], digest)
+
+    if not os.path.exists(cached_path):
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        with open(path, "rb") as f:
+            data = f.read()
+
+        try:
+            optimized = optimizer(data)
+        except (ValueError, IndexError, struct.error, zlib.error) as e:
+            logging.warning("Could not optimize {path}, keeping it as is: {e}".format(path=path, e=e))
+            optimized = data
+
+        if len(optimized) >= len(data):
+            optimized = data
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cached_path), suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(optimized)
+        add_to_asset_store(tmp_path, cached_path, storedir)
+
+    return cached_path
+
+
+def optimize_assessment_images(assessment_files, outdir=None, cachedir=None) -> ([str], dict):
+    """
+    Losslessly shrink the raster images among the given assessment resource
+    files. Returns a list of paths to use instead of assessment_files, laid
+    out the same way (i.e. <subpath>/<filename>) under outdir, and a report
+    of the sizes before and after, per file extension.
+    """
+    outdir = outdir or os.path.join(os.getcwd(), "build", "assessment_resources_optimized")
+    # a cache somewhere else gets its own store, rather than the one in the current directory
+    storedir = os.path.join(cachedir, ASSET_STORE_DIRNAME) if cachedir else None
+    cachedir = cachedir or get_optimized_images_cache_dir()
+
+    report = collections.defaultdict(lambda: {"count": 0, "size_before": 0, "size_after": 0})
+    new_paths = []
+
+    for path in assessment_files:
+        extension = os.path.splitext(path)[1].lower()
+        optimizer = IMAGE_OPTIMIZERS.get(extension)
+        if not optimizer:
+            new_paths.append(path)
+            continue
+
+        optimized_path = optimize_cached_file(path, optimizer, cachedir, storedir)
+        new_path = os.path.join(outdir, os.path.basename(os.path.dirname(path)), os.path.basename(path))
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        link_or_copy_file(optimized_path, new_path)
+        new_paths.append(new_path)
+
+        sizes = report[extension]
+        sizes["count"] += 1
+        sizes["size_before"] += os.path.getsize(path)
+        sizes["size_after"] += os.path.getsize(new_path)
+
+    return new_paths, dict(report)
+
+
+# HTML only treats these as whitespace; notably, \xa0 (&nbsp;) isn't one of them.
+HTML_NEWLINE_WHITESPACE_REGEX = re.compile(r"[ \t\f\r]*\n[ \t\n\f\r]*")
+
+HTML_TAG_PATTERN = r"""<[^>"']*(?:(?:"[^"]*"|'[^']*')[^>"']*)*>"""
+
+HTML_TOKEN_REGEX = re.compile(
+    r"(?P<comment><!--(?!\[if).*?-->)"
+    r"|(?P<raw><(?P<rawtag>script|style|pre|textarea)\b[^>]*>.*?</(?P=rawtag)\s*>)"
+    r"|(?P<tag>" + HTML_TAG_PATTERN + ")",
+    flags=re.IGNORECASE | re.DOTALL,
+)
+
+SVG_TOKEN_REGEX = re.compile(
+    r"(?P<comment><!--.*?-->)"
+    r"|(?P<verbatim><!\[CDATA\[.*?\]\]>|<[?!][^>]*>)"
+    r"|(?P<tag>" + HTML_TAG_PATTERN + ")",
+    flags=re.DOTALL,
+)
+
+# whitespace inside these elements is rendered, or is code
+SVG_WHITESPACE_SENSITIVE_TAGS = {"text", "tspan", "textPath", "title", "desc", "style", "script", "foreignObject"}
+
+JSONP_REGEX = re.compile(r"\A\s*(?P<callback>[\w$.]+)\s*\((?P<data>.*)\)\s*(?P<end>;?)\s*\Z", flags=re.DOTALL)
+
+
+def minify_vtt(data: bytes) -> bytes:
+    """
+    Normalize the whitespace of a WebVTT file, and drop comment (NOTE)
+    blocks and cues without any text. Cue text is rendered with
+    white-space: pre-line, so runs of spaces and tabs collapse anyway.
+    """
+    text = data.decode("utf-8-sig")
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    blocks = re.split(r"\n{2,}", text.strip("\n"))
+
+    out = []
+    for i, block in enumerate(blocks):
+        lines = block.split("\n")
+        timing_index = next((index for index, line in enumerate(lines) if "-->" in line), None)
+
+        if i == 0 or timing_index is None:
+            # the header, and NOTE, STYLE and REGION blocks
+            lines = [line.rstrip() for line in lines if line.strip()]
+            if lines and not lines[0].startswith("NOTE"):
+                out.append("\n".join(lines))
+            continue
+
+        cue_text = [re.sub(r"[ \t]+", " ", line).strip() for line in lines[timing_index + 1:]]
+        if not any(cue_text):
+            continue
+
+        cue = [line.rstrip() for line in lines[:timing_index]]
+        cue.append(re.sub(r"[ \t]+", " ", lines[timing_index].strip()))
+        # a whitespace-only line still renders as an empty line, but an
+        # actually empty one would end the cue. Keep a single space instead.
+        cue.extend(line or " " for line in cue_text)
+        out.append("\n".join(cue))
+
+    return ("\n\n".join(out) + "\n").encode("utf-8")
+
+
+def minify_html_exercise(data: bytes) -> bytes:
+    """
+    Remove comments from an HTML exercise, and drop the indentation and blank
+    lines around line breaks in its text. Tags, script, style, pre and
+    textarea contents are copied verbatim. Line breaks themselves are kept,
+    since the inline javascript in exercises may rely on them.
+    """
+    html = data.decode("utf-8")
+
+    out = []
+    text = []                   # the text since the last tag, minus comments
+    pos = 0
+    for match in HTML_TOKEN_REGEX.finditer(html):
+        text.append(html[pos:match.start()])
+        pos = match.end()
+        if not match.group("comment"):
+            out.append(HTML_NEWLINE_WHITESPACE_REGEX.sub("\n", "".join(text)))
+            out.append(match.group(0))
+            text = []
+    text.append(html[pos:])
+    out.append(HTML_NEWLINE_WHITESPACE_REGEX.sub("\n", "".join(text)))
+
+    return "".join(out).strip().encode("utf-8")
+
+
+def minify_graphie_json(data: bytes) -> bytes:
+    """
+    Re-serialize graphie data compactly. Graphie "-data.json" files are
+    usually JSONP (i.e. svgData<hash>({...});), so keep the callback intact.
+    """
+    text = data.decode("utf-8")
+    match = JSONP_REGEX.match(text)
+    payload = match.group("data") if match else text
+
+    compact = json.dumps(json.loads(payload), separators=(",", ":"))
+    if match:
+        compact = "{callback}({data}){end}".format(callback=match.group("callback"), data=compact, end=match.group("end"))
+
+    return compact.encode("utf-8")
+
+
+def _svg_tag_name(tag: str) -> str:
+    match = re.match(r"</?([^\s/>]+)", tag)
+    # e.g. "< foo>", which isn't a tag we know how to treat anyway
+    if not match:
+        return ""
+    return match.group(1).split(":")[-1]
+
+
+def minify_svg(data: bytes) -> bytes:
+    """
+    Drop comments and whitespace-only text between the tags of an SVG
+    file. Whitespace inside text, style and script elements is left alone, as
+    are files that ask for xml:space="preserve".
+    """
+    svg = data.decode("utf-8")
+    if "xml:space" in svg:
+        return data
+
+    out = []
+    sensitive_depth = 0
+    pos = 0
+    for match in SVG_TOKEN_REGEX.finditer(svg):
+        text = svg[pos:match.start()]
+        if sensitive_depth or text.strip():
+            out.append(text)
+        pos = match.end()
+
+        if match.group("comment"):
+            if sensitive_depth:
+                out.append(match.group(0))
+            continue
+
+        token = match.group(0)
+        out.append(token)
+        if match.group("tag") and _svg_tag_name(token) in SVG_WHITESPACE_SENSITIVE_TAGS:
+            if token.startswith("</"):
+                sensitive_depth -= 1
+            elif not token.endswith("/>"):
+                sensitive_depth += 1
+    out.append(svg[pos:].strip())
+
+    return "".join(out).encode("utf-8")
+
+
+def get_minified_text_cache_dir() -> str:
+    return os.path.join(os.getcwd(), "build", MINIFIED_TEXT_CACHE_DIRNAME)
+
+
+def _minify_file(path: str, minifier, dest: str, cachedir: str, storedir: str, sizes: dict) -> str:
+    minified_path = optimize_cached_file(path, minifier, os.path.join(cachedir, minifier.__name__), storedir)
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    link_or_copy_file(minified_path, dest)
+
+    sizes["count"] += 1
+    sizes["size_before"] += os.path.getsize(path)
+    sizes["size_after"] += os.path.getsize(dest)
+
+    return dest
+
+
+def minify_text_assets(subtitle_paths, html_exercise_path: str, assessment_files, outdir=None, cachedir=None):
+    """
+    Minify the subtitles, HTML exercises and graphie files that go into a
+    content pack. Returns new subtitle paths, HTML exercise directory and
+    assessment file paths, each laid out the way bundle_language_pack expects,
+    plus a report of the sizes before and after for each kind of file.
+    """
+    outdir = outdir or os.path.join(os.getcwd(), "build", "minified")
+    storedir = os.path.join(cachedir, ASSET_STORE_DIRNAME) if cachedir else None
+    cachedir = cachedir or get_minified_text_cache_dir()
+
+    report = collections.defaultdict(lambda: {"count": 0, "size_before": 0, "size_after": 0})
+
+    # subtitles/<lang>/<youtube_id>.vtt, so that languages built one after the other don't overwrite each other
+    new_subtitle_paths = [
+        _minify_file(path, minify_vtt,
+                     os.path.join(outdir, "subtitles", os.path.basename(os.path.dirname(path)), os.path.basename(path)),
+                     cachedir, storedir, report["subtitles"])
+        for path in subtitle_paths
+    ]
+
+    if os.path.isdir(html_exercise_path):
+        new_html_exercise_path = os.path.join(outdir, "exercises", os.path.basename(os.path.normpath(html_exercise_path)))
+        for name in os.listdir(html_exercise_path):
+            _minify_file(os.path.join(html_exercise_path, name), minify_html_exercise,
+                         os.path.join(new_html_exercise_path, name), cachedir, storedir, report["html exercises"])
+    else:
+        new_html_exercise_path = html_exercise_path
+
+    new_assessment_files = []
+    for path in assessment_files:
+        if path.endswith("-data.json"):
+            minifier, kind = minify_graphie_json, "graphie json"
+        elif path.lower().endswith(".svg"):
+            minifier, kind = minify_svg, "graphie svg"
+        else:
+            new_assessment_files.append(path)
+            continue
+
+        dest = os.path.join(outdir, "assessment_resources", os.path.basename(os.path.dirname(path)), os.path.basename(path))
+        new_assessment_files.append(_minify_file(path, minifier, dest, cachedir, storedir, report[kind]))
+
+    return new_subtitle_paths, new_html_exercise_path, new_assessment_files, dict(report)
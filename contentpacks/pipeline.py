@@ -0,0 +1,85 @@
+"""
+Run a chain of generator stages concurrently.
+
+Each stage is a function that takes an iterable and returns an iterable,
+like remove_assessment_data_with_empty_widgets. stream_through gives every
+stage its own thread, connected to the next by a bounded queue, so an item
+moves on to the next stage as soon as it's ready, while the stages before it
+keep working on the items after it.
+"""
+import logging
+import queue
+import threading
+
+PIPELINE_QUEUE_SIZE = 100
+
+_END = object()
+
+
+class _QueueIterator:
+    """
+    Iterate over the items put into q, until the end marker.
+    """
+
+    def __init__(self, q: queue.Queue):
+        self.q = q
+        self.done = False
+
+    def __iter__(self):
+        while not self.done:
+            item = self.q.get()
+            if item is _END:
+                self.done = True
+                return
+            yield item
+
+
+def stream_through(items, stages, maxsize=PIPELINE_QUEUE_SIZE):
+    """
+    Feed items through stages, one thread per stage, and yield what comes out
+    of the last one. If any stage raises, the error is raised here once the
+    other stages have wound down.
+    """
+    errors = []
+    queues = [queue.Queue(maxsize) for _ in range(len(stages) + 1)]
+
+    def _feed():
+        try:
+            for item in items:
+                queues[0].put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queues[0].put(_END)
+
+    def _run(stage, inq, outq):
+        inputs = _QueueIterator(inq)
+        try:
+            for item in stage(iter(inputs)):
+                outq.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            outq.put(_END)
+            # if this stage stopped early, keep the ones before it from blocking on a full queue
+            for _ in inputs:
+                pass
+
+    threads = [threading.Thread(target=_feed, daemon=True)]
+    threads += [threading.Thread(target=_run, args=(stage, queues[i], queues[i + 1]), daemon=True)
+                for i, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+
+    outputs = _QueueIterator(queues[-1])
+    try:
+        yield from outputs
+    finally:
+        for _ in outputs:
+            pass
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        logging.error("{} stage(s) of the pipeline failed.".format(len(errors)))
+        raise errors[0]
@@ -0,0 +1,87 @@
+"""
+An on-disk staging area for the pipeline's intermediate data.
+
+Normally each stage's output is kept in a list until the pack is bundled.
+With a StagingStore, a stage's output is written to a table of a temporary
+SQLite database instead, and later stages read it back one row at a time,
+so only the row being worked on needs to be in memory.
+"""
+import itertools
+import sqlite3
+import tempfile
+
+import ujson
+
+STAGING_BATCH_SIZE = 1000
+
+
+class StagedItems:
+    """
+    The rows of one staging table. Can be iterated over any number of times,
+    each time with a fresh cursor.
+    """
+
+    def __init__(self, store, table: str):
+        self.store = store
+        self.table = table
+
+    def __iter__(self):
+        cursor = self.store.connection.execute("SELECT data FROM {} ORDER BY rowid".format(self.table))
+        for data, in cursor:
+            yield ujson.loads(data)
+
+    def __len__(self):
+        count, = self.store.connection.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()
+        return count
+
+    def __bool__(self):
+        return self.store.connection.execute("SELECT 1 FROM {} LIMIT 1".format(self.table)).fetchone() is not None
+
+
+class StagingStore:
+    """
+    A temporary SQLite database of JSON serializable items, deleted when
+    closed.
+    """
+
+    def __init__(self, dir: str=None):
+        self.file = tempfile.NamedTemporaryFile(suffix=".sqlite", dir=dir)
+        self.connection = sqlite3.connect(self.file.name)
+        # it's all temporary anyway, so don't pay for durability
+        self.connection.execute("PRAGMA journal_mode = OFF")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        self.tables = set()
+
+    def stage(self, name: str, items) -> StagedItems:
+        """
+        Write items into the table name, replacing anything staged under
+        that name before, and return them as StagedItems. items may itself
+        be reading from another table of this store.
+        """
+        table = "staged_{}".format(name)
+        if table in self.tables:
+            self.connection.execute("DELETE FROM {}".format(table))
+        else:
+            self.connection.execute("CREATE TABLE {} (data TEXT NOT NULL)".format(table))
+            self.tables.add(table)
+
+        rows = ((ujson.dumps(item),) for item in items)
+        insert = "INSERT INTO {} (data) VALUES (?)".format(table)
+        while True:
+            batch = list(itertools.islice(rows, STAGING_BATCH_SIZE))
+            if not batch:
+                break
+            self.connection.executemany(insert, batch)
+        self.connection.commit()
+
+        return StagedItems(self, table)
+
+    def close(self):
+        self.connection.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,14 +1,26 @@
-import copy
+import codecs
+import collections
+import hashlib
+import itertools
+import json
 import logging
+import numpy as np
 import os
 import pkgutil
 import re
 import requests
-from functools import partial
+from functools import partial, lru_cache
 from urllib.parse import urlparse
-from contentpacks.models import Item, AssessmentItem
-from peewee import Using, SqliteDatabase, fn
+from contentpacks.contentdb import finalize_content_db, build_search_index, \
+    compress_assessment_items as compress_assessment_items_in_db, CONTENT_DB_PAGE_SIZE
+from contentpacks.models import Item, AssessmentItem, ItemClosure, ExerciseAssessmentItem, ItemPrerequisite, \
+    ItemRelatedVideo, TopicListing
+from contentpacks.nodetable import NodeTable, get_attribute, get_parent_path
+from contentpacks.ziputils import FanOutZipFile
+from peewee import Using, SqliteDatabase
 import polib
+import shutil
+import threading
 import ujson
 import zipfile
 import tempfile
@@ -38,11 +50,79 @@ NODE_FIELDS_TO_TRANSLATE = [
 
 ASSESSMENT_RESOURCES_ZIP_FOLDER = "khan/"
 
+# What goes into a minimal pack: no assessment items, subtitles or html exercises.
+MINIMAL_PACK_ITEMS = {
+    "metadata.json",
+    "content.db",
+    "backend.mo",
+    "frontend.mo",
+}
+
 ASSESSMENT_VERSION_FILENAME = "assessmentitems.version"
 
 
 LANGUAGELOOKUP_DATA = pkgutil.get_data('contentpacks', "resources/languagelookup.json")
 
+ASSET_STORE_DIRNAME = "store"
+
+HASH_BLOCKSIZE = 1024 * 1024
+
+# sqlite allows at most 999 parameters per query, and AssessmentItem and ItemClosure rows have 3
+ASSESSMENT_ITEM_BATCH_SIZE = 250
+ITEM_CLOSURE_BATCH_SIZE = 300
+EXERCISE_ASSESSMENT_ITEM_BATCH_SIZE = 300
+ITEM_EDGE_BATCH_SIZE = 300
+TOPIC_LISTING_BATCH_SIZE = 100
+
+# The columns of each child row in a TopicListing, and the totals of the topic itself.
+TOPIC_LISTING_CHILD_FIELDS = ["id", "path", "slug", "title", "kind", "available", "total_files", "size_on_disk",
+                              "remote_size"]
+TOPIC_LISTING_TOTAL_FIELDS = ["available", "total_files", "size_on_disk", "remote_size"]
+
+# Node fields saved as edge tables rather than in extra_fields, with the
+# model and the column each entry goes into.
+ITEM_EDGE_FIELDS = {
+    "prerequisites": (ItemPrerequisite, "prerequisite_id"),
+    "curated_related_videos": (ItemRelatedVideo, "video_id"),
+}
+
+# Format 2 packs keep these fields only in their columns and edge tables.
+# Earlier formats also leave them in extra_fields, where older clients read
+# them from.
+LEGACY_EXTRA_FIELDS = ["display_name", "duration", "basepoints", "file_name", "related_exercise_url",
+                       "uses_assessment_items", "prerequisites", "curated_related_videos"]
+
+# the format of the packs built, unless CONTENT_PACK_FORMAT_VERSION says otherwise
+PACK_FORMAT_VERSION = 1
+
+JSON_WHITESPACE_REGEX = re.compile(r"[ \t\n\r]*")
+
+
+class PersistentDict(dict):
+    """
+    A dict that's loaded from, and can be saved back to, a JSON file. Used
+    for the manifests and caches we keep around between builds.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+        try:
+            with open(path) as f:
+                self.update(ujson.load(f))
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.warning("Ignoring corrupt cache file {path}: {e}".format(path=path, e=e))
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as f:
+            ujson.dump(self, f)
+        os.replace(tmp_path, self.path)
+
 
 class Catalog(dict):
     """
@@ -90,7 +170,7 @@ def cache_file(func):
             cachedir = os.path.join(os.getcwd(), "build")
 
         if not filename:
-            filename = os.path.basename(urlparse(url).path) + urlparse(url).query
+            filename = get_cache_filename(url)
 
         path = os.path.join(cachedir, filename)
 
@@ -104,23 +184,244 @@ def cache_file(func):
     return func_wrapper
 
 
+def get_cache_filename(url: str) -> str:
+    """
+    The filename cache_file uses for url when it's not given one explicitly.
+    """
+    parsed = urlparse(url)
+    return os.path.basename(parsed.path) + parsed.query
+
+
 @cache_file
 def download_and_cache_file(url: str, path: str, headers: dict={}) -> str:
     """
     Download the given url if it's not saved in cachedir. Returns the
     path to the file. Always download the file if ignorecache is True.
     """
+    download_file(url, path, headers=headers)
+
+    return path
+
 
+def download_file(url: str, path: str, headers: dict={}) -> (requests.Response, str):
+    """
+    Download url to path through the asset store. Returns the response and
+    the SHA-256 digest of the downloaded file. If the server answers a
+    conditional request with 304 Not Modified, path is left untouched and the
+    digest is None.
+    """
     logging.info("Downloading file from {url}".format(url=url))
 
     r = requests.get(url, stream=True, headers=headers)
     r.raise_for_status()
 
-    with open(path, "wb") as f:
-        for chunk in r.iter_content(1024):
-            f.write(chunk)
+    if r.status_code == 304:
+        return r, None
 
-    return path
+    # download next to the final path first, so that an existing (possibly
+    # hardlinked) cached file is never truncated in place.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in r.iter_content(1024):
+                f.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    digest = add_to_asset_store(tmp_path, path)
+
+    return r, digest
+
+
+def hash_file(path: str) -> str:
+    """
+    Return the hex SHA-256 digest of the file at path.
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, HASH_BLOCKSIZE), b""):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def get_asset_store_dir() -> str:
+    return os.path.join(os.getcwd(), "build", ASSET_STORE_DIRNAME)
+
+
+def get_asset_store_path(digest: str, storedir: str=None) -> str:
+    storedir = storedir or get_asset_store_dir()
+    return os.path.join(storedir, digest[:2], digest)
+
+
+def add_to_asset_store(src: str, path: str, storedir: str=None) -> str:
+    """
+    Move the file at src into the content-addressed asset store, and make
+    path point to the stored blob. Files with identical bytes are only stored
+    once, no matter how many names they're cached under.
+
+    Returns the SHA-256 digest of the file.
+    """
+    digest = hash_file(src)
+    blob_path = get_asset_store_path(digest, storedir)
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if os.path.exists(blob_path):
+        os.remove(src)
+    else:
+        shutil.move(src, blob_path)
+
+    link_or_copy_file(blob_path, path)
+
+    return digest
+
+
+def link_or_copy_file(src: str, dest: str):
+    """
+    Atomically replace dest with a hardlink to src, falling back to a copy
+    when the filesystem doesn't support hardlinks (or src is on another device).
+    """
+    tmp_dest = "{dest}.{ident}.tmp".format(dest=dest, ident=threading.get_ident())
+    try:
+        os.link(src, tmp_dest)
+    except OSError:
+        shutil.copyfile(src, tmp_dest)
+
+    os.replace(tmp_dest, dest)
+
+
+def get_asset_store_digests(storedir: str=None) -> dict:
+    """
+    Map the (device, inode) of every blob in the asset store to its digest,
+    which is its name, so that the files linked to a blob needn't be hashed.
+    """
+    storedir = storedir or get_asset_store_dir()
+    try:
+        device = os.stat(storedir).st_dev
+    except FileNotFoundError:
+        return {}
+
+    digests = {}
+    for prefix in os.scandir(storedir):
+        if prefix.is_dir():
+            for blob in os.scandir(prefix.path):
+                digests[(device, blob.inode())] = blob.name
+    return digests
+
+
+def generate_dedupe_report(paths, storedir: str=None) -> dict:
+    """
+    Group the given files by content, and report how many of their bytes
+    are duplicates of another file in the set. Files linked to a blob in the
+    asset store at storedir get their digest from it; the others are hashed,
+    once per inode.
+    """
+    digests_by_inode = get_asset_store_digests(storedir)
+    paths_by_digest = collections.defaultdict(list)
+    sizes_by_digest = {}
+
+    for path in paths:
+        stat = os.stat(path)
+        inode = (stat.st_dev, stat.st_ino)
+        if inode not in digests_by_inode:
+            digests_by_inode[inode] = hash_file(path)
+        digest = digests_by_inode[inode]
+
+        paths_by_digest[digest].append(str(path))
+        sizes_by_digest[digest] = stat.st_size
+
+    total_files = sum(len(p) for p in paths_by_digest.values())
+    total_size = sum(sizes_by_digest[d] * len(p) for d, p in paths_by_digest.items())
+    unique_size = sum(sizes_by_digest.values())
+
+    return {
+        "total_files": total_files,
+        "unique_files": len(paths_by_digest),
+        "total_size": total_size,
+        "unique_size": unique_size,
+        "duplicate_size": total_size - unique_size,
+        "duplicates": {d: p for d, p in paths_by_digest.items() if len(p) > 1},
+    }
+
+
+def iter_json_object_arrays(chunks) -> (str, object):
+    """
+    Incrementally parse a JSON object whose values are all arrays, e.g.
+    {"topics": [...], "videos": [...]}, from an iterable of byte chunks.
+    Yields (key, element) pairs as soon as each element has arrived, so only
+    the element being parsed has to be held in memory.
+    """
+    chunks = iter(chunks)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    json_decoder = json.JSONDecoder()
+    buf, pos, exhausted = "", 0, False
+    state = "start"
+
+    while True:
+        pos = JSON_WHITESPACE_REGEX.match(buf, pos).end()
+
+        if pos == len(buf) or state in ("key", "element"):
+            # for keys and elements we only know that we have enough data
+            # once raw_decode succeeds, so try that first
+            if pos < len(buf):
+                try:
+                    value, end = json_decoder.raw_decode(buf, pos)
+                except ValueError:
+                    # most likely not all of the value has arrived yet
+                    if exhausted:
+                        raise
+                else:
+                    # a number at the end of the buffer may still be incomplete
+                    if end < len(buf) or exhausted:
+                        if state == "key":
+                            if not isinstance(value, str):
+                                raise ValueError("Expected a key at position {} of JSON data".format(pos))
+                            key, state = value, "colon"
+                        else:
+                            state = "after_element"
+                            yield key, value
+                        pos = end
+                        continue
+            if exhausted:
+                if state == "end":
+                    return
+                raise ValueError("Unexpected end of JSON data")
+            chunk = next(chunks, None)
+            if chunk is None:
+                buf, pos, exhausted = buf[pos:] + text_decoder.decode(b"", final=True), 0, True
+            else:
+                buf, pos = buf[pos:] + text_decoder.decode(chunk), 0
+            continue
+
+        char = buf[pos]
+        if state == "start" and char == "{":
+            state = "first_key"
+        elif state == "first_key" and char == "}":
+            state = "end"
+        elif state == "first_key":
+            state = "key"
+            continue
+        elif state == "colon" and char == ":":
+            state = "array"
+        elif state == "array" and char == "[":
+            state = "first_element"
+        elif state == "first_element" and char == "]":
+            state = "after_array"
+        elif state == "first_element":
+            state = "element"
+            continue
+        elif state == "after_element" and char == ",":
+            state = "element"
+        elif state == "after_element" and char == "]":
+            state = "after_array"
+        elif state == "after_array" and char == ",":
+            state = "key"
+        elif state == "after_array" and char == "}":
+            state = "end"
+        else:
+            raise ValueError("Unexpected {char!r} at position {pos} of JSON data".format(char=char, pos=pos))
+        pos += 1
 
 
 def translate_nodes(nodes: list, catalog: Catalog) -> list:
@@ -131,8 +432,11 @@ def translate_nodes(nodes: list, catalog: Catalog) -> list:
     Note that translation in these fields is nonessential -- meaning
     that even if they're not translated they're not a dealbreaker, and
     thus won't be eliminated from the topic tree.
+
+    Like the other stages of the pipeline, this owns the nodes it's given,
+    and translates them in place. Copy them beforehand if you still need
+    the untranslated versions.
     """
-    nodes = copy.deepcopy(nodes)
     for node in nodes:
 
         for field in NODE_FIELDS_TO_TRANSLATE:
@@ -155,6 +459,8 @@ def translate_assessment_item_text(items: list, catalog: Catalog):
 
     Assessment item translations are considered essential, and thus
     if they're found missing will make that exercise as unavailable.
+
+    The items are translated in place.
     """
 
     # TODO (aronasorman): implement tests
@@ -167,8 +473,6 @@ def translate_assessment_item_text(items: list, catalog: Catalog):
         return trans
 
     for item in items:
-        item = copy.copy(item)
-
         item_data = ujson.loads(item["item_data"])
         try:
             translated_item_data = smart_translate_item_data(item_data, gettext)
@@ -213,30 +517,23 @@ def smart_translate_item_data(item_data: dict, gettext):
 
 
 def remove_untranslated_exercises(nodes, html_ids, translated_assessment_data):
-    item_data_ids = set([item.get("id") for item in translated_assessment_data])
+    item_data_ids = set(item.get("id") for item in translated_assessment_data)
     html_ids = set(html_ids)
 
-    def is_translated_exercise(ex):
-
-        ex_id = ex["id"]
-        if ex_id in html_ids:  # translated html exercise
-            return True
-        elif ex["uses_assessment_items"]:
-            for item_data in ex["all_assessment_items"]:
-                assessment_id = item_data["id"]
-                if assessment_id in item_data_ids:
-                    continue
-                else:
-                    return False
+    def is_translated_exercise(node):
+        if node["id"] in html_ids:
             return True
+        if not node.get("uses_assessment_items"):
+            return False
+        # an assessment exercise is translated only if all of its items are
+        for item in node.get("all_assessment_items") or []:
+            if item["id"] not in item_data_ids:
+                return False
+        return True
 
     for node in nodes:
-        if node["kind"] != NodeType.exercise:
-            yield node
-        elif is_translated_exercise(node):
+        if node["kind"] != NodeType.exercise or is_translated_exercise(node):
             yield node
-        else:
-            continue
 
 
 def remove_unavailable_topics(nodes):
@@ -268,16 +565,36 @@ def remove_unavailable_topics(nodes):
     return node_list
 
 
-def bundle_language_pack(dest, nodes, frontend_catalog, backend_catalog, metadata, assessment_items, assessment_files, subtitles, html_exercise_path):
+def bundle_language_pack(dest, nodes, frontend_catalog, backend_catalog, metadata, assessment_items, assessment_files, subtitles, html_exercise_path,
+                         db_path=None, compress_assessment_items=False, outputs=None, mappable_db=False):
+    """
+    Write the language pack to dest. If db_path is given, the content
+    database is built on top of that sqlite file, e.g. one that
+    insert_assessment_items has already filled. If compress_assessment_items
+    is True, the item_data is stored compressed (see contentdb.decode_item_data).
+
+    outputs maps names of OUTPUT_PROFILES to the paths to write those packs
+    to, alongside dest, in the same pass. Every pack gets an index for range
+    requests next to it (see ziputils.write_pack_index), hashed as it's written.
+
+    If mappable_db is True, content.db is stored uncompressed at the start of
+    the pack, aligned to a database page, and its offset and size are
+    recorded in the metadata as content_db_offset and content_db_size (see
+    contentdb.map_content_db).
+    """
+    outputs = outputs or {}
 
     # make sure dest's parent directories exist
-    pathlib.Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    for path in [dest] + list(outputs.values()):
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
 
-    with zipfile.ZipFile(dest, "w") as zf, tempfile.NamedTemporaryFile() as dbf:
-        db = SqliteDatabase(dbf.name)
+    output_renames = [(path, OUTPUT_PROFILES[profile]) for profile, path in sorted(outputs.items())]
+
+    with FanOutZipFile(dest, output_renames, index=True) as zf, tempfile.NamedTemporaryFile() as dbf:
+        db = SqliteDatabase(db_path or dbf.name)
         db.connect()
 
-        nodes = convert_dicts_to_models(nodes)
+        nodes = convert_dicts_to_models(nodes, metadata.get("pack_format_version", PACK_FORMAT_VERSION))
         nodes = mark_exercises_as_available(nodes)
         nodes = list(save_models(nodes, db)) # we have to make sure to force
                                              # the evaluation of each
@@ -285,9 +602,12 @@ def bundle_language_pack(dest, nodes, frontend_catalog, backend_catalog, metadat
                                              # avoid nesting them.
         nodes = list(populate_parent_foreign_keys(nodes))
         list(save_models(nodes, db))
+        save_item_closure(nodes, db)
+        save_exercise_assessment_items(nodes, db)
+        save_item_edges(nodes, db)
 
-        nodes = recurse_availability_up_tree(nodes, db)
-        list(save_models(nodes, db))
+        list(save_models(roll_up_availability(nodes), db))
+        save_topic_listings(nodes, db)
 
         assessment_items = convert_dicts_to_assessment_items(assessment_items)
         list(save_assessment_items(assessment_items, db))
@@ -295,8 +615,30 @@ def bundle_language_pack(dest, nodes, frontend_catalog, backend_catalog, metadat
         db.close()
         dbf.flush()
 
+        search_report = build_search_index(db.database, metadata.get("code") or "en")
+        logging.info("Built the search index in {build_time}s, adding {size} bytes.".format(**search_report))
+
+        if compress_assessment_items:
+            compression_report = compress_assessment_items_in_db(db.database)
+            logging.info("Compressed {item_count} assessment items from {raw_size} to {compressed_size} bytes.".format(
+                **compression_report) if compression_report else "No assessment items to compress.")
+            metadata = dict(metadata, assessment_item_compression=compression_report)
+
+        db_report = finalize_content_db(db.database)
+        logging.info("content.db is {size} bytes, query latencies (ms): {query_latency_ms}".format(**db_report))
+        metadata = dict(metadata, content_db=db_report, search_index=search_report)
+
+        if mappable_db:
+            # first, so that its offset is known by the time the metadata is written
+            offset = zf.write_aligned(db.database, "content.db", CONTENT_DB_PAGE_SIZE)
+            metadata = dict(metadata, content_db_offset=offset, content_db_size=os.path.getsize(db.database))
+
+        # the small entries most clients need come first, so they can be fetched with a single range request
+        save_metadata(zf, metadata)
         save_catalog(frontend_catalog, zf, "frontend.mo")
         save_catalog(backend_catalog, zf, "backend.mo")
+        if not mappable_db:
+            save_db(db, zf)
         # save_subtitles(subtitle_path, zf)
 
         try:                    # sometimes we have no html exercises
@@ -304,10 +646,6 @@ def bundle_language_pack(dest, nodes, frontend_catalog, backend_catalog, metadat
         except FileNotFoundError:
             logging.warning("No html exercises found; skipping.")
 
-        save_db(db, zf)
-
-        save_metadata(zf, metadata)
-
         for file_path in assessment_files:
             save_assessment_file(file_path, zf)
         write_assessment_version(metadata, zf)
@@ -318,6 +656,27 @@ def bundle_language_pack(dest, nodes, frontend_catalog, backend_catalog, metadat
     return dest
 
 
+def get_minimal_pack_name(name: str) -> str:
+    return name if name.rsplit("/", 1)[-1] in MINIMAL_PACK_ITEMS else None
+
+
+def get_khan_assessment_name(name: str) -> str:
+    """
+    khan_assessment.zip, for KA Lite 0.15.x and below, has the assessment
+    resources at its root, without the leading khan/.
+    """
+    if name.startswith(ASSESSMENT_RESOURCES_ZIP_FOLDER) and name != ASSESSMENT_RESOURCES_ZIP_FOLDER:
+        return name[len(ASSESSMENT_RESOURCES_ZIP_FOLDER):]
+    return None
+
+
+# The packs that can be derived from a full language pack, and the name each of its entries gets in them, if any.
+OUTPUT_PROFILES = {
+    "minimal": get_minimal_pack_name,
+    "khan_assessment": get_khan_assessment_name,
+}
+
+
 def write_assessment_version(metadata: dict, zf):
     lang = metadata.get("code") or "en"
     if lang != "en":            # Don't write the assessment version for non-en lang packs
@@ -351,7 +710,17 @@ def save_subtitle(path: str, zf: zipfile.ZipFile):
     zf.write(str(path), str(zip_subtitle_path))
 
 
-def convert_dicts_to_models(nodes):
+def convert_dicts_to_models(nodes, format_version: int=PACK_FORMAT_VERSION):
+    """
+    Turn the nodes into Items. A node with extra_placements becomes one Item
+    for each place it appears in the topic tree, all sharing the same fields
+    apart from their path, slug and sort_order. Packs before format 2 also
+    keep the LEGACY_EXTRA_FIELDS in extra_fields.
+    """
+    present_fields = set(Item._meta.get_field_names()) | set(ITEM_EDGE_FIELDS)
+    if format_version < 2:
+        present_fields -= set(LEGACY_EXTRA_FIELDS)
+
     def _make_extra_fields_value(present_fields, node_dict):
         """
         Generate the JSON string that goes into an item's extra_fields value.
@@ -366,7 +735,7 @@ def convert_dicts_to_models(nodes):
 
         return ujson.dumps(extra_fields)
 
-    def convert_dict_to_model(node):
+    def convert_dict_to_model(node, extra_fields=None):
         item = Item(**node)
 
         item.__dict__.update(**node)
@@ -376,14 +745,22 @@ def convert_dicts_to_models(nodes):
         # make sure description is a string, not None
         item.description = item.description or ""
 
-        item.extra_fields = _make_extra_fields_value(
-            item._meta.get_field_names(),
-            node
-        )
+        item.extra_fields = extra_fields or _make_extra_fields_value(present_fields, node)
 
         return item
 
-    yield from (convert_dict_to_model(node) for node in nodes)
+    for node in nodes:
+        placements = node.get("extra_placements")
+        if not placements:
+            yield convert_dict_to_model(node)
+            continue
+
+        node = {key: value for key, value in node.items() if key != "extra_placements"}
+        item = convert_dict_to_model(node)
+        yield item
+        # the placements only differ in their columns, so they can all share the same extra_fields
+        for placement in placements:
+            yield convert_dict_to_model(dict(node, **placement), item.extra_fields)
 
 
 def mark_exercises_as_available(nodes):
@@ -436,6 +813,153 @@ def save_assessment_items(assessment_items, db):
             yield item
 
 
+def insert_assessment_items(assessment_items, db, batch_size=ASSESSMENT_ITEM_BATCH_SIZE) -> int:
+    """
+    Insert the assessment item dicts into the db as they come, a batch per
+    transaction. Returns how many were inserted.
+    """
+    assessment_items = iter(assessment_items)
+    count = 0
+
+    db.create_table(AssessmentItem, safe=True)
+    with Using(db, [AssessmentItem]):
+        while True:
+            batch = [AssessmentItem(**item)._data for item in itertools.islice(assessment_items, batch_size)]
+            if not batch:
+                break
+            with db.transaction():
+                AssessmentItem.insert_many(batch).execute()
+            count += len(batch)
+
+    return count
+
+
+def generate_item_closure(nodes) -> iter:
+    """
+    Yield an ItemClosure row for each saved item and each of its ancestors,
+    itself included. The ancestors come straight from the item's path.
+    """
+    pks = {node.path: node.pk for node in nodes}
+
+    for node in nodes:
+        path, depth = node.path, 0
+        while path:
+            if path in pks:
+                yield {"ancestor": pks[path], "descendant": node.pk, "depth": depth}
+            path, depth = get_parent_path(path), depth + 1
+
+
+def save_item_closure(nodes, db, batch_size=ITEM_CLOSURE_BATCH_SIZE) -> int:
+    """
+    Save the closure table of the saved items in nodes into the db.
+    """
+    return _insert_rows(ItemClosure, generate_item_closure(nodes), db, batch_size)
+
+
+def generate_exercise_assessment_items(nodes) -> iter:
+    """
+    Yield an ExerciseAssessmentItem row for each assessment item of each
+    exercise, keeping the order of its all_assessment_items. Exercises that
+    appear in several places in the topic tree are only listed once.
+    """
+    seen = set()
+    for node in nodes:
+        if node.kind != NodeType.exercise or node.id in seen:
+            continue
+        seen.add(node.id)
+        for sort_order, assessment_item in enumerate(getattr(node, "all_assessment_items", None) or []):
+            yield {"exercise_id": node.id, "assessment_item_id": assessment_item["id"], "sort_order": sort_order}
+
+
+def save_exercise_assessment_items(nodes, db, batch_size=EXERCISE_ASSESSMENT_ITEM_BATCH_SIZE) -> int:
+    """
+    Save the exercise to assessment item mapping of the items in nodes into
+    the db.
+    """
+    return _insert_rows(ExerciseAssessmentItem, generate_exercise_assessment_items(nodes), db, batch_size)
+
+
+def generate_item_edges(nodes, field: str, column: str) -> iter:
+    """
+    Yield a row for each id in the field list of each item, keeping its
+    order, with the id in column. Items that appear in several places in
+    the topic tree are only listed once.
+    """
+    seen = set()
+    for node in nodes:
+        if node.id in seen:
+            continue
+        seen.add(node.id)
+        for sort_order, target_id in enumerate(getattr(node, field, None) or []):
+            yield {"item_id": node.id, column: target_id, "sort_order": sort_order}
+
+
+def save_item_edges(nodes, db, batch_size=ITEM_EDGE_BATCH_SIZE) -> dict:
+    """
+    Save each of the ITEM_EDGE_FIELDS of the items in nodes into its edge
+    table. Returns the number of rows saved for each field.
+    """
+    return {field: _insert_rows(model, generate_item_edges(nodes, field, column), db, batch_size)
+            for field, (model, column) in ITEM_EDGE_FIELDS.items()}
+
+
+def generate_topic_listings(nodes) -> iter:
+    """
+    Yield a TopicListing row for each topic in nodes. Its listing is JSON
+    like this, with the children sorted by their sort_order:
+
+        {"fields": TOPIC_LISTING_CHILD_FIELDS,
+         "children": [[<one value per field>], ...],
+         "kinds": {"Video": 3, ...},
+         "available": true, "total_files": 3, "size_on_disk": 0, "remote_size": 1234}
+
+    Run it after roll_up_availability, so that the totals are final.
+    """
+    children = collections.defaultdict(list)
+    for node in nodes:
+        children[get_parent_path(node.path)].append(node)
+
+    for node in nodes:
+        if node.kind != NodeType.topic:
+            continue
+        topic_children = sorted(children.get(node.path, []), key=lambda child: child.sort_order)
+        listing = {field: getattr(node, field) for field in TOPIC_LISTING_TOTAL_FIELDS}
+        listing.update(
+            fields=TOPIC_LISTING_CHILD_FIELDS,
+            children=[[getattr(child, field) for field in TOPIC_LISTING_CHILD_FIELDS] for child in topic_children],
+            kinds=collections.Counter(child.kind for child in topic_children),
+        )
+        yield {"path": node.path, "listing": ujson.dumps(listing)}
+
+
+def save_topic_listings(nodes, db, batch_size=TOPIC_LISTING_BATCH_SIZE) -> int:
+    """
+    Save the TopicListing of every topic in nodes into the db.
+    """
+    return _insert_rows(TopicListing, generate_topic_listings(nodes), db, batch_size)
+
+
+def _insert_rows(model, rows, db, batch_size) -> int:
+    """
+    Create model's table if needed, and insert rows into it batch_size at a
+    time, in a single transaction. Returns the number of rows inserted.
+    """
+    count = 0
+
+    with Using(db, [model]):
+        # unlike db.create_table, this creates the model's indexes too
+        model.create_table(fail_silently=True)
+        with db.transaction():
+            while True:
+                batch = list(itertools.islice(rows, batch_size))
+                if not batch:
+                    break
+                model.insert_many(batch).execute()
+                count += len(batch)
+
+    return count
+
+
 def save_catalog(catalog: dict, zf: zipfile.ZipFile, name: str):
     mofile = polib.MOFile()
     for msgid, msgstr in catalog.items():
@@ -480,15 +1004,12 @@ def save_assessment_file(assessment_file, zf):
 def separate_exercise_types(node_data):
     node_data = list(node_data)
 
-    def _is_html_exercise(node):
-        return node["kind"] == NodeType.exercise and not node["uses_assessment_items"]
-
-    def _is_assessment_exercise(node):
-        return node["kind"] == NodeType.exercise and node["uses_assessment_items"]
+    html_ids, assessment_ids = [], []
+    for node in node_data:
+        if node["kind"] == NodeType.exercise:
+            (assessment_ids if node.get("uses_assessment_items") else html_ids).append(node["id"])
 
-    return (n['id'] for n in node_data if _is_html_exercise(n)), \
-           (n['id'] for n in node_data if _is_assessment_exercise(n)), \
-           node_data
+    return iter(html_ids), iter(assessment_ids), node_data
 
 
 def generate_kalite_language_pack_metadata(lang: str, version: str, interface_catalog: Catalog,
@@ -504,6 +1025,7 @@ def generate_kalite_language_pack_metadata(lang: str, version: str, interface_ca
         "code": lang,
         'software_version': version,
         'language_pack_version': int(os.environ.get("CONTENT_PACK_VERSION") or "1"),
+        'pack_format_version': int(os.environ.get("CONTENT_PACK_FORMAT_VERSION") or PACK_FORMAT_VERSION),
         'percent_translated': interface_catalog.percent_translated,
         'topic_tree_translated': content_catalog.percent_translated,
         'subtitle_count': len(subtitles),
@@ -516,8 +1038,13 @@ def generate_kalite_language_pack_metadata(lang: str, version: str, interface_ca
     return metadata
 
 
+@lru_cache(maxsize=None)
+def get_language_lookup() -> dict:
+    return ujson.loads(LANGUAGELOOKUP_DATA)
+
+
 def get_lang_name(lang):
-    langlookup = ujson.loads(LANGUAGELOOKUP_DATA)
+    langlookup = get_language_lookup()
 
     try:
         return langlookup[lang]["name"]
@@ -527,7 +1054,7 @@ def get_lang_name(lang):
 
 
 def get_lang_native_name(lang):
-    langlookup = ujson.loads(LANGUAGELOOKUP_DATA)
+    langlookup = get_language_lookup()
 
     try:
         return langlookup[lang]["native_name"]
@@ -542,56 +1069,29 @@ def save_metadata(zf, metadata):
     zf.writestr(metadata_name, dump)
 
 
-def recurse_availability_up_tree(nodes, db) -> [Item]:
+def roll_up_availability(nodes) -> [Item]:
+    """
+    Set the availability and sizes of each topic from its descendants, for
+    the whole tree at once, without any queries. Returns the nodes whose
+    values changed.
+    """
 
     logging.info("Marking availability.")
 
     nodes = list(nodes)
+    table = NodeTable(nodes, get=get_attribute)
+    columns = table.roll_up()
 
-    def _recurse_availability_up_tree(node):
-
-        available = node.available
-        if not node.parent:
-            return node
-        else:
-            parent = node.parent
-        Parent = Item.alias()
-        children = Item.select().join(Parent, on=(Item.parent == Parent.pk)).where(Item.parent == parent.pk)
-        if not available:
-            children_available = children.where(Item.available == True).count() > 0
-            available = children_available
-
-        total_files = children.aggregate(fn.SUM(Item.total_files))
-
-        child_remote = children.where(((Item.available == False) & (Item.kind != "Topic")) | (Item.kind == "Topic")).aggregate(fn.SUM(Item.remote_size))
-        child_on_disk = children.aggregate(fn.SUM(Item.size_on_disk))
-
-        if parent.available != available:
-            parent.available = available
-        if parent.total_files != total_files:
-            parent.total_files = total_files
-        # Ensure that the aggregate sizes are not None
-        if parent.remote_size != child_remote and child_remote:
-            parent.remote_size = child_remote
-        # Ensure that the aggregate sizes are not None
-        if parent.size_on_disk != child_on_disk and child_on_disk:
-            parent.size_on_disk = child_on_disk
-        if parent.is_dirty():
-            parent.save()
-            _recurse_availability_up_tree(parent)
-
-        return node
+    changed = np.zeros(len(nodes), dtype=bool)
+    for field, values in columns.items():
+        changed |= getattr(table, field) != values
 
-    with Using(db, [Item]):
-        # at this point, the only thing that can affect a topic's availability
-        # are exercises. Videos and other content's availability can only be
-        # determined by what's in the client. However, we need to set total_files
-        # and remote_sizes. So, loop over exercises and other content,
-        # and skip topics as they will be recursed upwards.
-        for node in (n for n in nodes if n.kind != NodeType.topic):
-            _recurse_availability_up_tree(node)
+    for row in np.flatnonzero(changed):
+        node = nodes[row]
+        for field, values in columns.items():
+            setattr(node, field, values[row].item())
 
-    return nodes
+    return [nodes[row] for row in np.flatnonzero(changed)]
 
 
 def is_video_node_dubbed(video_node: dict, expected_lang: str) -> bool:
@@ -645,19 +1145,7 @@ def remove_nonexistent_assessment_items_from_exercises(node_data: list, assessme
     assessment_ids = set(assessment["id"] for assessment in assessment_data)
 
     for node in node_data:
-        if node["kind"] != NodeType.exercise:
-            yield node
-        else:
-            # import pdb; pdb.set_trace()
-            try:
-                assessment_items = node["all_assessment_items"]
-                new_assessment_items = []
-                for item in assessment_items:
-                    ass_id = item["id"]
-                    if ass_id in assessment_ids:
-                        new_assessment_items.append(item)
-                node["all_assessment_items"] = new_assessment_items
-                yield node
-            except Exception as e:
-                import pdb; pdb.set_trace()
-                print(1)
+        if node["kind"] == NodeType.exercise and node.get("all_assessment_items"):
+            node["all_assessment_items"] = [item for item in node["all_assessment_items"]
+                                            if item["id"] in assessment_ids]
+        yield node
@@ -0,0 +1,118 @@
+"""
+An in-memory cache of parsed build inputs, for long-running processes.
+
+A normal build parses nodes.json, en_nodes.json, the dubbed video mappings
+and the CrowdIn catalogs once and exits. The build daemon runs many builds in
+one process, so it turns WARM_CACHE on, and load_cached then hands out the
+objects parsed by an earlier build for as long as the files they were parsed
+from have the same contents.
+
+WARM_CACHE is off (max_size 0) by default, in which case load_cached just
+calls the loader.
+
+The cache is bounded by the sizes of the source files, not of the parsed
+objects, which aren't cheap to measure. Those can be several times bigger,
+and more so for the catalogs, whose source files are compressed zips.
+"""
+import collections
+import logging
+import os
+import threading
+
+from contentpacks.utils import hash_file
+
+
+class WarmCache:
+    """
+    A least recently used cache, bounded by the total size of its entries.
+    Each entry's size is given when it's loaded; load_cached uses the size
+    of the file the value was parsed from, as it is on disk.
+    """
+
+    def __init__(self, max_size: int=0):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, loader, size: int):
+        """
+        Return the value cached under key, or load, cache and return it.
+        Values too big for the cache are returned without being cached.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = loader()
+
+        with self.lock:
+            if size <= self.max_size and key not in self.entries:
+                self.entries[key] = (value, size)
+                self.size += size
+                self._evict()
+        return value
+
+    def resize(self, max_size: int):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _evict(self):
+        while self.size > self.max_size:
+            key, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            logging.debug("Evicted {} from the warm cache.".format(key))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "size": self.size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+WARM_CACHE = WarmCache()
+
+# the size, modification time and digest of each file hashed, so an unchanged file isn't hashed again
+_digests = {}
+
+
+def get_file_digest(path: str) -> str:
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if _digests.get(path, (None,))[:2] != stamp:
+        _digests[path] = stamp + (hash_file(path),)
+    return _digests[path][2]
+
+
+def load_cached(path: str, loader, key=None):
+    """
+    Return loader(path), reusing the value from WARM_CACHE if the file at
+    path had the same contents when it was loaded before. key tells apart
+    loaders that parse the same file differently. Callers share the cached
+    value, so they must not modify it.
+
+    Files are recognized by their contents rather than their modification
+    time, since most are downloaded again by every build.
+    """
+    if not WARM_CACHE.max_size:
+        return loader(path)
+
+    cache_key = (key or getattr(loader, "__name__", repr(loader)), get_file_digest(path))
+    return WARM_CACHE.get(cache_key, lambda: loader(path), os.path.getsize(path))
@@ -0,0 +1,383 @@
+"""
+Copy entries between zip files without recompressing them.
+
+ZipFile.read followed by ZipFile.writestr inflates every entry into memory
+and deflates it again. copy_entries instead copies each entry's compressed
+bytes verbatim, writing a fresh local header for it (under a new name, if
+asked to) and letting the destination ZipFile write the central directory
+when it's closed, so deriving one pack from another is bound by I/O alone.
+"""
+import hashlib
+import os
+import shutil
+import struct
+import time
+import zipfile
+import zlib
+
+import requests
+import ujson
+
+ZIP_COPY_CHUNK_SIZE = 1024 * 1024
+
+PACK_INDEX_SUFFIX = ".index.json"
+
+# Ranges closer together than this are fetched with a single request, gap included.
+RANGE_MERGE_GAP = 64 * 1024
+
+# general purpose flag bits
+_ENCRYPTED = 0x01
+_DATA_DESCRIPTOR = 0x08
+
+_ZIP64_EXTRA_ID = 0x0001
+
+# the extra field Android's zipalign pads local headers with: the alignment, then the padding
+_ALIGNMENT_EXTRA_ID = 0xd935
+
+
+class _LimitedReader:
+    """
+    A file-like object reading at most size bytes from fp, and adding them to
+    the hash sha if one is given.
+    """
+
+    def __init__(self, fp, size: int, sha=None):
+        self.fp = fp
+        self.remaining = size
+        self.sha = sha
+
+    def read(self, n: int=-1) -> bytes:
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        data = self.fp.read(n)
+        if len(data) < n:
+            raise zipfile.BadZipFile("Unexpected end of file while copying an entry's data")
+        self.remaining -= len(data)
+        if self.sha:
+            self.sha.update(data)
+        return data
+
+
+def strip_zip64_extra(extra: bytes) -> bytes:
+    """
+    Remove the zip64 field from an entry's extra data. ZipFile adds a new
+    one where the destination needs it, based on the entry's final sizes and
+    offset.
+    """
+    fields = []
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, size = struct.unpack("<HH", extra[i:i + 4])
+        if field_id != _ZIP64_EXTRA_ID:
+            fields.append(extra[i:i + 4 + size])
+        i += 4 + size
+    return b"".join(fields)
+
+
+def get_data_offset(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    """
+    Return where info's compressed data starts in zf's file, right after its
+    local header.
+    """
+    zf.fp.seek(info.header_offset)
+    header = zf.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad local file header for {}".format(info.filename))
+    # the header ends with the lengths of the name and extra field that follow it
+    name_length, extra_length = struct.unpack(zipfile.structFileHeader, header)[-2:]
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
+def copy_entry(src: zipfile.ZipFile, dest: zipfile.ZipFile, info: zipfile.ZipInfo, name: str=None,
+               sha=None) -> zipfile.ZipInfo:
+    """
+    Copy the entry info of src into dest, under name if it's given,
+    keeping its compression, CRC and timestamps. The compressed data is
+    added to the hash sha, if one is given, as it's copied. Returns the new
+    entry.
+    """
+    if info.flag_bits & _ENCRYPTED:
+        raise ValueError("Can't copy {}: encrypted entries aren't supported".format(info.filename))
+    if dest.mode not in ("w", "x", "a"):
+        raise ValueError("Can't copy into a zip file opened for reading")
+
+    new_info = zipfile.ZipInfo(name or info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.comment = info.comment
+    new_info.create_system = info.create_system
+    new_info.create_version = info.create_version
+    new_info.extract_version = info.extract_version
+    new_info.external_attr = info.external_attr
+    new_info.internal_attr = info.internal_attr
+    new_info.extra = strip_zip64_extra(info.extra)
+    # the sizes and CRC go into the new local header, so there's no data descriptor after the data
+    new_info.flag_bits = info.flag_bits & ~_DATA_DESCRIPTOR
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+
+    data_offset = get_data_offset(src, info)
+
+    dest.fp.seek(dest.start_dir)
+    new_info.header_offset = dest.fp.tell()
+    dest.fp.write(new_info.FileHeader())
+    src.fp.seek(data_offset)
+    shutil.copyfileobj(_LimitedReader(src.fp, info.compress_size, sha), dest.fp, ZIP_COPY_CHUNK_SIZE)
+    dest.start_dir = dest.fp.tell()
+
+    dest.filelist.append(new_info)
+    dest.NameToInfo[new_info.filename] = new_info
+    dest._didModify = True
+
+    return new_info
+
+
+def copy_entries(src: zipfile.ZipFile, dest: zipfile.ZipFile, names) -> int:
+    """
+    Copy entries from src into dest, in src's order. names is either an
+    iterable of entry names to copy as they are, or a dict of entry names
+    to the names to give them in dest. Returns the number of bytes copied.
+    """
+    renames = names if isinstance(names, dict) else {name: name for name in names}
+
+    copied = 0
+    for info in src.infolist():
+        if info.filename in renames:
+            copy_entry(src, dest, info, renames[info.filename])
+            copied += info.compress_size
+
+    return copied
+
+
+def write_aligned(zf: zipfile.ZipFile, filename: str, arcname: str, alignment: int, sha=None) -> int:
+    """
+    Store the file filename in zf uncompressed, padding its local header so
+    that its data starts at a multiple of alignment, where it can be
+    memory-mapped straight out of the zip file. The data is added to the
+    hash sha, if one is given. Returns that offset.
+    """
+    if zf.mode not in ("w", "x", "a"):
+        raise ValueError("Can't write into a zip file opened for reading")
+
+    stat = os.stat(filename)
+    info = zipfile.ZipInfo(arcname, time.localtime(stat.st_mtime)[:6])
+    info.compress_type = zipfile.ZIP_STORED
+    info.external_attr = (stat.st_mode & 0xFFFF) << 16
+    info.file_size = info.compress_size = stat.st_size
+    info.CRC = 0
+
+    # FileHeader adds a zip64 field of its own for big files, so measure the header it writes
+    info.extra = struct.pack("<HHH", _ALIGNMENT_EXTRA_ID, 2, alignment)
+    data_offset = zf.start_dir + len(info.FileHeader())
+    padding = -data_offset % alignment
+    info.extra = struct.pack("<HHH", _ALIGNMENT_EXTRA_ID, 2 + padding, alignment) + bytes(padding)
+
+    zf.fp.seek(zf.start_dir)
+    info.header_offset = zf.fp.tell()
+    zf.fp.write(info.FileHeader())
+    with open(filename, "rb") as src:
+        for chunk in iter(lambda: src.read(ZIP_COPY_CHUNK_SIZE), b""):
+            info.CRC = zlib.crc32(chunk, info.CRC)
+            if sha:
+                sha.update(chunk)
+            zf.fp.write(chunk)
+    zf.start_dir = zf.fp.tell()
+
+    # the CRC is only known now; the header stays the same size, so it can be written over
+    zf.fp.seek(info.header_offset)
+    zf.fp.write(info.FileHeader())
+    zf.fp.seek(zf.start_dir)
+
+    # the padding is only needed in the local header, not in the central directory
+    info.extra = struct.pack("<HHH", _ALIGNMENT_EXTRA_ID, 2, alignment)
+
+    zf.filelist.append(info)
+    zf.NameToInfo[info.filename] = info
+    zf._didModify = True
+
+    return data_offset + padding
+
+
+class FanOutZipFile:
+    """
+    A zip file written to several outputs at once. Everything goes into the
+    primary zip file at path, and each entry is then copied, still
+    compressed, into every other output whose rename function gives it a
+    name; entries it returns None for are left out of that output.
+
+    If index is True, each entry is hashed as it's copied, and every output
+    gets its pack index (see write_pack_index) when it's closed.
+
+    Supports the write and writestr methods of ZipFile.
+    """
+
+    def __init__(self, path: str, outputs: list=(), compression: int=zipfile.ZIP_STORED, index: bool=False):
+        self.primary = zipfile.ZipFile(path, "w", compression)
+        self.outputs = [(zipfile.ZipFile(output_path, "w", compression), rename) for output_path, rename in outputs]
+        self.index = index
+        self.index_entries = {zf.filename: [] for zf in self._zip_files()}
+
+    def write(self, filename: str, arcname: str=None):
+        self.primary.write(filename, arcname)
+        self._fan_out()
+
+    def writestr(self, arcname: str, data):
+        self.primary.writestr(arcname, data)
+        self._fan_out()
+
+    def write_aligned(self, filename: str, arcname: str, alignment: int) -> int:
+        """
+        Like write_aligned, for every output that wants the file. The
+        offset is only the same in all of them if they're written to in the
+        same order, so it's the primary's that's returned.
+        """
+        sha = hashlib.sha256() if self.index else None
+        offset = write_aligned(self.primary, filename, arcname, alignment, sha)
+        written = [self.primary]
+        for zf, rename in self.outputs:
+            name = rename(arcname)
+            if name:
+                write_aligned(zf, filename, name, alignment)
+                written.append(zf)
+        self._add_to_indexes(written, sha)
+        return offset
+
+    def _fan_out(self):
+        info = self.primary.filelist[-1]
+        sha = hashlib.sha256() if self.index else None
+        written = [self.primary]
+        for zf, rename in self.outputs:
+            name = rename(info.filename)
+            if name:
+                # the copies are all the same, so only the first needs hashing
+                copy_entry(self.primary, zf, info, name, None if len(written) > 1 else sha)
+                written.append(zf)
+
+        if sha and len(written) == 1:
+            self.primary.fp.seek(get_data_offset(self.primary, info))
+            reader = _LimitedReader(self.primary.fp, info.compress_size, sha)
+            while reader.read(ZIP_COPY_CHUNK_SIZE):
+                pass
+        self._add_to_indexes(written, sha)
+
+    def _add_to_indexes(self, written: list, sha):
+        if sha:
+            for zf in written:
+                self.index_entries[zf.filename].append(_get_index_entry(zf, zf.filelist[-1], sha.hexdigest()))
+
+    def _zip_files(self) -> list:
+        return [self.primary] + [zf for zf, _ in self.outputs]
+
+    def close(self):
+        for zf, _ in self.outputs:
+            zf.close()
+        self.primary.close()
+        if self.index:
+            for zf in self._zip_files():
+                write_pack_index(zf.filename, self.index_entries[zf.filename])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_pack_index_path(path: str) -> str:
+    return path + PACK_INDEX_SUFFIX
+
+
+def _get_index_entry(zf: zipfile.ZipFile, info: zipfile.ZipInfo, sha256: str) -> dict:
+    return {
+        "name": info.filename,
+        "offset": get_data_offset(zf, info),
+        "size": info.compress_size,
+        "file_size": info.file_size,
+        "compress_type": info.compress_type,
+        "crc": info.CRC,
+        "sha256": sha256,
+    }
+
+
+def write_pack_index(path: str, entries: list=None) -> dict:
+    """
+    Write the sidecar index of the zip file at path: where each entry's data
+    is, how big it is and its SHA-256, so that clients can fetch any entry
+    with an HTTP Range request (see fetch_entries). entries are the index
+    entries collected while the zip file was written, if it was written by
+    a FanOutZipFile; otherwise each entry is read back and hashed. Returns
+    the index.
+    """
+    if entries is None:
+        entries = []
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                sha = hashlib.sha256()
+                zf.fp.seek(get_data_offset(zf, info))
+                reader = _LimitedReader(zf.fp, info.compress_size, sha)
+                while reader.read(ZIP_COPY_CHUNK_SIZE):
+                    pass
+                entries.append(_get_index_entry(zf, info, sha.hexdigest()))
+
+    index = {"entries": entries}
+    with open(get_pack_index_path(path), "w") as f:
+        ujson.dump(index, f)
+
+    return index
+
+
+def _merge_ranges(entries: list, gap: int=RANGE_MERGE_GAP) -> list:
+    """
+    Group entries sorted by offset into runs that can each be fetched with
+    one range request.
+    """
+    runs = []
+    for entry in sorted(entries, key=lambda entry: entry["offset"]):
+        if runs and entry["offset"] - runs[-1][-1]["offset"] - runs[-1][-1]["size"] <= gap:
+            runs[-1].append(entry)
+        else:
+            runs.append([entry])
+    return runs
+
+
+def _decode_entry(entry: dict, data: bytes) -> bytes:
+    if hashlib.sha256(data).hexdigest() != entry["sha256"]:
+        raise zipfile.BadZipFile("Checksum mismatch for {}".format(entry["name"]))
+    if entry["compress_type"] == zipfile.ZIP_DEFLATED:
+        return zlib.decompress(data, -zlib.MAX_WBITS)
+    if entry["compress_type"] != zipfile.ZIP_STORED:
+        raise zipfile.BadZipFile("Can't decode {}: unsupported compression type {}".format(
+            entry["name"], entry["compress_type"]))
+    return data
+
+
+def fetch_entries(url: str, names, session: requests.Session=None, index: dict=None) -> dict:
+    """
+    The reference client for pack indexes: fetch just the entries named
+    from the zip file at url with HTTP Range requests, using the index
+    published next to it (or index, if given). Entries that are close
+    together share a request. Returns the entries' contents by name.
+    """
+    session = session or requests.Session()
+    if index is None:
+        r = session.get(get_pack_index_path(url))
+        r.raise_for_status()
+        index = r.json()
+
+    by_name = {entry["name"]: entry for entry in index["entries"]}
+    missing = set(names) - set(by_name)
+    if missing:
+        raise KeyError("Not in the pack: {}".format(", ".join(sorted(missing))))
+
+    contents = {}
+    for run in _merge_ranges([by_name[name] for name in set(names)]):
+        start, end = run[0]["offset"], run[-1]["offset"] + run[-1]["size"]
+        r = session.get(url, headers={"Range": "bytes={}-{}".format(start, end - 1)})
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise requests.exceptions.HTTPError("{} doesn't support range requests".format(url), response=r)
+        for entry in run:
+            offset = entry["offset"] - start
+            contents[entry["name"]] = _decode_entry(entry, r.content[offset:offset + entry["size"]])
+
+    return contents
@@ -13,28 +13,22 @@ import zipfile
 from docopt import docopt
 from pathlib import Path
 
-
-ASSESSMENT_FOLDER_IN_ZIP = "khan/"  # Note: this should just be imported from the contentpacks module
+from contentpacks.utils import get_khan_assessment_name
+from contentpacks.ziputils import copy_entries
 
 
 def extract_khan_assessment(contentpackpath: Path, outpath: Path):
     with zipfile.ZipFile(str(contentpackpath)) as cf,\
          zipfile.ZipFile(str(outpath), "w") as of:
 
-        items = list(i for i in cf.namelist()
-                     if ASSESSMENT_FOLDER_IN_ZIP in i)
+        # strip the leading khan/ from each item's path
+        items = {i: get_khan_assessment_name(i) for i in cf.namelist() if get_khan_assessment_name(i)}
 
         logging.info("Writing {} items to {}".format(
             len(items),
             outpath)
         )
-        for item in items:
-            bytes = cf.read(item)
-
-            # the relative_to call removes the leading khan/ in the item's path
-            new_item_name = Path(item).relative_to(ASSESSMENT_FOLDER_IN_ZIP)
-
-            of.writestr(str(new_item_name), bytes)
+        copy_entries(cf, of, items)
 
         logging.info("great success.")
 
@@ -10,25 +10,17 @@ import zipfile
 from pathlib import Path
 from docopt import docopt
 
-ITEMS_TO_TRANSFER = [
-    "metadata.json",
-    "content.db",
-    "backend.mo",
-    "frontend.mo",
-]
+from contentpacks.utils import get_minimal_pack_name
+from contentpacks.ziputils import copy_entries
 
 
 def minimize_content_pack(oldpackpath: Path, outpath: Path):
     with zipfile.ZipFile(str(oldpackpath)) as oldzf,\
          zipfile.ZipFile(str(outpath), "w") as newzf:
 
-        items = list(i for i in oldzf.namelist()
-                     for will_be_transferred in ITEMS_TO_TRANSFER
-                     if will_be_transferred in i)
+        items = [i for i in oldzf.namelist() if get_minimal_pack_name(i)]
 
-        for item in items:
-            bytes = oldzf.read(item)
-            newzf.writestr(item, bytes)
+        copy_entries(oldzf, newzf, items)
 
 
 def main():
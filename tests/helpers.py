@@ -20,3 +20,23 @@ def generate_node_list():
 def generate_catalog():
     catalog = retrieve_translations("khanacademy", "dummy", lang_code="es-ES", includes="*learn*.po", force=True)
     return catalog
+
+
+def generate_topic_tree(topic_count=50, children_per_topic=100, items_per_exercise=20):
+    """
+    Build a synthetic cleaned-up KA topic tree, where every exercise is
+    listed under two topics, like KA's cross-listed content.
+    """
+    exercise_count = topic_count * children_per_topic // 2
+    nodes = [{"id": "x00000000", "kind": "Topic", "slug": "root", "title": "Root",
+              "child_data": [{"id": "t{}".format(t)} for t in range(topic_count)]}]
+    for t in range(topic_count):
+        nodes.append({"id": "t{}".format(t), "kind": "Topic", "slug": "topic-{}".format(t), "title": "Topic {}".format(t),
+                      "child_data": [{"id": "e{}".format((t * children_per_topic + i) % exercise_count)}
+                                     for i in range(children_per_topic)]})
+    for e in range(exercise_count):
+        nodes.append({"id": "e{}".format(e), "kind": "Exercise", "slug": "exercise-{}".format(e),
+                      "title": "Exercise {}".format(e), "uses_assessment_items": True,
+                      "all_assessment_items": [{"id": "e{}-{}".format(e, i), "live": True}
+                                               for i in range(items_per_exercise)]})
+    return nodes
@@ -0,0 +1,44 @@
+import json
+import os
+import pathlib
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import collectmetadata
+from collectmetadata import collect_metadata
+
+
+def _make_pack(path, metadata, mtime):
+    with zipfile.ZipFile(str(path), "w") as zf:
+        zf.writestr("metadata.json", json.dumps(metadata))
+    os.utime(str(path), (mtime, mtime))
+
+
+class Test_collect_metadata:
+
+    def test_reuses_unchanged_packs_without_hashing_them(self, tmpdir, monkeypatch):
+        _make_pack(tmpdir.join("en.zip"), {"code": "en"}, 1000000000)
+        previous = {m["zip_name"]: m for m in collect_metadata(pathlib.Path(str(tmpdir)))}
+
+        def hash_file(path):
+            raise AssertionError("{} was hashed again".format(path))
+        monkeypatch.setattr(collectmetadata, "hash_file", hash_file)
+
+        all_metadata = collect_metadata(pathlib.Path(str(tmpdir)), previous)
+
+        assert all_metadata == [previous["en.zip"]]
+        assert all_metadata[0]["code"] == "en"
+
+    def test_hashes_changed_packs_again(self, tmpdir):
+        pack = tmpdir.join("en.zip")
+        _make_pack(pack, {"code": "en"}, 1000000000)
+        previous = {m["zip_name"]: m for m in collect_metadata(pathlib.Path(str(tmpdir)))}
+
+        _make_pack(pack, {"code": "en", "subtitle_count": 12}, 1000000060)
+        metadata, = collect_metadata(pathlib.Path(str(tmpdir)), previous)
+
+        assert metadata["subtitle_count"] == 12
+        assert metadata["zip_sha256"] != previous["en.zip"]["zip_sha256"]
+        assert metadata["zip_mtime"] == 1000000060
@@ -0,0 +1,285 @@
+import sqlite3
+import zipfile
+
+import ujson
+from peewee import SqliteDatabase, Using
+
+from contentpacks.contentdb import finalize_content_db, build_search_index, compress_assessment_items, \
+    decode_item_data, get_item_data_dictionary, map_content_db, BENCHMARK_QUERIES
+from contentpacks.models import Item, ItemClosure, ExerciseAssessmentItem, ItemPrerequisite, ItemRelatedVideo
+from contentpacks.utils import convert_dicts_to_models, save_models, populate_parent_foreign_keys, \
+    insert_assessment_items, save_item_closure, save_exercise_assessment_items, save_item_edges, save_topic_listings, \
+    roll_up_availability, bundle_language_pack, NodeType
+
+
+def _build_content_db(path):
+    nodes = [{"id": "khan", "kind": NodeType.topic, "title": "Khan", "slug": "khan", "path": "khan/"}]
+    nodes += [{"id": "v{}".format(i), "kind": NodeType.video, "title": "Video {}".format(i), "slug": "v{}".format(i),
+               "path": "khan/v{}/".format(i), "youtube_id": "yt{}".format(i)} for i in range(50)]
+    nodes += [{"id": "e1", "kind": NodeType.exercise, "title": "Exercise", "slug": "e1", "path": "khan/e1/",
+               "all_assessment_items": [{"id": "a1"}]}]
+
+    db = SqliteDatabase(path)
+    db.connect()
+    models = list(save_models(convert_dicts_to_models(nodes), db))
+    list(save_models(list(populate_parent_foreign_keys(models)), db))
+    save_exercise_assessment_items(models, db)
+    save_topic_listings(models, db)
+    insert_assessment_items([{"id": "a1", "item_data": "{}", "author_names": "[]"}], db)
+    db.close()
+
+
+class Test_finalize_content_db:
+
+    def test_indexes_vacuums_and_benchmarks(self, tmpdir):
+        path = str(tmpdir.join("content.db"))
+        _build_content_db(path)
+
+        report = finalize_content_db(path)
+
+        conn = sqlite3.connect(path)
+        indexes = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        assert {"item_path", "item_kind_parent_id", "item_youtube_id"} <= indexes
+        assert conn.execute("SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0] > 0
+        assert conn.execute("PRAGMA page_size").fetchone()[0] == report["page_size"] == 4096
+        plan = " ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN SELECT * FROM item WHERE youtube_id = 'yt3'"))
+        assert "item_youtube_id" in plan
+
+        assert report["size"] == tmpdir.join("content.db").size()
+        assert set(report["query_latency_ms"]) == set(BENCHMARK_QUERIES)
+
+    def test_allows_children_with_the_same_slug(self, tmpdir):
+        path = str(tmpdir.join("content.db"))
+        nodes = [{"id": "khan", "kind": NodeType.topic, "title": "Khan", "slug": "khan", "path": "khan/"}]
+        nodes += [{"id": id, "kind": NodeType.video, "title": "Intro", "slug": "intro", "path": "khan/intro/",
+                   "youtube_id": id} for id in ["yt1", "yt2"]]
+        db = SqliteDatabase(path)
+        db.connect()
+        models = list(save_models(convert_dicts_to_models(nodes), db))
+        models = list(populate_parent_foreign_keys(models))
+        list(save_models(models, db))
+        save_item_closure(models, db)
+        save_topic_listings(models, db)
+        db.close()
+
+        finalize_content_db(path)
+
+        conn = sqlite3.connect(path)
+        assert sorted(conn.execute("SELECT youtube_id FROM item WHERE path = 'khan/intro/'")) == [("yt1",), ("yt2",)]
+
+
+class Test_save_item_closure:
+
+    def test_links_items_to_all_their_ancestors(self, tmpdir):
+        nodes = [{"id": slug, "kind": kind, "title": slug, "slug": slug, "path": path} for slug, kind, path in [
+            ("khan", NodeType.topic, "khan/"),
+            ("math", NodeType.topic, "khan/math/"),
+            ("algebra", NodeType.topic, "khan/math/algebra/"),
+            ("v1", NodeType.video, "khan/math/algebra/v1/"),
+            ("e1", NodeType.exercise, "khan/math/e1/"),
+        ]]
+        db = SqliteDatabase(str(tmpdir.join("content.db")))
+        db.connect()
+        models = list(save_models(convert_dicts_to_models(nodes), db))
+
+        # every item, plus the depth of each one
+        assert save_item_closure(models, db) == 5 + (0 + 1 + 2 + 3 + 2)
+
+        with Using(db, [Item, ItemClosure]):
+            math = Item.get(Item.id == "math")
+            subtree = (Item.select().join(ItemClosure, on=(ItemClosure.descendant == Item.pk))
+                       .where(ItemClosure.ancestor == math.pk, ItemClosure.depth > 0))
+            assert sorted(item.id for item in subtree) == ["algebra", "e1", "v1"]
+
+            v1 = Item.get(Item.id == "v1")
+            ancestors = ItemClosure.select().where(ItemClosure.descendant == v1.pk).order_by(ItemClosure.depth)
+            assert [(link.ancestor.id, link.depth) for link in ancestors] == \
+                [("v1", 0), ("algebra", 1), ("math", 2), ("khan", 3)]
+
+
+class Test_save_exercise_assessment_items:
+
+    def test_maps_exercises_to_their_items_in_order(self, tmpdir):
+        exercise = {"id": "e1", "kind": NodeType.exercise, "title": "e1", "slug": "e1", "path": "khan/e1/",
+                    "all_assessment_items": [{"id": "a3"}, {"id": "a1"}, {"id": "a2"}],
+                    "extra_placements": [{"path": "khan/math/e1/", "slug": "e1", "sort_order": 1}]}
+        nodes = [
+            {"id": "khan", "kind": NodeType.topic, "title": "khan", "slug": "khan", "path": "khan/"},
+            {"id": "math", "kind": NodeType.topic, "title": "math", "slug": "math", "path": "khan/math/"},
+            exercise,
+            {"id": "e2", "kind": NodeType.exercise, "title": "e2", "slug": "e2", "path": "khan/e2/",
+             "all_assessment_items": [{"id": "a1"}]},
+        ]
+        db = SqliteDatabase(str(tmpdir.join("content.db")))
+        db.connect()
+        models = list(save_models(convert_dicts_to_models(nodes), db))
+
+        # e1 is only mapped once, even though it's in the tree twice
+        assert save_exercise_assessment_items(models, db) == 4
+
+        with Using(db, [ExerciseAssessmentItem]):
+            query = ExerciseAssessmentItem.select().where(ExerciseAssessmentItem.exercise_id == "e1")
+            assert [row.assessment_item_id for row in query.order_by(ExerciseAssessmentItem.sort_order)] == \
+                ["a3", "a1", "a2"]
+            query = ExerciseAssessmentItem.select().where(ExerciseAssessmentItem.assessment_item_id == "a1")
+            assert sorted(row.exercise_id for row in query) == ["e1", "e2"]
+
+        plan = " ".join(row[-1] for row in db.execute_sql(
+            "EXPLAIN QUERY PLAN SELECT exercise_id FROM exerciseassessmentitem WHERE assessment_item_id = 'a1'"))
+        assert "INDEX" in plan
+
+
+class Test_save_item_edges:
+
+    def test_saves_prerequisites_and_related_videos(self, tmpdir):
+        nodes = [
+            {"id": "e1", "kind": NodeType.exercise, "title": "e1", "slug": "e1", "path": "khan/e1/",
+             "prerequisites": ["e0"], "curated_related_videos": ["v2", "v1"]},
+            {"id": "e2", "kind": NodeType.exercise, "title": "e2", "slug": "e2", "path": "khan/e2/",
+             "prerequisites": ["e1", "e0"]},
+        ]
+        db = SqliteDatabase(str(tmpdir.join("content.db")))
+        db.connect()
+        models = list(save_models(convert_dicts_to_models(nodes), db))
+
+        assert save_item_edges(models, db) == {"prerequisites": 3, "curated_related_videos": 2}
+
+        with Using(db, [ItemPrerequisite, ItemRelatedVideo]):
+            query = ItemPrerequisite.select().where(ItemPrerequisite.item_id == "e2").order_by(ItemPrerequisite.sort_order)
+            assert [row.prerequisite_id for row in query] == ["e1", "e0"]
+            query = ItemPrerequisite.select().where(ItemPrerequisite.prerequisite_id == "e0")
+            assert sorted(row.item_id for row in query) == ["e1", "e2"]
+            query = ItemRelatedVideo.select().where(ItemRelatedVideo.item_id == "e1").order_by(ItemRelatedVideo.sort_order)
+            assert [row.video_id for row in query] == ["v2", "v1"]
+
+
+class Test_save_topic_listings:
+
+    def test_lists_children_in_order_with_totals(self, tmpdir):
+        nodes = [
+            {"id": "khan", "kind": NodeType.topic, "title": "Khan", "slug": "khan", "path": "khan/"},
+            {"id": "math", "kind": NodeType.topic, "title": "Math", "slug": "math", "path": "khan/math/", "sort_order": 1},
+            {"id": "v1", "kind": NodeType.video, "title": "V1", "slug": "v1", "path": "khan/math/v1/", "sort_order": 2,
+             "remote_size": 10},
+            {"id": "e1", "kind": NodeType.exercise, "title": "E1", "slug": "e1", "path": "khan/math/e1/", "sort_order": 1},
+            {"id": "v2", "kind": NodeType.video, "title": "V2", "slug": "v2", "path": "khan/v2/", "sort_order": 0,
+             "remote_size": 5},
+        ]
+        db = SqliteDatabase(str(tmpdir.join("content.db")))
+        db.connect()
+        models = list(save_models(convert_dicts_to_models(nodes), db))
+        list(save_models(list(populate_parent_foreign_keys(models)), db))
+        roll_up_availability(models)
+
+        assert save_topic_listings(models, db) == 2
+
+        listings = {path: ujson.loads(listing) for path, listing in
+                    db.execute_sql("SELECT path, listing FROM topiclisting")}
+        khan = listings["khan/"]
+        assert [dict(zip(khan["fields"], child))["id"] for child in khan["children"]] == ["v2", "math"]
+        assert khan["remote_size"] == 15
+        math = listings["khan/math/"]
+        assert [child[khan["fields"].index("kind")] for child in math["children"]] == ["Exercise", "Video"]
+        assert math["kinds"] == {"Exercise": 1, "Video": 1}
+
+
+class Test_build_search_index:
+
+    def _search(self, path, query):
+        conn = sqlite3.connect(path)
+        try:
+            return sorted(id for id, in conn.execute(
+                "SELECT item.id FROM item JOIN item_fts ON item.pk = item_fts.docid WHERE item_fts MATCH ?", (query,)))
+        finally:
+            conn.close()
+
+    def test_searches_titles_descriptions_and_keywords(self, tmpdir):
+        path = str(tmpdir.join("content.db"))
+        nodes = [
+            {"id": "v1", "kind": NodeType.video, "title": "Graphing lines", "slug": "v1", "path": "khan/v1/",
+             "description": "Slope and intercept", "keywords": "linear, equations"},
+            {"id": "v2", "kind": NodeType.video, "title": "Ecuaciones lineales", "slug": "v2", "path": "khan/v2/",
+             "description": "Pendiente e intersección"},
+        ]
+        db = SqliteDatabase(path)
+        db.connect()
+        list(save_models(convert_dicts_to_models(nodes), db))
+        db.close()
+
+        report = build_search_index(path, "en")
+        assert report["tokenizer"] == "porter"
+        assert report["size"] > 0
+        # stemmed, so "graphs" finds "Graphing"
+        assert self._search(path, "graphs") == ["v1"]
+        assert self._search(path, "equations") == ["v1"]
+        assert self._search(path, "slope") == ["v1"]
+
+        build_search_index(path, "es-ES")
+        # accents are ignored
+        assert self._search(path, "interseccion") == ["v2"]
+
+
+class Test_compress_assessment_items:
+
+    def _perseus_item(self, i):
+        return {
+            "question": {
+                "content": "What is ${} + {}$?\\n\\n[[\u2603 numeric-input 1]]".format(i, i * 7),
+                "images": {},
+                "widgets": {"numeric-input 1": {"type": "numeric-input", "graded": True, "options": {
+                    "answers": [{"value": i * 8, "status": "correct", "message": "", "simplify": "required",
+                                 "strict": False, "maxError": None}],
+                    "size": "normal", "coefficient": False}, "version": {"major": 0, "minor": 0}}},
+            },
+            "answerArea": {"calculator": False, "chi2Table": False, "periodicTable": False, "tTable": False,
+                           "zTable": False},
+            "itemDataVersion": {"major": 0, "minor": 1},
+            "hints": [{"content": "Add {} and {}.".format(i, i * 7), "images": {}, "widgets": {}}],
+        }
+
+    def test_round_trips_and_beats_plain_zlib(self, tmpdir):
+        path = str(tmpdir.join("content.db"))
+        db = SqliteDatabase(path)
+        db.connect()
+        items = [{"id": "a{}".format(i), "item_data": ujson.dumps(self._perseus_item(i)), "author_names": "[]"}
+                 for i in range(200)]
+        insert_assessment_items(items, db)
+        db.close()
+
+        # several batches, the last one partly filled
+        report = compress_assessment_items(path, batch_size=30)
+
+        conn = sqlite3.connect(path)
+        dictionary = get_item_data_dictionary(conn)
+        assert dictionary and len(dictionary) == report["dictionary_size"]
+        stored = dict(conn.execute("SELECT id, item_data FROM assessmentitem"))
+        assert all(isinstance(data, bytes) for data in stored.values())
+        assert {id: decode_item_data(data, dictionary) for id, data in stored.items()} == \
+            {item["id"]: item["item_data"] for item in items}
+
+        assert report["item_count"] == 200
+        assert report["compressed_size"] < report["zlib_size"] < report["raw_size"]
+        assert report["decode_median_ms"] >= 0
+
+    def test_decodes_uncompressed_items_as_is(self):
+        assert decode_item_data('{"hints": []}', b"") == '{"hints": []}'
+
+
+class Test_map_content_db:
+
+    def test_maps_the_page_aligned_db_out_of_the_pack(self, tmpdir):
+        nodes = [{"id": "khan", "kind": NodeType.topic, "title": "Khan", "slug": "khan", "path": "khan/"},
+                 {"id": "v1", "kind": NodeType.video, "title": "V1", "slug": "v1", "path": "khan/v1/"}]
+        dest, minimal = str(tmpdir.join("en.zip")), str(tmpdir.join("en-minimal.zip"))
+
+        bundle_language_pack(dest, nodes, {}, {}, {"code": "en"}, [], [], [], str(tmpdir.join("no-exercises")),
+                             outputs={"minimal": minimal}, mappable_db=True)
+
+        for path in [dest, minimal]:
+            with zipfile.ZipFile(path) as zf:
+                db = zf.read("content.db")
+                metadata = ujson.loads(zf.read("metadata.json"))
+            assert metadata["content_db_offset"] % 4096 == 0
+            with map_content_db(path) as mapped:
+                assert mapped[:] == db
+                assert mapped[:16] == b"SQLite format 3\x00"
@@ -1,5 +1,9 @@
+import http.server
 import logging
 import os
+import threading
+import tracemalloc
+import requests
 import vcr
 from hypothesis import given
 from hypothesis.strategies import lists, sampled_from, text, \
@@ -9,9 +13,13 @@ from contentpacks.khanacademy import _get_video_ids, \
     retrieve_html_exercises, \
     retrieve_kalite_data, retrieve_translations, retrieve_subtitles, apply_dubbed_video_map, \
     retrieve_all_assessment_item_data, retrieve_assessment_item_data, \
-    clean_assessment_item, localize_image_urls, localize_content_links, prune_assessment_items
+    clean_assessment_item, localize_image_urls, localize_content_links, prune_assessment_items, \
+    query_remote_content_file_sizes, apply_remote_content_file_sizes, create_paths_remove_orphans_and_empty_topics
 from contentpacks.models import AssessmentItem
-from contentpacks.utils import NODE_FIELDS_TO_TRANSLATE, translate_nodes, Catalog, NodeType
+from helpers import generate_topic_tree
+from contentpacks.utils import NODE_FIELDS_TO_TRANSLATE, translate_nodes, Catalog, NodeType, \
+    PersistentDict
+import contentpacks.khanacademy
 
 logging.basicConfig()
 logging.getLogger("vcr").setLevel(logging.DEBUG)
@@ -248,13 +256,15 @@ class Test_translating_kalite_data:
     @vcr.use_cassette("tests/fixtures/cassettes/translate_topics.yml")
     def test_translate_nodes(self):
         node_data = retrieve_kalite_data()
+        # translate_nodes works in place, so keep the original values around
+        untranslated_node_data = [dict(node) for node in node_data]
         translated_node_data = translate_nodes(
             node_data,
             self.ka_catalog,
         )
 
         for translated_node, untranslated_node in zip(translated_node_data,
-                                                    node_data):
+                                                    untranslated_node_data):
             for field in NODE_FIELDS_TO_TRANSLATE:
                 untranslated_fieldval = untranslated_node.get(field)
                 translated_fieldval = translated_node.get(field)
@@ -308,3 +318,154 @@ class Test_retrieve_html_exercises:
         path, retrieved_exercises = retrieve_html_exercises([exercise], lang, force=True)
 
         assert retrieved_exercises == [exercise]
+
+
+class Test_retrieve_html_exercises_manifest:
+
+    EXERCISES = {
+        "en": {"translated": b"<p>Hello</p>", "untranslated": b"<p>Hi</p>"},
+        "es": {"translated": b"<p>Hola</p>", "untranslated": b"<p>Hi</p>"},
+    }
+
+    def _fake_download_file(self, url, path, headers={}):
+        """
+        Pretend to be KA: serve the exercises above, and answer conditional
+        requests with 304 Not Modified.
+        """
+        self.requests.append((url, headers))
+        response = requests.Response()
+        if headers.get("If-None-Match"):
+            response.status_code = 304
+            return response, None
+
+        exercise_id, lang = url.split("/")[-1].split(".html?lang=")
+        with open(path, "wb") as f:
+            f.write(self.EXERCISES[lang][exercise_id])
+        response.status_code = 200
+        response.headers["ETag"] = '"{}-{}"'.format(exercise_id, lang)
+        return response, contentpacks.khanacademy.hash_file(path)
+
+    def test_detects_translations_and_revalidates(self, tmpdir, monkeypatch):
+        self.requests = []
+        monkeypatch.chdir(tmpdir)
+        monkeypatch.setattr(contentpacks.khanacademy, "download_file", self._fake_download_file)
+        exercises = ["translated", "untranslated"]
+
+        path, translated = retrieve_html_exercises(exercises, "es")
+        assert translated == ["translated"]
+        assert len(self.requests) == 4
+
+        # cached files are trusted without any requests...
+        _, translated = retrieve_html_exercises(exercises, "es")
+        assert translated == ["translated"]
+        assert len(self.requests) == 4
+
+        # ...and only revalidated when forced to
+        _, translated = retrieve_html_exercises(exercises, "es", force=True)
+        assert translated == ["translated"]
+        assert all(headers.get("If-None-Match") for _, headers in self.requests[4:])
+
+        manifest = PersistentDict(str(tmpdir.join("build", "html_exercise_manifest.json")))
+        assert manifest["es"]["untranslated"]["sha256"] == manifest["en"]["untranslated"]["sha256"]
+        assert manifest["es"]["translated"]["sha256"] != manifest["en"]["translated"]["sha256"]
+
+
+class _VideoHandler(http.server.BaseHTTPRequestHandler):
+
+    SIZES = {"/a.mp4": 1234, "/b.mp4": 5678}
+
+    def do_HEAD(self):
+        self.server.requests.append((self.path, self.headers.get("If-None-Match")))
+        if self.path not in self.SIZES:
+            self.send_response(404)
+        elif self.headers.get("If-None-Match") == '"{}"'.format(self.path):
+            self.send_response(304)
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", str(self.SIZES[self.path]))
+            self.send_header("ETag", '"{}"'.format(self.path))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class Test_query_remote_content_file_sizes:
+
+    def test_caches_sizes_and_revalidates_stale_ones(self, tmpdir):
+        server = http.server.HTTPServer(("127.0.0.1", 0), _VideoHandler)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = "http://127.0.0.1:{}/".format(server.server_port)
+
+        videos = [
+            {"kind": NodeType.video, "youtube_id": name, "format": "mp4",
+             "download_urls": {"mp4": base_url + name + ".mp4"}, "title": name, "readable_id": name}
+            for name in ["a", "b", "missing"]
+        ]
+        cache_path = str(tmpdir.join("remote_sizes.json"))
+
+        try:
+            sizes = query_remote_content_file_sizes(videos, cache_path=cache_path, retries=1)
+            assert sizes == {"a": 1234, "b": 5678}
+            assert len(server.requests) == 3
+
+            # fresh entries aren't checked again...
+            assert query_remote_content_file_sizes(videos[:2], cache_path=cache_path) == sizes
+            assert len(server.requests) == 3
+
+            # ...and stale ones are revalidated with their ETag
+            assert query_remote_content_file_sizes(videos[:2], cache_path=cache_path, max_age=-1) == sizes
+            assert sorted(server.requests[3:]) == [("/a.mp4", '"/a.mp4"'), ("/b.mp4", '"/b.mp4"')]
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        videos = apply_remote_content_file_sizes(videos, sizes)
+        assert [video.get("remote_size") for video in videos] == [1234, 5678, None]
+
+
+class Test_create_paths_remove_orphans_and_empty_topics:
+
+    def test_cross_listed_content_is_kept_once(self):
+        tracemalloc.start()
+        try:
+            nodes = generate_topic_tree()
+            tree_size, _ = tracemalloc.get_traced_memory()
+            if hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+            else:
+                tracemalloc.clear_traces()
+            start, _ = tracemalloc.get_traced_memory()
+            node_list = create_paths_remove_orphans_and_empty_topics(nodes)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        exercises = [node for node in node_list if node["kind"] == NodeType.exercise]
+        # each exercise is listed under two topics, but only kept once
+        assert len(exercises) == 2500
+        assert all(len(node["extra_placements"]) == 1 for node in exercises)
+        paths = [node["path"] for node in exercises] + \
+            [placement["path"] for node in exercises for placement in node["extra_placements"]]
+        assert len(set(paths)) == 5000
+        # copying the nodes deeply would take more memory than the tree itself
+        assert peak - start < tree_size / 4
+
+    def test_renames_duplicate_slugs_per_placement(self):
+        nodes = [
+            {"id": "x00000000", "kind": "Topic", "child_data": [{"id": "a"}, {"id": "b"}]},
+            {"id": "a", "kind": "Topic", "slug": "a", "child_data": [{"id": "e1"}, {"id": "e2"}]},
+            {"id": "b", "kind": "Topic", "slug": "b", "child_data": [{"id": "e2"}, {"id": "v"}]},
+            {"id": "e1", "kind": "Exercise", "slug": "same"},
+            {"id": "e2", "kind": "Exercise", "slug": "same"},
+            {"id": "v", "kind": "Video", "slug": "same"},
+        ]
+
+        node_dict = {node["id"]: node for node in create_paths_remove_orphans_and_empty_topics(nodes)}
+
+        assert node_dict["e1"]["path"] == "khan/a/same_1/"
+        assert node_dict["e2"]["path"] == "khan/a/same_2/"
+        assert node_dict["e2"]["extra_placements"] == [{"path": "khan/b/same_1/", "slug": "same_1", "sort_order": 5}]
+        assert node_dict["v"]["path"] == "khan/b/same/"
+        assert "child_data" not in node_dict["a"]
@@ -0,0 +1,45 @@
+import threading
+import time
+
+import requests
+
+from contentpacks.daemon import make_server
+from contentpacks.warmcache import WARM_CACHE
+
+
+class Test_daemon:
+
+    def test_runs_build_requests_in_order(self):
+        built = []
+
+        def _build(request):
+            if request["lang"] == "xx":
+                raise ValueError("No such language")
+            built.append(request["lang"])
+
+        server = make_server(_build, port=0, cache_size=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}".format(server.server_port)
+
+        try:
+            assert WARM_CACHE.max_size == 1024 * 1024
+            assert requests.post(url + "/builds", json={"lang": "es"}).status_code == 400
+
+            ids = [requests.post(url + "/builds", json={"lang": lang, "version": "0.16"}).json()["id"]
+                   for lang in ["es", "xx", "fr"]]
+            for _ in range(100):
+                builds = [requests.get("{}/builds/{}".format(url, id)).json() for id in ids]
+                if all(build["state"] in ("done", "failed") for build in builds):
+                    break
+                time.sleep(0.05)
+
+            assert [build["state"] for build in builds] == ["done", "failed", "done"]
+            assert "No such language" in builds[1]["error"]
+            assert built == ["es", "fr"]
+            assert requests.get(url + "/status").json()["queued"] == 0
+            assert requests.get(url + "/builds/42").status_code == 404
+        finally:
+            server.shutdown()
+            server.server_close()
+            WARM_CACHE.resize(0)
+            WARM_CACHE.clear()
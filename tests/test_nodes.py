@@ -0,0 +1,62 @@
+import copy
+import pickle
+import sys
+
+import pytest
+
+from contentpacks.khanacademy import topic_attributes, exercise_attributes, video_attributes, convert_camel_case
+from contentpacks.models import Item
+from contentpacks.nodes import Node, NODE_FIELDS, compact_nodes
+
+
+VIDEO = {
+    "id": "y2-uaPiyoxc",
+    "kind": "Video",
+    "slug": "sine-graph",
+    "path": "khan/math/sine-graph/",
+    "title": "Sine graph",
+    "youtube_id": "y2-uaPiyoxc",
+    "download_urls": {"mp4": "http://example.com/y2-uaPiyoxc.mp4"},
+}
+
+
+class Test_Node:
+
+    def test_behaves_like_a_dict(self):
+        node = Node(VIDEO)
+
+        assert node == VIDEO
+        assert VIDEO == node
+        assert list(node) == list(VIDEO)
+        assert node.get("description") is None
+        assert "download_urls" in node and "description" not in node
+
+        node["description"] = ""
+        del node["download_urls"]
+        assert node.pop("youtube_id") == VIDEO["youtube_id"]
+        assert set(node) == set(VIDEO) - {"download_urls", "youtube_id"} | {"description"}
+        with pytest.raises(KeyError):
+            node["youtube_id"]
+
+    def test_copies_are_independent(self):
+        node = Node(VIDEO)
+        for other in [node.copy(), copy.deepcopy(node), pickle.loads(pickle.dumps(node))]:
+            other["title"] = "Cosine graph"
+            other["extra"] = True
+            assert node == VIDEO
+            assert isinstance(other, Node)
+        assert copy.deepcopy(node)["download_urls"] is not node["download_urls"]
+
+    def test_interns_kind(self):
+        kind = "".join(["Vid", "eo"])
+        assert Node(kind=kind)["kind"] is sys.intern("Video")
+
+    def test_has_slots_for_all_ka_attributes(self):
+        dropped = {"hide", "deleted", "do_not_publish"}
+        attributes = {convert_camel_case(a) for a in topic_attributes + exercise_attributes + video_attributes}
+        assert attributes - dropped <= set(NODE_FIELDS)
+
+    def test_can_be_passed_as_keyword_arguments(self):
+        node, = compact_nodes([dict(VIDEO)])
+        assert isinstance(node, Node)
+        assert Item(**node).youtube_id == VIDEO["youtube_id"]
@@ -0,0 +1,69 @@
+import numpy as np
+
+from contentpacks.nodetable import NodeTable, NO_PARENT
+from contentpacks.utils import NodeType, remove_nonexistent_assessment_items_from_exercises, \
+    remove_untranslated_exercises, separate_exercise_types
+
+
+def _tree():
+    return [
+        {"kind": NodeType.topic, "id": "khan", "path": "khan/"},
+        {"kind": NodeType.topic, "id": "math", "path": "khan/math/"},
+        {"kind": NodeType.video, "id": "v1", "path": "khan/math/v1/", "remote_size": 100, "total_files": 1},
+        {"kind": NodeType.video, "id": "v2", "path": "khan/math/v2/", "remote_size": 50, "total_files": 1,
+         "available": True, "size_on_disk": 40},
+        {"kind": NodeType.topic, "id": "science", "path": "khan/science/"},
+        {"kind": NodeType.exercise, "id": "e1", "path": "khan/science/e1/", "available": True,
+         "uses_assessment_items": True, "all_assessment_items": [{"id": "a"}, {"id": "b"}, {"id": "c"}]},
+        {"kind": NodeType.exercise, "id": "e2", "path": "khan/science/e2/", "uses_assessment_items": False},
+    ]
+
+
+class Test_NodeTable:
+
+    def test_finds_parents_from_paths(self):
+        table = NodeTable(_tree())
+        assert table.parent.tolist() == [NO_PARENT, 0, 1, 1, 0, 4, 4]
+        assert table.is_kind(NodeType.exercise).tolist() == [False] * 5 + [True] * 2
+
+    def test_rolls_up_availability_and_sizes(self):
+        columns = NodeTable(_tree()).roll_up()
+
+        assert columns["available"].tolist() == [True, True, False, True, True, True, False]
+        assert columns["total_files"].tolist() == [2, 2, 1, 1, 0, 0, 0]
+        # only the videos that haven't been downloaded count towards remote_size
+        assert columns["remote_size"].tolist() == [100, 100, 100, 50, 0, 0, 0]
+        assert columns["size_on_disk"].tolist() == [40, 40, 0, 40, 0, 0, 0]
+
+    def test_rolls_up_deep_trees(self):
+        depth = 50
+        nodes = [{"kind": NodeType.topic, "path": "t/" * (i + 1)} for i in range(depth)]
+        nodes.append({"kind": NodeType.video, "path": "t/" * depth + "v/", "remote_size": 7, "total_files": 1})
+
+        columns = NodeTable(nodes[::-1]).roll_up()
+
+        assert np.all(columns["remote_size"] == 7)
+        assert np.all(columns["total_files"] == 1)
+
+
+class Test_node_filters:
+
+    def test_separate_exercise_types(self):
+        html_ids, assessment_ids, nodes = separate_exercise_types(_tree())
+        assert list(html_ids) == ["e2"]
+        assert list(assessment_ids) == ["e1"]
+        assert len(nodes) == 7
+
+    def test_remove_nonexistent_assessment_items(self):
+        nodes = list(remove_nonexistent_assessment_items_from_exercises(_tree(), [{"id": "c"}, {"id": "a"}]))
+        assert len(nodes) == 7
+        assert nodes[5]["all_assessment_items"] == [{"id": "a"}, {"id": "c"}]
+
+    def test_remove_untranslated_exercises(self):
+        translated = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+
+        ids = [node["id"] for node in remove_untranslated_exercises(_tree(), ["e2"], translated[:2])]
+        assert ids == ["khan", "math", "v1", "v2", "science", "e2"]
+
+        ids = [node["id"] for node in remove_untranslated_exercises(_tree(), [], translated)]
+        assert ids == ["khan", "math", "v1", "v2", "science", "e1"]
@@ -0,0 +1,277 @@
+import json
+import os
+import re
+import struct
+import zlib
+from html.parser import HTMLParser
+from xml.etree import ElementTree
+
+import pytest
+
+from contentpacks.optimize import optimize_png, optimize_jpeg, optimize_gif, \
+    optimize_assessment_images, minify_vtt, minify_html_exercise, minify_graphie_json, \
+    minify_svg, minify_text_assets, JSONP_REGEX
+
+MINIFY_FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures", "minify")
+
+
+def _png_chunk(chunk_type, data):
+    return struct.pack(">I4s", len(data), chunk_type) + data + \
+        struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff)
+
+
+def _make_png(extra_chunks=()):
+    width, height = 16, 16
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    pixels = b"".join(b"\x00" + b"\x10\x20\x30" * width for _ in range(height))
+    idat = zlib.compress(pixels, 0)  # deliberately badly compressed
+    return b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", header) + \
+        b"".join(_png_chunk(t, d) for t, d in extra_chunks) + \
+        _png_chunk(b"IDAT", idat[:20]) + _png_chunk(b"IDAT", idat[20:]) + \
+        _png_chunk(b"IEND", b"")
+
+
+def _png_chunks(data):
+    pos = 8
+    while pos < len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        yield chunk_type, data[pos + 8:pos + 8 + length]
+        pos += length + 12
+
+
+def _jpeg_segment(marker, payload):
+    return bytes([0xff, marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+
+def _exif(orientation):
+    ifd = struct.pack("<H", 1) + struct.pack("<HHIHH", 0x0112, 3, 1, orientation, 0) + struct.pack("<I", 0)
+    return b"Exif\x00\x00" + b"II*\x00" + struct.pack("<I", 8) + ifd
+
+
+SCAN_DATA = _jpeg_segment(0xda, b"\x01\x01\x00\x00\x3f\x00") + b"\x12\x34\xff\x00\x56" + b"\xff\xd9"
+
+
+class Test_optimize_png:
+
+    def test_keeps_pixels_and_drops_text(self):
+        original = _make_png([(b"tEXt", b"Software\x00graphie"), (b"tRNS", b"\x00\x00\x00\x00\x00\x00")])
+
+        optimized = optimize_png(original)
+        chunks = list(_png_chunks(optimized))
+        types = [t for t, _ in chunks]
+
+        assert len(optimized) < len(original)
+        assert b"tEXt" not in types
+        assert b"tRNS" in types
+        assert types.count(b"IDAT") == 1
+        original_pixels = zlib.decompress(b"".join(d for t, d in _png_chunks(original) if t == b"IDAT"))
+        assert zlib.decompress(dict(chunks)[b"IDAT"]) == original_pixels
+
+
+class Test_optimize_jpeg:
+
+    def test_strips_comments_and_metadata(self):
+        jfif = _jpeg_segment(0xe0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+        dqt = _jpeg_segment(0xdb, b"\x00" + bytes(range(64)))
+        original = b"\xff\xd8" + jfif + _jpeg_segment(0xe1, _exif(1)) + \
+            _jpeg_segment(0xfe, b"made by a camera") + dqt + SCAN_DATA
+
+        assert optimize_jpeg(original) == b"\xff\xd8" + jfif + dqt + SCAN_DATA
+
+    def test_keeps_exif_orientation(self):
+        exif = _jpeg_segment(0xe1, _exif(6))
+        original = b"\xff\xd8" + exif + SCAN_DATA
+
+        assert optimize_jpeg(original) == original
+
+
+class Test_optimize_gif:
+
+    def test_strips_comments(self):
+        header = b"GIF89a" + struct.pack("<HHBBB", 1, 1, 0x80, 0, 0) + b"\x00\x00\x00\xff\xff\xff"
+        loop = b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+        comment = b"\x21\xfe\x05hello\x00"
+        image = b"\x2c" + struct.pack("<HHHHB", 0, 0, 1, 1, 0) + b"\x02\x02\x44\x01\x00"
+        original = header + loop + comment + image + b"\x3b"
+
+        assert optimize_gif(original) == header + loop + image + b"\x3b"
+
+
+class Test_optimize_assessment_images:
+
+    def test_reuses_cache_and_keeps_layout(self, tmpdir, monkeypatch):
+        monkeypatch.chdir(tmpdir.mkdir("cwd"))
+        source = tmpdir.join("src", "abc", "abcdef.png")
+        source.write_binary(_make_png([(b"tEXt", b"Comment\x00hi")]), ensure=True)
+        svg = tmpdir.join("src", "xyz", "xyz.svg")
+        svg.write("<svg/>", ensure=True)
+        outdir, cachedir = str(tmpdir.join("out")), str(tmpdir.join("cache"))
+
+        paths, report = optimize_assessment_images([str(source), str(svg)], outdir=outdir, cachedir=cachedir)
+        # the second run must come straight from the cache
+        again, _ = optimize_assessment_images([str(source)], outdir=outdir, cachedir=cachedir)
+
+        assert paths[0] == again[0] == os.path.join(outdir, "abc", "abcdef.png")
+        assert paths[1] == str(svg)
+        assert report[".png"]["count"] == 1
+        assert report[".png"]["size_after"] < report[".png"]["size_before"]
+        # the optimized PNG, and its blob in the cache's own asset store rather than ./build/store
+        assert len(list(tmpdir.join("cache").visit(lambda p: p.check(file=1)))) == 2
+        assert len(list(tmpdir.join("cache", "store").visit(lambda p: p.check(file=1)))) == 1
+        assert not tmpdir.join("cwd", "build").check()
+
+
+def _read_fixture(name):
+    with open(os.path.join(MINIFY_FIXTURES_DIR, name), "rb") as f:
+        return f.read()
+
+
+def _rendered_cues(vtt):
+    """
+    The cues as a player would show them: cue text is laid out with
+    white-space: pre-line, and empty cues show nothing at all.
+    """
+    cues = []
+    for block in re.split(r"\n{2,}", vtt.decode("utf-8").replace("\r\n", "\n")):
+        lines = block.split("\n")
+        timings = [i for i, line in enumerate(lines) if "-->" in line]
+        if timings:
+            timing = re.sub(r"\s+", " ", lines[timings[0]].strip())
+            text = "\n".join(re.sub(r"[ \t]+", " ", line).strip() for line in lines[timings[0] + 1:])
+            if text.strip():
+                cues.append((timing, text))
+    return cues
+
+
+class _HTMLEvents(HTMLParser):
+    """
+    Record the DOM an HTML document parses to, with text collapsed the way
+    it's rendered (except inside elements where whitespace is significant).
+    """
+    VERBATIM_TAGS = {"pre", "script", "style", "textarea"}
+
+    def __init__(self, html):
+        super().__init__(convert_charrefs=True)
+        self.events = []
+        self.verbatim = 0
+        self.feed(html.decode("utf-8"))
+        self.close()
+
+        self.events = [self._collapse(event) for event in self.events]
+        # whitespace before the doctype or after </html> isn't rendered
+        while self.events and self.events[-1] == ("data", " "):
+            self.events.pop()
+
+    @staticmethod
+    def _collapse(event):
+        if event[0] != "data":
+            return event
+        _, data, verbatim = event
+        return "data", data if verbatim else re.sub("[ \t\n\f\r]+", " ", data)
+
+    def handle_starttag(self, tag, attrs):
+        self.events.append(("start", tag, attrs))
+        self.verbatim += tag in self.VERBATIM_TAGS
+
+    def handle_endtag(self, tag):
+        self.events.append(("end", tag))
+        self.verbatim -= tag in self.VERBATIM_TAGS
+
+    def handle_data(self, data):
+        # comments aren't recorded, so text on either side of one is merged
+        if self.events and self.events[-1][0] == "data":
+            data = self.events.pop()[1] + data
+        self.events.append(("data", data, self.verbatim))
+
+    def handle_decl(self, decl):
+        self.events.append(("decl", decl))
+
+
+def _svg_tree(svg, parent_in_text=False):
+    element = ElementTree.fromstring(svg) if isinstance(svg, bytes) else svg
+    tag = element.tag.split("}")[-1]
+    in_text = parent_in_text or tag in {"text", "style"}
+
+    def normalize(s, in_text):
+        if in_text:
+            return re.sub(r"\s+", " ", s or "")
+        return (s or "").strip()
+
+    return (tag, element.attrib, normalize(element.text, in_text), normalize(element.tail, parent_in_text),
+            [_svg_tree(child, in_text) for child in element])
+
+
+class Test_minifiers:
+
+    @pytest.mark.parametrize("minifier,source,golden", [
+        (minify_vtt, "subtitle.vtt", "subtitle.min.vtt"),
+        (minify_html_exercise, "exercise.html", "exercise.min.html"),
+        (minify_graphie_json, "graph-data.json", "graph-data.min.json"),
+        (minify_svg, "graph.svg", "graph.min.svg"),
+    ])
+    def test_matches_golden_output(self, minifier, source, golden):
+        original = _read_fixture(source)
+        minified = minifier(original)
+
+        assert minified == _read_fixture(golden)
+        assert len(minified) < len(original)
+        # minifying twice shouldn't change anything
+        assert minifier(minified) == minified
+
+    def test_vtt_renders_the_same(self):
+        original = _read_fixture("subtitle.vtt")
+        assert _rendered_cues(minify_vtt(original)) == _rendered_cues(original)
+
+    def test_html_renders_the_same(self):
+        original = _read_fixture("exercise.html")
+        assert _HTMLEvents(minify_html_exercise(original)).events == _HTMLEvents(original).events
+
+    def test_html_keeps_line_breaks_in_inline_code(self):
+        minified = minify_html_exercise(_read_fixture("exercise.html")).decode("utf-8")
+        assert "i++ ) {\ncircle( [i, 1], 0.3 );\n}" in minified
+
+    def test_graphie_json_has_the_same_data(self):
+        original = JSONP_REGEX.match(_read_fixture("graph-data.json").decode("utf-8"))
+        minified = JSONP_REGEX.match(minify_graphie_json(_read_fixture("graph-data.json")).decode("utf-8"))
+
+        assert minified.group("callback") == original.group("callback")
+        assert json.loads(minified.group("data")) == json.loads(original.group("data"))
+
+    def test_svg_renders_the_same(self):
+        original = _read_fixture("graph.svg")
+        assert _svg_tree(minify_svg(original)) == _svg_tree(original)
+
+    def test_svg_tolerates_malformed_tags(self):
+        assert minify_svg(b"<svg>< foo></svg>") == b"<svg>< foo></svg>"
+
+    def test_minify_text_assets_keeps_layout(self, tmpdir):
+        subtitle = tmpdir.join("subtitles", "en", "y2-uaPiyoxc.vtt")
+        subtitle.write_binary(_read_fixture("subtitle.vtt"), ensure=True)
+        exercise = tmpdir.join("es", "counting.htmllang=es")
+        exercise.write_binary(_read_fixture("exercise.html"), ensure=True)
+        graphie = tmpdir.join("assessment", "abc", "abcdef-data.json")
+        graphie.write_binary(_read_fixture("graph-data.json"), ensure=True)
+        png = tmpdir.join("assessment", "cat", "cat.png")
+        png.write_binary(b"not really a png", ensure=True)
+        outdir = str(tmpdir.join("out"))
+
+        subtitles, exercise_path, files, report = minify_text_assets(
+            [str(subtitle)], str(tmpdir.join("es")), [str(graphie), str(png)],
+            outdir=outdir, cachedir=str(tmpdir.join("cache")))
+
+        assert subtitles == [os.path.join(outdir, "subtitles", "en", "y2-uaPiyoxc.vtt")]
+        assert os.listdir(exercise_path) == ["counting.htmllang=es"]
+        assert files == [os.path.join(outdir, "assessment_resources", "abc", "abcdef-data.json"), str(png)]
+        assert report["html exercises"]["size_after"] < report["html exercises"]["size_before"]
+
+    def test_minify_text_assets_keeps_subtitle_languages_apart(self, tmpdir):
+        paths = []
+        for lang in ["en", "es"]:
+            subtitle = tmpdir.join("subtitles", lang, "y2-uaPiyoxc.vtt")
+            subtitle.write_binary(_read_fixture("subtitle.vtt"), ensure=True)
+            paths.append(str(subtitle))
+
+        subtitles, _, _, _ = minify_text_assets(paths, str(tmpdir.mkdir("exercises")), [],
+                                                outdir=str(tmpdir.join("out")), cachedir=str(tmpdir.join("cache")))
+
+        assert len(set(subtitles)) == 2
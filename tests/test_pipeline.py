@@ -0,0 +1,63 @@
+import threading
+
+import pytest
+from peewee import SqliteDatabase, Using
+
+from contentpacks.models import AssessmentItem
+from contentpacks.pipeline import stream_through
+from contentpacks.utils import insert_assessment_items, remove_assessment_data_with_empty_widgets
+
+
+def _double(items):
+    for item in items:
+        yield item * 2
+
+
+def _odd_only(items):
+    return (item for item in items if item % 2)
+
+
+class Test_stream_through:
+
+    def test_runs_stages_in_order(self):
+        assert list(stream_through(range(1000), [_odd_only, _double], maxsize=3)) == list(range(2, 2000, 4))
+
+    def test_items_flow_before_the_source_is_done(self):
+        released = threading.Event()
+
+        def source():
+            yield 1
+            # only carries on once the first item has made it through
+            assert released.wait(5)
+            yield 3
+
+        outputs = stream_through(source(), [_double])
+        assert next(outputs) == 2
+        released.set()
+        assert list(outputs) == [6]
+
+    def test_raises_errors_from_stages(self):
+        def _fail(items):
+            for item in items:
+                if item == 50:
+                    raise ValueError("bad item")
+                yield item
+
+        with pytest.raises(ValueError):
+            list(stream_through(range(1000), [_fail, _double], maxsize=2))
+
+
+class Test_insert_assessment_items:
+
+    def test_saves_streamed_items_in_batches(self, tmpdir):
+        db = SqliteDatabase(str(tmpdir.join("content.db")))
+        items = ({"id": str(i), "item_data": '{"question": {"widgets": %s}}' % ("{}" if i % 2 else '{"a": 1}'),
+                  "author_names": "[]"} for i in range(600))
+
+        count = insert_assessment_items(
+            stream_through(items, [remove_assessment_data_with_empty_widgets]), db, batch_size=100)
+
+        assert count == 300
+        with Using(db, [AssessmentItem]):
+            assert AssessmentItem.select().count() == 300
+            assert AssessmentItem.get(AssessmentItem.id == "598").author_names == "[]"
@@ -0,0 +1,23 @@
+from contentpacks.staging import StagingStore
+from contentpacks.utils import remove_assessment_data_with_empty_widgets
+
+
+class Test_StagingStore:
+
+    def test_stages_from_another_staged_table(self, tmpdir):
+        items = [{"id": str(i), "item_data": '{"question": {"widgets": %s}}' % ("{}" if i % 3 else '{"a": 1}')}
+                 for i in range(2500)]
+
+        with StagingStore(dir=str(tmpdir)) as staging:
+            all_items = staging.stage("all", iter(items))
+            with_widgets = staging.stage("with_widgets", remove_assessment_data_with_empty_widgets(all_items))
+
+            assert list(all_items) == items
+            # staged items can be read more than once
+            assert [item["id"] for item in with_widgets] == [str(i) for i in range(0, 2500, 3)]
+            assert len(with_widgets) == 834
+
+            assert not staging.stage("all", [])
+            assert len(tmpdir.listdir()) == 1
+
+        assert not tmpdir.listdir()
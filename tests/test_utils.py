@@ -1,18 +1,22 @@
 import os.path
+import tracemalloc
 
+import pytest
 import vcr
 import ujson
 import tempfile
 import zipfile
 
+from contentpacks import utils
 from contentpacks.khanacademy import retrieve_kalite_data
 from contentpacks.models import Item
 from contentpacks.utils import NODE_FIELDS_TO_TRANSLATE, \
     download_and_cache_file, translate_nodes, \
     translate_assessment_item_text, NodeType, remove_untranslated_exercises, \
     convert_dicts_to_models, save_catalog, populate_parent_foreign_keys, \
-    save_db, save_models, remove_unavailable_topics
-from helpers import generate_catalog
+    save_db, save_models, remove_unavailable_topics, add_to_asset_store, \
+    generate_dedupe_report, hash_file, iter_json_object_arrays, Catalog
+from helpers import generate_catalog, generate_topic_tree
 from peewee import SqliteDatabase, Using
 
 
@@ -26,12 +30,110 @@ class Test_download_and_cache_file:
         assert os.path.exists(path)
 
 
+class Test_add_to_asset_store:
+
+    def test_identical_files_share_one_blob(self, tmpdir):
+        storedir = str(tmpdir.join("store"))
+        for name in ["a.svg", "b.svg"]:
+            src = tmpdir.join(name + ".part")
+            src.write("<svg></svg>")
+            add_to_asset_store(str(src), str(tmpdir.join(name)), storedir=storedir)
+
+        a, b = tmpdir.join("a.svg"), tmpdir.join("b.svg")
+        assert a.read() == b.read() == "<svg></svg>"
+        assert os.path.samefile(str(a), str(b))
+        assert not tmpdir.join("a.svg.part").exists()
+
+    def test_replaces_existing_file_without_touching_blob(self, tmpdir):
+        storedir = str(tmpdir.join("store"))
+        path = str(tmpdir.join("catalog.zip"))
+        for content in ["old", "new"]:
+            src = tmpdir.join("catalog.zip.part")
+            src.write(content)
+            add_to_asset_store(str(src), path, storedir=storedir)
+
+        assert tmpdir.join("catalog.zip").read() == "new"
+        blobs = [p.basename for p in tmpdir.join("store").visit() if p.check(file=1)]
+        # the old blob is left alone, since other names may still point to it
+        assert len(blobs) == 2
+        assert hash_file(path) in blobs
+
+
+class Test_generate_dedupe_report:
+
+    def test_counts_duplicate_bytes(self, tmpdir):
+        tmpdir.join("a.png").write("12345")
+        tmpdir.join("b.png").write("12345")
+        tmpdir.join("c.png").write("123")
+
+        report = generate_dedupe_report(str(tmpdir.join(n)) for n in ["a.png", "b.png", "c.png"])
+
+        assert report["total_files"] == 3
+        assert report["unique_files"] == 2
+        assert report["total_size"] == 13
+        assert report["duplicate_size"] == 5
+        assert len(report["duplicates"]) == 1
+
+    def test_takes_digests_from_the_asset_store(self, tmpdir, monkeypatch):
+        storedir = str(tmpdir.join("store"))
+        for name in ["a.png", "b.png"]:
+            tmpdir.join(name + ".part").write("12345")
+            add_to_asset_store(str(tmpdir.join(name + ".part")), str(tmpdir.join(name)), storedir)
+        digest = hash_file(str(tmpdir.join("a.png")))
+
+        def no_hashing(path):
+            raise AssertionError("{} was hashed".format(path))
+        monkeypatch.setattr(utils, "hash_file", no_hashing)
+
+        report = generate_dedupe_report([str(tmpdir.join("a.png")), str(tmpdir.join("b.png"))], storedir)
+
+        assert report["duplicates"] == {digest: [str(tmpdir.join("a.png")), str(tmpdir.join("b.png"))]}
+
+
+class Test_iter_json_object_arrays:
+
+    TREE = {
+        "topics": [{"id": "x00000000", "title": "Khan Acad\u00e9mie", "childData": [{"id": "v1"}]}],
+        "exercises": [],
+        "videos": [{"id": "v1", "duration": 12, "keywords": "a, b"}, {"id": "v2", "downloadSize": 1.5e6}],
+    }
+
+    def test_matches_parsing_in_one_go(self):
+        data = ujson.dumps(self.TREE, ensure_ascii=False, indent=2).encode("utf-8")
+        # split the data everywhere, including in the middle of the utf-8 encoded characters
+        for size in [1, 7, len(data)]:
+            chunks = (data[i:i + size] for i in range(0, len(data), size))
+            parsed = {}
+            for key, node in iter_json_object_arrays(chunks):
+                parsed.setdefault(key, []).append(node)
+            assert parsed == {key: nodes for key, nodes in self.TREE.items() if nodes}
+
+    def test_rejects_truncated_data(self):
+        data = ujson.dumps(self.TREE).encode("utf-8")
+        with pytest.raises(ValueError):
+            list(iter_json_object_arrays([data[:-5]]))
+
+    def test_rejects_malformed_data_right_away(self):
+        read = []
+
+        def chunks():
+            yield b'{1: ['
+            for i in range(100):
+                read.append(i)
+                yield b'{"id": "v1"}, '
+
+        with pytest.raises(ValueError, match="Expected a key"):
+            list(iter_json_object_arrays(chunks()))
+        assert len(read) < 100
+
+
 class Test_translate_nodes:
 
     @vcr.use_cassette("tests/fixtures/cassettes/kalite/node_data.json.yml")
     def test_translates_selected_fields(self):
         node_data = retrieve_kalite_data()
-        node_dict = {node.get("path"): node for node in node_data}
+        # translate_nodes works in place, so keep the original values around
+        node_dict = {node.get("path"): dict(node) for node in node_data}
         catalog = generate_catalog()
 
         translated_nodes = translate_nodes(node_data, catalog)
@@ -43,6 +145,23 @@ class Test_translate_nodes:
                 assert translated_fieldval == catalog.get(untranslated_fieldval,
                                                                         untranslated_fieldval)
 
+    def test_translates_in_place_without_copying(self):
+        nodes = generate_topic_tree()
+        catalog = Catalog()
+        catalog.update({node["title"]: node["title"].upper() for node in nodes})
+
+        tracemalloc.start()
+        try:
+            translated_nodes = translate_nodes(nodes, catalog)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert translated_nodes is nodes
+        assert nodes[-1]["title"] == "EXERCISE 2499"
+        # the translated strings all come from the catalog; no node is copied
+        assert peak < 64 * 1024
+
 
 class Test_translate_assessment_item_text:
 
@@ -70,6 +189,20 @@ class Test_translate_assessment_item_text:
         assert "not_in_catalog" in translated
         assert "not_translated" in translated
 
+    def test_translates_in_place(self):
+        items = [{"id": str(i), "item_data": '"Millions"'} for i in range(1000)]
+
+        tracemalloc.start()
+        try:
+            translated = list(translate_assessment_item_text(items, Catalog()))
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert all(a is b for a, b in zip(translated, items))
+        # only the new item_data strings, and the list above
+        assert peak < 256 * 1024
+
 
 class Test_remove_unavailable_topics:
     def setup(self):
@@ -147,6 +280,39 @@ class Test_convert_dicts_to_models:
         # see if we can have peewee validate the models
 
 
+    def test_expands_extra_placements(self):
+        node = {"id": "e1", "kind": NodeType.exercise, "title": "Exercise", "slug": "e1", "path": "khan/a/e1/",
+                "sort_order": 1, "uses_assessment_items": True,
+                "extra_placements": [{"path": "khan/b/e1/", "slug": "e1", "sort_order": 5}]}
+
+        items = list(convert_dicts_to_models([node]))
+
+        assert [(item.path, item.sort_order) for item in items] == [("khan/a/e1/", 1), ("khan/b/e1/", 5)]
+        assert items[0].extra_fields == items[1].extra_fields
+        assert "extra_placements" not in items[0].extra_fields
+
+    def test_moves_hot_fields_out_of_extra_fields(self):
+        node = {"id": "v1", "kind": NodeType.video, "title": "Video", "slug": "v1", "path": "khan/v1/",
+                "duration": 300, "related_exercise_url": "/e/e1", "keywords": "rare",
+                "prerequisites": ["e0"], "curated_related_videos": ["v2"]}
+
+        item, = convert_dicts_to_models([node], format_version=2)
+
+        assert (item.duration, item.related_exercise_url) == (300, "/e/e1")
+        assert ujson.loads(item.extra_fields) == {"keywords": "rare"}
+
+    def test_keeps_hot_fields_in_extra_fields_for_old_readers(self):
+        node = {"id": "e1", "kind": NodeType.exercise, "title": "Exercise", "slug": "e1", "path": "khan/e1/",
+                "duration": 300, "prerequisites": ["e0"], "keywords": "rare"}
+
+        item, = convert_dicts_to_models([node])
+
+        # what a reader that predates the columns and edge tables sees
+        extra_fields = ujson.loads(item.extra_fields)
+        assert extra_fields["duration"] == 300
+        assert extra_fields["prerequisites"] == ["e0"]
+        assert item.duration == 300
+
 class Test_save_catalog:
 
     def test_mofile_exists_in_zip(self):
@@ -0,0 +1,56 @@
+from contentpacks.warmcache import WarmCache, WARM_CACHE, load_cached
+
+
+class Test_WarmCache:
+
+    def test_evicts_least_recently_used_entries_over_max_size(self):
+        cache = WarmCache(max_size=10)
+        cache.get("a", lambda: "A", 4)
+        cache.get("b", lambda: "B", 4)
+        assert cache.get("a", lambda: "not again", 4) == "A"
+
+        cache.get("c", lambda: "C", 4)
+
+        assert list(cache.entries) == ["a", "c"]
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["size"] == 8
+
+    def test_does_not_cache_values_bigger_than_max_size(self):
+        cache = WarmCache(max_size=10)
+        assert cache.get("a", lambda: "A", 11) == "A"
+        assert not cache.entries
+
+
+class Test_load_cached:
+
+    def test_reuses_values_while_the_contents_are_the_same(self, tmpdir):
+        path = tmpdir.join("nodes.json")
+        loads = []
+
+        def _load(path):
+            loads.append(path)
+            return open(path).read()
+
+        path.write("[1]")
+        try:
+            # off by default
+            load_cached(str(path), _load)
+            load_cached(str(path), _load)
+            assert len(loads) == 2
+
+            WARM_CACHE.resize(1024)
+            assert load_cached(str(path), _load) == load_cached(str(path), _load) == "[1]"
+            assert len(loads) == 3
+
+            # rewritten with the same contents, as when it's downloaded again
+            path.remove()
+            path.write("[1]")
+            load_cached(str(path), _load)
+            assert len(loads) == 3
+
+            path.write("[2]")
+            assert load_cached(str(path), _load) == "[2]"
+            assert len(loads) == 4
+        finally:
+            WARM_CACHE.resize(0)
+            WARM_CACHE.clear()
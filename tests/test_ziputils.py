@@ -0,0 +1,209 @@
+import http.server
+import io
+import json
+import os
+import re
+import struct
+import threading
+import zipfile
+
+import pytest
+
+from contentpacks.utils import get_minimal_pack_name, get_khan_assessment_name
+from contentpacks.ziputils import copy_entries, FanOutZipFile, write_aligned, write_pack_index, \
+    fetch_entries, _decode_entry
+
+
+class _Unseekable(io.RawIOBase):
+    """
+    A write-only stream, which makes ZipFile follow each entry with a data
+    descriptor.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.buffer.write(data)
+
+
+def _make_zip(path):
+    with zipfile.ZipFile(path, "w", allowZip64=True) as zf:
+        zf.writestr("content.db", b"sqlite" * 1000, zipfile.ZIP_DEFLATED)
+        zf.writestr("khan/a.json", b'{"a": 1}', zipfile.ZIP_STORED)
+        # an entry with a zip64 field in its headers, as ZipFile writes for ones it expects to be big
+        data = b'{"b": 2}' * 100
+        info = zipfile.ZipInfo("khan/b.json", (2016, 1, 1, 0, 0, 0))
+        info.extra = struct.pack("<HHQQ", 0x0001, 16, len(data), len(data))
+        zf.writestr(info, data)
+
+
+class Test_copy_entries:
+
+    def test_copies_and_renames_entries_verbatim(self, tmpdir):
+        src_path, dest_path = tmpdir.join("src.zip"), tmpdir.join("dest.zip")
+        _make_zip(str(src_path))
+
+        with zipfile.ZipFile(str(src_path)) as src, zipfile.ZipFile(str(dest_path), "w") as dest:
+            copy_entries(src, dest, {"content.db": "content.db", "khan/b.json": "b.json"})
+            dest.writestr("extra.txt", b"written after the copies")
+
+        with zipfile.ZipFile(str(src_path)) as src, zipfile.ZipFile(str(dest_path)) as dest:
+            assert dest.testzip() is None
+            assert dest.namelist() == ["content.db", "b.json", "extra.txt"]
+            assert src.getinfo("khan/b.json").extra[:2] == b"\x01\x00"
+            assert dest.read("b.json") == src.read("khan/b.json")
+            assert dest.getinfo("b.json").extra == b""
+            assert dest.getinfo("content.db").compress_type == zipfile.ZIP_DEFLATED
+            assert dest.getinfo("content.db").CRC == src.getinfo("content.db").CRC
+            assert dest.read("content.db") == src.read("content.db")
+
+    def test_copies_entries_with_data_descriptors(self, tmpdir):
+        buffer = io.BytesIO()
+        _make_zip(_Unseekable(buffer))
+        assert zipfile.ZipFile(io.BytesIO(buffer.getvalue())).getinfo("content.db").flag_bits & 0x08
+
+        dest_path = tmpdir.join("dest.zip")
+        with zipfile.ZipFile(io.BytesIO(buffer.getvalue())) as src, zipfile.ZipFile(str(dest_path), "w") as dest:
+            copy_entries(src, dest, ["content.db", "khan/a.json"])
+
+        with zipfile.ZipFile(str(dest_path)) as dest:
+            assert dest.testzip() is None
+            assert dest.read("khan/a.json") == b'{"a": 1}'
+            assert not dest.getinfo("content.db").flag_bits & 0x08
+
+
+class Test_write_aligned:
+
+    def test_aligns_the_data_and_keeps_the_zip_valid(self, tmpdir):
+        source = tmpdir.join("content.db")
+        source.write_binary(os.urandom(10000))
+        path = str(tmpdir.join("en.zip"))
+
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("metadata.json", b"{}")
+            offset = write_aligned(zf, str(source), "content.db", 4096)
+            zf.writestr("frontend.mo", b"catalog")
+
+        assert offset % 4096 == 0
+        with open(path, "rb") as f:
+            f.seek(offset)
+            assert f.read(10000) == source.read_binary()
+        with zipfile.ZipFile(path) as zf:
+            assert zf.testzip() is None
+            assert zf.read("content.db") == source.read_binary()
+            assert zf.getinfo("content.db").compress_type == zipfile.ZIP_STORED
+            assert zf.getinfo("content.db").external_attr >> 16 == os.stat(str(source)).st_mode
+
+
+class Test_FanOutZipFile:
+
+    def test_writes_each_entry_to_the_outputs_that_want_it(self, tmpdir):
+        full, minimal, assessment = (str(tmpdir.join(name)) for name in ["en.zip", "minimal.zip", "khan_assessment.zip"])
+        source = tmpdir.join("frontend.mo")
+        source.write_binary(b"catalog")
+
+        with FanOutZipFile(full, [(minimal, get_minimal_pack_name), (assessment, get_khan_assessment_name)]) as zf:
+            zf.writestr("content.db", b"sqlite")
+            zf.write(str(source), "frontend.mo")
+            zf.writestr("khan/assessmentitems.version", b"0.16")
+            zf.writestr("subtitles/v1.vtt", b"WEBVTT")
+
+        assert zipfile.ZipFile(full).namelist() == ["content.db", "frontend.mo", "khan/assessmentitems.version",
+                                                    "subtitles/v1.vtt"]
+        assert zipfile.ZipFile(minimal).namelist() == ["content.db", "frontend.mo"]
+        assert zipfile.ZipFile(minimal).read("frontend.mo") == b"catalog"
+        with zipfile.ZipFile(assessment) as zf:
+            assert zf.testzip() is None
+            assert zf.namelist() == ["assessmentitems.version"]
+            assert zf.read("assessmentitems.version") == b"0.16"
+
+    def test_indexes_entries_as_they_are_written(self, tmpdir):
+        full, minimal = str(tmpdir.join("en.zip")), str(tmpdir.join("minimal.zip"))
+        source = tmpdir.join("content.db")
+        source.write_binary(b"sqlite" * 1000)
+
+        with FanOutZipFile(full, [(minimal, get_minimal_pack_name)], zipfile.ZIP_DEFLATED, index=True) as zf:
+            zf.write_aligned(str(source), "content.db", 4096)
+            zf.writestr("metadata.json", b'{"code": "en"}')
+            zf.writestr("subtitles/v1.vtt", b"WEBVTT")
+
+        for path in [full, minimal]:
+            with open(path + ".index.json") as f:
+                index = json.load(f)
+            # the same as reading each entry back and hashing it
+            assert index == write_pack_index(path)
+        assert [entry["name"] for entry in index["entries"]] == ["content.db", "metadata.json"]
+
+
+class _RangeHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    A static file server for the server's directory that answers
+    single-range requests with 206.
+    """
+
+    def translate_path(self, path):
+        # SimpleHTTPRequestHandler only takes a directory other than the current one from Python 3.7
+        return os.path.join(self.server.directory, os.path.relpath(super().translate_path(path), os.getcwd()))
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        match = re.match(r"bytes=(\d+)-(\d+)$", self.headers.get("Range") or "")
+        if not match:
+            return super().do_GET()
+
+        path = self.translate_path(self.path)
+        start, end = int(match.group(1)), int(match.group(2))
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, start + len(data) - 1, os.path.getsize(path)))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class Test_fetch_entries:
+
+    def test_fetches_entries_with_range_requests(self, tmpdir):
+        path = str(tmpdir.join("en.zip"))
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("metadata.json", b'{"code": "en"}')
+            zf.writestr("frontend.mo", b"catalog")
+            zf.writestr("content.db", b"sqlite" * 100, zipfile.ZIP_DEFLATED)
+            zf.writestr("subtitles/v1.vtt", os.urandom(200 * 1024))
+            zf.writestr("khan/a.json", b"{}")
+        index = write_pack_index(path)
+        assert [entry["name"] for entry in index["entries"]][:2] == ["metadata.json", "frontend.mo"]
+
+        server = http.server.HTTPServer(("127.0.0.1", 0), _RangeHandler)
+        server.directory = str(tmpdir)
+        server.requests = []
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/en.zip".format(server.server_port)
+
+        try:
+            contents = fetch_entries(url, ["metadata.json", "frontend.mo", "content.db", "khan/a.json"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert contents == {"metadata.json": b'{"code": "en"}', "frontend.mo": b"catalog",
+                            "content.db": b"sqlite" * 100, "khan/a.json": b"{}"}
+        # the index, one request for the first three entries, and one for the last, skipping the subtitles
+        assert [path for path, _ in server.requests] == ["/en.zip.index.json", "/en.zip", "/en.zip"]
+        assert all(range_ for _, range_ in server.requests[1:])
+
+    def test_rejects_unsupported_compression(self):
+        entry = {"name": "content.db", "compress_type": zipfile.ZIP_BZIP2,
+                 "sha256": "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"}
+
+        with pytest.raises(zipfile.BadZipFile):
+            _decode_entry(entry, b"")